@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+#
+# Flattens composed petrinets into a single petrinet.
+# Copyright (C) 2010  Bauke Conijn
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import metamodel
+
+
+class Interfaces:
+    """The named interface places and transitions of an AbstractPetrinet,
+    as dictionaries mapping each name to a list of elements. The names
+    that have more than one element in their list are kept in a set, such
+    that fusing them does not require scanning all names."""
+
+    def __init__(self):
+        self.places = dict()
+        self.transitions = dict()
+        self.unfusedplaces = set()
+        self.unfusedtransitions = set()
+
+    def __len__(self):
+        return len(self.places) + len(self.transitions)
+
+    @staticmethod
+    def add(elements, unfused, name, new):
+        """Adds the list of elements 'new' to the elements named 'name'."""
+        old = elements.get(name)
+        if old is None:
+            elements[name] = new
+        else:
+            old.extend(new)
+            unfused.add(name)
+
+    def update(self, other):
+        """Adds the interface elements of 'other' to this one."""
+        for (name, new) in other.places.items():
+            self.add(self.places, self.unfusedplaces, name, new)
+        for (name, new) in other.transitions.items():
+            self.add(self.transitions, self.unfusedtransitions, name, new)
+
+
+def flatten(source, net=None):
+    """Returns an instance of petrinets.m2, or of the MetaModel 'net', with
+    a single Petrinet, which is the root of 'source', an instance of
+    composedpetrinets.m2, with its compositions flattened.
+
+    A Sync composition fuses the InterfaceTransitions of the nets it
+    composes that have the same name: the fused transition has the arcs of
+    all of them. An Async composition fuses their InterfacePlaces with the
+    same name in the same way. The fused place contains the tokens of all
+    of them and has the smallest of their capacities. Fused elements remain
+    interface elements, such that the enclosing compositions can fuse them
+    further. Interface elements without a name are never fused.
+
+    The fused elements are found by looking up their names in a dictionary
+    for each composition, which contains the interface elements of the
+    nets it composes. The dictionaries of the composed nets are merged into
+    the largest one. Then the elements are copied into the new instance by
+    TransformationRules, once for each group of fused elements."""
+
+    if net is None:
+        net = metamodel.load("petrinets.m2")
+    M = type("PetrinetsModel", (), net.elements)
+    target = net.instance()
+
+    # The fused elements, as a union-find structure. Each group of fused
+    # elements is represented by one of them, which is not a key.
+    fused = dict()
+    # The tokens and capacity of each group of fused places.
+    contents = dict()
+
+    def find(element):
+        """Returns the element representing the group of 'element'."""
+        representative = element
+        while fused.get(representative, representative) is not representative:
+            representative = fused[representative]
+        while element is not representative:
+            (fused[element], element) = (representative, fused[element])
+        return representative
+
+    def fuse(elements):
+        """Fuses 'elements' into one group and returns its representative."""
+        first = find(elements[0])
+        for element in elements[1:]:
+            element = find(element)
+            if element is not first:
+                fused[element] = first
+                if hasattr(first, "tokens"):
+                    (tokens, capacity) = contents.pop(element, (element.tokens, element.capacity))
+                    (firsttokens, firstcapacity) = contents.get(first, (first.tokens, first.capacity))
+                    contents[first] = (
+                        None if tokens is None and firsttokens is None else (tokens or 0) + (firsttokens or 0),
+                        capacity if firstcapacity is None else firstcapacity if capacity is None else min(capacity, firstcapacity),
+                    )
+        return first
+
+    @metamodel.TransformationRule
+    def interfaces(petrinet):
+        """Returns the interfaces of 'petrinet', after fusing them, as an
+        Interfaces object."""
+        if not hasattr(petrinet, "composes"):
+            result = Interfaces()
+            for place in petrinet.places:
+                if type(place).__name__ == "InterfacePlace" and place.name is not None:
+                    result.add(result.places, result.unfusedplaces, place.name, [place])
+            for transition in petrinet.transitions:
+                if type(transition).__name__ == "InterfaceTransition" and transition.name is not None:
+                    result.add(result.transitions, result.unfusedtransitions, transition.name, [transition])
+            return result
+
+        # Merge the interfaces of the composed nets into the largest one.
+        parts = [interfaces(child) for child in petrinet.composes]
+        if not parts:
+            return Interfaces()
+        result = max(parts, key=len)
+        for part in parts:
+            if part is not result:
+                result.update(part)
+
+        # Fuse the elements with the same name that were not fused yet.
+        if type(petrinet).__name__ == "Sync":
+            (fusing, unfused) = (result.transitions, result.unfusedtransitions)
+        else:
+            (fusing, unfused) = (result.places, result.unfusedplaces)
+        for name in unfused:
+            fusing[name] = [fuse(fusing[name])]
+        unfused.clear()
+        return result
+
+    @metamodel.TransformationRule
+    def copy_place(place):
+        (tokens, capacity) = contents.get(place, (place.tokens, place.capacity))
+        return getattr(M, type(place).__name__)(of=root, name=place.name, tokens=tokens, capacity=capacity)
+
+    @metamodel.TransformationRule
+    def copy_transition(transition):
+        return getattr(M, type(transition).__name__)(of=root, name=transition.name)
+
+    @metamodel.TransformationRule
+    def copy_arc(arc):
+        if type(arc).__name__ == "InputArc":
+            return M.InputArc(source=copy_place(find(arc.source)), dest=copy_transition(find(arc.dest)), weight=arc.weight)
+        else:
+            return M.OutputArc(source=copy_transition(find(arc.source)), dest=copy_place(find(arc.dest)), weight=arc.weight)
+
+    # The rules are defined for each call, so they are applied in a context
+    # of their own, which does not keep 'source' and 'target' alive.
+    with metamodel.TransformationContext():
+        top = source.root()
+        interfaces(top)
+        with target:
+            target.identifiers["root"] = root = M.Petrinet(name=getattr(top, "name", None))
+            stack = [top]
+            while stack:
+                petrinet = stack.pop()
+                if hasattr(petrinet, "composes"):
+                    stack.extend(reversed(list(petrinet.composes)))
+                    continue
+                for place in petrinet.places:
+                    copy_place(find(place))
+                for transition in petrinet.transitions:
+                    copy_transition(find(transition))
+                for place in petrinet.places:
+                    for arc in place.totransitions:
+                        copy_arc(arc)
+                    for arc in place.fromtransitions:
+                        copy_arc(arc)
+    return target
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    if len(sys.argv)==1:
+        sys.argv.append("-")
+    if len(sys.argv)!=2 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
+        print("Usage: {0} [filename.m1|-]".format(sys.argv[0]))
+        sys.exit(1)
+
+    composed = metamodel.load("composedpetrinets.m2")
+    print(flatten(composed.instance().load(sys.argv[1])))
@@ -21,8 +21,10 @@ import os
 
 if len(sys.argv)==1:
     sys.argv.append("-")
-if len(sys.argv)!=2 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
-    print("Usage: {0} [filename.m1|-]".format(sys.argv[0]))
+if len(sys.argv)==2:
+    sys.argv.append("-")
+if len(sys.argv)!=3 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
+    print("Usage: {0} [filename.m1|- [output.dot|output.dot.gz|-]]".format(sys.argv[0]))
     sys.exit(1)
 
 import metamodel
@@ -33,60 +35,48 @@ netin = net.instance().load(sys.argv[1])
 M=type("DeclareModel", (), net.elements)
 
 @metamodel.TransformationRule
-def declare2graphviz(declare):
-    global activitycount, relationcount, negatecount
-    activitycount=0
-    relationcount=0
-    negatecount=0
-    r = ["digraph {", "overlap=false;", "splines=true;", "model=mds;"]
-    r.append("// Activities:")
+def declare2graphviz(declare, dot):
+    dot.write("// Activities:")
     for activity in declare.init:
-        activity2graphviz(activity, r)
+        activity2graphviz(activity, dot)
     for activity in declare.activities:
-        activity2graphviz(activity, r)
-    r.append("// Binary Relations:")
+        activity2graphviz(activity, dot)
+    dot.write("// Binary Relations:")
     for activity in declare.activities:
         for binary in activity.relatedleft:
-            binary2graphviz(binary, r)
-    r.append("// N-ary Relations:")
+            binary2graphviz(binary, dot)
+    dot.write("// N-ary Relations:")
     for relation in declare.relations:
-        relation2graphviz(relation, r)
-    
-    r.append("}\n")
-    return "\n".join(r)
+        relation2graphviz(relation, dot)
 
 @metamodel.TransformationRule
-def activity2graphviz(activity,r):
-    global activitycount
-    tag = "A{0}".format(activitycount)
-    activitycount += 1
-    r.append('{0} [shape=none, label=<<TABLE BORDER="0" CELLBORDER="0" CELLSPACING="0" CELLPADDING="0">'.format(tag))
+def activity2graphviz(activity,dot):
+    tag = "A{0}".format(dot.count("activity"))
+    dot.write('{0} [shape=none, label=<<TABLE BORDER="0" CELLBORDER="0" CELLSPACING="0" CELLPADDING="0">'.format(tag))
     if isinstance(activity, M.InitialActivity):
-        r.append('<TR><TD></TD><TD BORDER="1">init</TD><TD></TD></TR>')
+        dot.write('<TR><TD></TD><TD BORDER="1">init</TD><TD></TD></TR>')
     else:
         lowerbound = activity.existence if activity.existence!=None and activity.existence>0 else 0
         upperbound = activity.absence-1 if activity.absence!=None else "*"
         if lowerbound==upperbound:
-            r.append('<TR><TD></TD><TD BORDER="1">{0}</TD><TD></TD></TR>'.format(lowerbound))
+            dot.write('<TR><TD></TD><TD BORDER="1">{0}</TD><TD></TD></TR>'.format(lowerbound))
         elif lowerbound!=0 or upperbound!="*":
-            r.append('<TR><TD></TD><TD BORDER="1">{0}..{1}</TD><TD></TD></TR>'.format(lowerbound, upperbound))
-    r.append('<TR><TD BORDER="1" COLSPAN="3" CELLPADDING="10" PORT="T">{0}</TD></TR>'.format(activity.name))
-    r.append('</TABLE>>];') 
+            dot.write('<TR><TD></TD><TD BORDER="1">{0}..{1}</TD><TD></TD></TR>'.format(lowerbound, upperbound))
+    dot.write('<TR><TD BORDER="1" COLSPAN="3" CELLPADDING="10" PORT="T">{0}</TD></TR>'.format(activity.name))
+    dot.write('</TABLE>>];') 
     return tag
 
 @metamodel.TransformationRule
-def relation2graphviz(relation, r):
-    global relationcount
-    tag = "R{0}".format(relationcount)
-    relationcount += 1
+def relation2graphviz(relation, dot):
+    tag = "R{0}".format(dot.count("relation"))
     n = relation.count if relation.count != None else 1
     label = r'{0} of {1}'.format(n, len(relation.contains))
     if isinstance(relation, M.Choice):
-        r.append('{0} [shape=diamond, label="{1}", fontsize=12];'.format(tag, label))
+        dot.write('{0} [shape=diamond, label="{1}", fontsize=12];'.format(tag, label))
     elif isinstance(relation, M.Exclusive):
-        r.append('{0} [shape=diamond, label="{1}", fontsize=12, style="filled", fillcolor="black", fontcolor="white", fontname="bold"];'.format(tag, label))
+        dot.write('{0} [shape=diamond, label="{1}", fontsize=12, style="filled", fillcolor="black", fontcolor="white", fontname="bold"];'.format(tag, label))
     for participation in relation.contains:
-        r.append('{0}:T->{1} [dir=none];'.format(activity2graphviz(participation.activity), tag))
+        dot.write('{0}:T->{1} [dir=none];'.format(activity2graphviz(participation.activity), tag))
     return tag
     
 binarystyles = {
@@ -112,7 +102,7 @@ binarystyles = {
 }
     
 @metamodel.TransformationRule
-def binary2graphviz(binary, r):
+def binary2graphviz(binary, dot):
     left =activity2graphviz(binary.left)+":T"
     right=activity2graphviz(binary.right)+":T"
     try:
@@ -120,16 +110,15 @@ def binary2graphviz(binary, r):
         color = ":".join(["black"]*style[3])
         if style[2]:
             # Negation
-            global negatecount
-            tag = "N{0}".format(negatecount)
-            negatecount += 1
-            r.append('{0} -> {1} [arrowtail="{2[0]}", arrowhead="tee", color="{3}", dir=both, len=.8];'.format(left, tag, style, color))
-            r.append('{0} -> {1} [arrowtail="tee", arrowhead="{2[1]}", color="{3}", dir=both, len=.8];'.format(tag, right, style, color))
-            r.append('{0} [shape=point, label="", width=0, height=0];'.format(tag))
+            tag = "N{0}".format(dot.count("negation"))
+            dot.write('{0} -> {1} [arrowtail="{2[0]}", arrowhead="tee", color="{3}", dir=both, len=.8];'.format(left, tag, style, color))
+            dot.write('{0} -> {1} [arrowtail="tee", arrowhead="{2[1]}", color="{3}", dir=both, len=.8];'.format(tag, right, style, color))
+            dot.write('{0} [shape=point, label="", width=0, height=0];'.format(tag))
         else:
-            r.append('{0} -> {1} [arrowtail="{2[0]}", arrowhead="{2[1]}", color="{3}", dir=both, len=1.5];'.format(left, right, style, color))
+            dot.write('{0} -> {1} [arrowtail="{2[0]}", arrowhead="{2[1]}", color="{3}", dir=both, len=1.5];'.format(left, right, style, color))
             
     except KeyError:
-        r.append('{0} -> {1} [color=red, len=1.5, label="{2}"];'.format(left, right, binary.__class__.__name__))
+        dot.write('{0} -> {1} [color=red, len=1.5, label="{2}"];'.format(left, right, binary.__class__.__name__))
 
-print(declare2graphviz(netin.root()))
+with metamodel.DotWriter.open(sys.argv[2], "overlap=false;", "splines=true;", "model=mds;") as dot:
+    declare2graphviz(netin.root(), dot)
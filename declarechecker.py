@@ -0,0 +1,488 @@
+#!/usr/bin/python3
+#
+# Checks event logs against Declare models.
+# Copyright (C) 2010  Bauke Conijn
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import csv
+import gc
+import gzip
+import io
+import resource
+import sys
+import time
+from collections import deque
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+
+import metamodel
+
+# The state of a constraint that is violated, whatever events follow.
+violated = "violated"
+
+# The templates of the constraints. Each is a function that returns the
+# initial state, a function that returns the next state given the current
+# state and whether the event is the left and the right activity of the
+# constraint, and a function that returns whether a trace ending in a
+# state satisfies the constraint.
+
+def respondedexistence():
+    # 0: neither occurred, 1: left occurred, 2: right occurred.
+    return (0, lambda s, l, r: 2 if s == 2 or r else 1 if l or s == 1 else 0, lambda s: s != 1)
+
+def coexistence():
+    return ((False, False), lambda s, l, r: (s[0] or l, s[1] or r), lambda s: s[0] == s[1])
+
+def response():
+    # Whether a left activity awaits a right activity.
+    return (False, lambda s, l, r: l or (s and not r), lambda s: not s)
+
+def precedence():
+    # Whether the left activity occurred.
+    return (False, lambda s, l, r: violated if r and not s else s or l, lambda s: True)
+
+def alternateresponse():
+    return (False, lambda s, l, r: violated if s and l and not r else l or (s and not r), lambda s: not s)
+
+def alternateprecedence():
+    # Whether the left activity occurred since the last right activity.
+    return (False, lambda s, l, r: violated if r and not s else l or (s and not r), lambda s: True)
+
+def chainresponse():
+    return (False, lambda s, l, r: violated if s and not r else l, lambda s: not s)
+
+def chainprecedence():
+    # Whether the previous event is the left activity.
+    return (False, lambda s, l, r: violated if r and not s else l, lambda s: True)
+
+def notcoexistence():
+    return ((False, False), lambda s, l, r: violated if (s[0] or l) and (s[1] or r) else (s[0] or l, s[1] or r), lambda s: True)
+
+def notsuccession():
+    return (False, lambda s, l, r: violated if r and s else s or l, lambda s: True)
+
+def notchainsuccession():
+    return (False, lambda s, l, r: violated if r and s else l, lambda s: True)
+
+def both(first, second):
+    """Returns the template of satisfying both templates."""
+    def template():
+        (initial1, step1, accept1) = first()
+        (initial2, step2, accept2) = second()
+        def step(s, l, r):
+            s1 = step1(s[0], l, r)
+            s2 = step2(s[1], l, r)
+            return violated if s1 is violated or s2 is violated else (s1, s2)
+        return ((initial1, initial2), step, lambda s: accept1(s[0]) and accept2(s[1]))
+    return template
+
+# The templates with a count are created once for each count, such that the
+# constraints with the same count share their automaton.
+
+@lru_cache(maxsize=None)
+def existence(n):
+    """The template of the left activity occurring at least 'n' times."""
+    return lambda: (0, lambda s, l, r: min(s + l, n), lambda s: s >= n)
+
+@lru_cache(maxsize=None)
+def absence(n):
+    """The template of the left activity occurring less than 'n' times."""
+    return lambda: (0, lambda s, l, r: violated if s + l >= n else s + l, lambda s: True)
+
+def init():
+    """The template of the left activity being the first event."""
+    return (0, lambda s, l, r: 1 if s == 1 or l else violated, lambda s: s == 1)
+
+binarytemplates = dict(
+    RespondedExistence=respondedexistence,
+    CoExistence=coexistence,
+    Response=response,
+    Precedence=precedence,
+    Succession=both(response, precedence),
+    AlternateResponse=alternateresponse,
+    AlternatePrecedence=alternateprecedence,
+    AlternateSuccession=both(alternateresponse, alternateprecedence),
+    ChainResponse=chainresponse,
+    ChainPrecedence=chainprecedence,
+    ChainSuccession=both(chainresponse, chainprecedence),
+    NotCoExistence=notcoexistence,
+    NotSuccession=notsuccession,
+    NotChainSuccession=notchainsuccession,
+)
+
+
+def automaton(template):
+    """Compiles 'template' into a deterministic finite automaton. Returns
+    its transition table, which maps 4*state+symbol to the next state, and
+    whether each state is accepting. The initial state is 0. The symbol of
+    an event is 1 if it is the left activity, plus 2 if it is the right
+    activity."""
+    (initial, step, accept) = template()
+    numbers = {initial: 0}
+    states = [initial]
+    table = []
+    for s in states:
+        for symbol in range(4):
+            t = violated if s is violated else step(s, bool(symbol & 1), bool(symbol & 2))
+            if t not in numbers:
+                numbers[t] = len(states)
+                states.append(t)
+            table.append(numbers[t])
+    return (table, [s is not violated and bool(accept(s)) for s in states])
+
+
+class Checker:
+    """Checks traces against the constraints of a DeclareDiagram element of
+    an instance of declare.m2. A trace is a sequence of activity names. The
+    initial activity must be the first event of each trace. An activity
+    with 'existence' n must occur at least n times and with 'absence' n
+    less than n times. A Choice of 'count' n, which is 1 by default,
+    requires at least n of its activities to occur and an Exclusive
+    exactly n. The binary relations follow the usual Declare semantics,
+    where 'left' is the activity that comes first in the name of the
+    relation: Response(left=a, right=b) requires each a to be followed by
+    a b and Precedence(left=a, right=b) each b to be preceded by an a.
+
+    The binary and unary constraints are compiled into finite automata,
+    of which the transition tables are stored consecutively. An event only
+    updates the automata of the constraints on its activity, and of those
+    in a state in which any other activity changes their state, such as
+    ChainResponse after its left activity. The N-ary relations count the
+    distinct activities that occur. The number of traces that violate each
+    constraint is counted in 'violations'."""
+
+    def __init__(self, diagram):
+        # The description and element of each constraint.
+        self.constraints = []
+        self.elements = []
+        # The transition table of the automata and, for each state, whether
+        # it is accepting and whether an event of another activity changes it.
+        self.delta = array.array("q")
+        self.accepting = []
+        self.armable = []
+        # The initial state of each constraint, -1 for N-ary relations.
+        self.initial = array.array("q")
+        # Maps each activity name to a dictionary mapping the automata that
+        # it updates to the symbol of the activity.
+        self.watch = dict()
+        # The N-ary relations: (constraint, activity names, count, exact).
+        self.nary = []
+        self.__automata = dict()
+
+        for activity in diagram.init:
+            self.__add(activity, "Init({0})".format(activity.name), init, activity.name)
+        for activity in diagram.activities:
+            if activity.existence is not None and activity.existence > 0:
+                self.__add(activity, "Existence({0}, {1})".format(activity.name, activity.existence),
+                    existence(activity.existence), activity.name)
+            if activity.absence is not None:
+                self.__add(activity, "Absence({0}, {1})".format(activity.name, activity.absence),
+                    absence(activity.absence), activity.name)
+        for activity in list(diagram.init) + list(diagram.activities):
+            for relation in activity.relatedright:
+                name = type(relation).__name__
+                if name not in binarytemplates:
+                    raise ValueError("Unknown constraint {0}".format(relation))
+                self.__add(relation, "{0}({1}, {2})".format(name, relation.left.name, relation.right.name),
+                    binarytemplates[name], relation.left.name, relation.right.name)
+        for relation in diagram.relations:
+            names = [participation.activity.name for participation in relation.contains]
+            count = relation.count if relation.count is not None else 1
+            self.nary.append((len(self.constraints), frozenset(names), count, type(relation).__name__ == "Exclusive"))
+            self.constraints.append("{0}({1} of {2})".format(type(relation).__name__, count, ", ".join(names)))
+            self.elements.append(relation)
+            self.initial.append(-1)
+            for name in names:
+                self.watch.setdefault(name, dict())
+        self.participants = frozenset(name for (c, names, count, exact) in self.nary for name in names)
+        self.initialarmed = [c for (c, s) in enumerate(self.initial) if s >= 0 and self.armable[s]]
+        self.clear()
+
+    def __add(self, element, description, template, left, right=None):
+        """Adds the automaton of a constraint."""
+        c = len(self.constraints)
+        self.constraints.append(description)
+        self.elements.append(element)
+        if template not in self.__automata:
+            (table, accepting) = automaton(template)
+            base = len(self.accepting)
+            self.delta.extend(base + s for s in table)
+            self.accepting.extend(accepting)
+            self.armable.extend(table[4*s] != s for s in range(len(accepting)))
+            self.__automata[template] = base
+        self.initial.append(self.__automata[template])
+        for (symbol, name) in ((1, left), (2, right)):
+            if name is not None:
+                automata = self.watch.setdefault(name, dict())
+                automata[c] = automata.get(c, 0) | symbol
+
+    def clear(self):
+        """Resets the counts."""
+        self.violations = array.array("q", [0]) * len(self.constraints)
+        self.traces = 0
+        self.events = 0
+        self.violating = 0
+        self.seconds = 0
+        self.peak = 0
+
+    def __checking(self):
+        """Returns a function that checks a trace, updates the counts and
+        returns the numbers of the violated constraints. The tables are
+        bound to local variables once, which makes checking many traces
+        faster."""
+        delta = self.delta
+        accepting = self.accepting
+        armable = self.armable
+        initial = self.initial
+        initialarmed = self.initialarmed
+        watch = self.watch
+        nary = self.nary
+        participants = self.participants
+        violations = self.violations
+        def check(trace):
+            state = initial[:]
+            armed = set(initialarmed)
+            seen = set()
+            n = 0
+            for (n, name) in enumerate(trace, 1):
+                automata = watch.get(name)
+                if armed:
+                    # Feed the other activity to the automata that need it.
+                    for c in tuple(armed):
+                        if automata is None or c not in automata:
+                            s = state[c] = delta[4*state[c]]
+                            if not armable[s]:
+                                armed.discard(c)
+                if automata is not None:
+                    for (c, symbol) in automata.items():
+                        s = state[c] = delta[4*state[c] + symbol]
+                        if armable[s]:
+                            armed.add(c)
+                        else:
+                            armed.discard(c)
+                    if name in participants:
+                        seen.add(name)
+            failed = [c for (c, s) in enumerate(state) if s >= 0 and not accepting[s]]
+            for (c, names, count, exact) in nary:
+                k = len(seen & names)
+                if k < count or (exact and k != count):
+                    failed.append(c)
+            for c in failed:
+                violations[c] += 1
+            return (n, failed)
+        return check
+
+    def check(self, trace):
+        """Checks the sequence of activity names 'trace' and returns the
+        descriptions of the constraints it violates."""
+        (n, failed) = self.__checking()(trace)
+        self.traces += 1
+        self.events += n
+        self.violating += bool(failed)
+        return [self.constraints[c] for c in sorted(failed)]
+
+    def check_rows(self, rows, columns=None):
+        """Checks the traces in 'rows', which are lists of strings. If
+        'columns' is None, each row is a trace. Otherwise it is the pair of
+        column numbers of the case and the activity and each row is an
+        event. The events of a case must be consecutive. Empty rows are
+        skipped."""
+        check = self.__checking()
+        rows = (row for row in rows if row)
+        if columns is None:
+            traces = rows
+        else:
+            (case, activity) = columns
+            activity = itemgetter(activity)
+            traces = (map(activity, events) for (c, events) in groupby(rows, itemgetter(case)))
+        (tracecount, events, violating) = (0, 0, 0)
+        for trace in traces:
+            (n, failed) = check(trace)
+            tracecount += 1
+            events += n
+            if failed:
+                violating += 1
+        self.traces += tracecount
+        self.events += events
+        self.violating += violating
+
+    def run(self, filename, format="events", case="case", activity="activity", processes=1, chunk=100000):
+        """Checks the log in the CSV file 'filename', which is compressed
+        if it ends with '.gz' and read from standard input if it is '-',
+        and returns a report, see 'report'. The log is read as a stream.
+        With format "events", the log has a header and a row for each
+        event, of which the columns named 'case' and 'activity' are used.
+        The events of each case must be consecutive. With format "traces",
+        each row is a trace containing the names of its activities. Fields
+        can be quoted, but must not contain line breaks.
+
+        With 'processes' more than 1, the log is split into chunks of at
+        least 'chunk' lines, ending with a trace, which are checked by that
+        many worker processes, see metamodel.worker_pool. Reading the log
+        waits for the workers, such that the memory used is bounded by the
+        size of the chunks and the longest trace."""
+        if format not in ("events", "traces"):
+            raise ValueError("Unknown format '{0}'".format(format))
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+
+        if filename == "-":
+            f = sys.stdin.buffer
+        elif filename.endswith(".gz"):
+            f = gzip.open(filename, "rb")
+        else:
+            f = open(filename, "rb")
+        try:
+            columns = None
+            if format == "events":
+                header = next(csv.reader([f.readline().decode("utf-8")]), [])
+                for name in (case, activity):
+                    if name not in header:
+                        raise ValueError("The log has no column '{0}'".format(name))
+                columns = (header.index(case), header.index(activity))
+            if processes > 1:
+                self.__run_parallel(f, columns, processes, chunk)
+            else:
+                text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+                self.check_rows(csv.reader(text), columns)
+                text.detach()
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+        self.seconds += time.time() - start
+        self.peak = max(self.peak, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024)
+        return self.report()
+
+    def __run_parallel(self, f, columns, processes, chunk):
+        """Checks the lines of the binary file 'f' using worker processes 
+        and adds their counts. Each worker receives a copy of this checker
+        once. At most two chunks per worker are waiting to be checked."""
+        pending = deque()
+        with metamodel.worker_pool(processes, startworker, (self, columns)) as pool:
+            try:
+                for lines in chunks(f, columns[0] if columns else None, chunk):
+                    if len(pending) >= 2 * processes:
+                        self.__add_counts(pending.popleft().result())
+                    pending.append(pool.submit(checkchunk, lines))
+                while pending:
+                    self.__add_counts(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def __add_counts(self, counts):
+        """Adds the counts returned by 'checkchunk'."""
+        (violations, traces, events, violating) = counts
+        for (c, v) in enumerate(violations):
+            self.violations[c] += v
+        self.traces += traces
+        self.events += events
+        self.violating += violating
+
+    def __getstate__(self):
+        # The elements and the templates of the automata are not needed for
+        # checking and can not be pickled.
+        state = dict(self.__dict__)
+        state["elements"] = None
+        state["_Checker__automata"] = None
+        return state
+
+    def report(self):
+        """Returns the results as a dictionary: the number of traces,
+        events and traces violating a constraint, a list of the description
+        of each constraint and the number of traces that violate it, how
+        long checking took, how many events were checked per second and by
+        how much it increased the peak memory usage of this process in
+        bytes."""
+        return dict(
+            traces=self.traces,
+            events=self.events,
+            violating=self.violating,
+            constraints=list(zip(self.constraints, self.violations)),
+            seconds=self.seconds,
+            events_per_second=self.events/self.seconds if self.seconds else None,
+            peak_bytes=self.peak,
+        )
+
+
+def chunks(f, case, size):
+    """Generates the lines of the binary file 'f' in chunks of at least
+    'size' lines, as bytes. If 'case' is not None, a chunk does not end
+    until that column changes."""
+    lines = []
+    key = None
+    for line in f:
+        if len(lines) >= size:
+            if case is None:
+                yield b"".join(lines)
+                lines = []
+            else:
+                row = next(csv.reader([line.decode("utf-8")]), None)
+                linekey = row[case] if row and len(row) > case else None
+                if key is None:
+                    row = next(csv.reader([lines[-1].decode("utf-8")]), None)
+                    key = row[case] if row and len(row) > case else None
+                if linekey != key:
+                    yield b"".join(lines)
+                    lines = []
+                    key = None
+        lines.append(line)
+    if lines:
+        yield b"".join(lines)
+
+
+# The checker and the columns of the log used by a worker process.
+worker = None
+
+def startworker(checker, columns):
+    """Sets the checker used by this worker process, see Checker.run."""
+    global worker
+    worker = (checker, columns)
+
+def checkchunk(lines):
+    """Checks the lines in the chunk 'lines', which is bytes, using the
+    checker of this worker process and returns the counts."""
+    (checker, columns) = worker
+    checker.clear()
+    checker.check_rows(csv.reader(io.StringIO(lines.decode("utf-8"), newline="")), columns)
+    return (list(checker.violations), checker.traces, checker.events, checker.violating)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Checks an event log against a Declare model.")
+    parser.add_argument("model", help="the Declare instance")
+    parser.add_argument("log", nargs="?", default="-", help="the CSV log, optionally compressed with gzip (default: standard input)")
+    parser.add_argument("--traces", action="store_true", help="each row of the log is a trace, instead of an event")
+    parser.add_argument("--case", default="case", help="the column of the case of an event (default: case)")
+    parser.add_argument("--activity", default="activity", help="the column of the activity of an event (default: activity)")
+    parser.add_argument("--processes", type=int, default=1, help="the number of worker processes")
+    parser.add_argument("--chunk", type=int, default=100000, help="the number of lines passed to a worker at once")
+    args = parser.parse_args()
+
+    declare = metamodel.load("declare.m2")
+    declarein = declare.instance().load(args.model)
+
+    checker = Checker(declarein.root())
+    report = checker.run(args.log, "traces" if args.traces else "events", args.case, args.activity, args.processes, args.chunk)
+    for (description, violations) in report["constraints"]:
+        print("{0:10} {1}".format(violations, description))
+    print("{0} of {1} traces violate a constraint, {2} events, {3:.2f} s, {4:.0f} events/s".format(
+        report["violating"], report["traces"], report["events"], report["seconds"], report["events_per_second"] or 0))
@@ -0,0 +1,567 @@
+#!/usr/bin/python3
+#
+# Benchmarks for the metamodel module
+# Copyright (C) 2010  Bauke Conijn
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import composedpetrinet2petrinet
+import declarechecker
+import metamodel
+import petrinetreachability
+import petrinetsimulation
+
+
+def petrinet(net, size):
+    """Creates an instance of petrinets.m2 with approximately 'size' elements.
+    The net is a ring of places and transitions, connected by arcs."""
+    M = net.elements
+    instance = net.instance()
+    instance.identifiers["root"] = root = M["Petrinet"](name="ring")
+    first = place = M["Place"](of=root, name="p0", tokens=1)
+    for i in range(max(1, size//4)):
+        transition = M["Transition"](of=root)
+        M["InputArc"](source=place, dest=transition, weight=1)
+        place = M["Place"](of=root, tokens=0) if 4*i+4 < size else first
+        M["OutputArc"](source=transition, dest=place, weight=1)
+    return instance
+
+
+def bulkpetrinet(net, size):
+    """Creates the same petrinet as 'petrinet', using bulk construction."""
+    M = net.elements
+    instance = net.instance()
+    instance.identifiers["root"] = root = M["Petrinet"](name="ring")
+    n = max(1, size//4)
+    places = M["Place"].bulk(of=[root]*n, name=["p0"] + [None]*(n-1), tokens=[1] + [0]*(n-1))
+    transitions = M["Transition"].bulk(of=[root]*n)
+    M["InputArc"].bulk(source=places, dest=transitions, weight=[1]*n)
+    M["OutputArc"].bulk(source=transitions, dest=places[1:] + places[:1], weight=[1]*n)
+    return instance
+
+
+def writepetrinet(f, size):
+    """Writes the same petrinet as 'petrinet' as instance description to 'f'."""
+    f.write('root = Petrinet(name="ring")\n')
+    f.write('p0 = first = Place(of=root, name="p0", tokens=1)\n')
+    for i in range(max(1, size//4)):
+        f.write('t{0} = Transition(of=root)\n'.format(i))
+        f.write('InputArc(source=p{0}, dest=t{0}, weight=1)\n'.format(i))
+        if 4*i+4 < size:
+            f.write('p{0} = Place(of=root, tokens=0)\n'.format(i+1))
+            f.write('OutputArc(source=t{0}, dest=p{1}, weight=1)\n'.format(i, i+1))
+        else:
+            f.write('OutputArc(source=t{0}, dest=first, weight=1)\n'.format(i))
+
+
+def writedeclare(f, size):
+    """Writes an instance of declare.m2 with approximately 'size' elements to 'f'.
+    It is a chain of activities, connected by binary relations, with a choice
+    between every tenth activity and its predecessor."""
+    relations = ["Response", "Precedence", "Succession", "ChainResponse", "NotCoExistence"]
+    f.write('root = DeclareDiagram()\n')
+    f.write('a0 = InitialActivity(of=root, name="a0")\n')
+    for i in range(1, max(2, size*10//23)):
+        f.write('a{0} = Activity(of=root, name="a{0}", existence={1})\n'.format(i, i%3))
+        f.write('{0}(left=a{1}, right=a{2})\n'.format(relations[i%len(relations)], i-1, i))
+        if i%10 == 0:
+            f.write('c{0} = Choice(of=root, count=1)\n'.format(i))
+            f.write('Participation(activity=a{0}, relation=c{0})\n'.format(i))
+            f.write('Participation(activity=a{0}, relation=c{1})\n'.format(i-1, i))
+
+
+def writemof(f, size):
+    """Writes an instance of mof.m3 with approximately 'size' elements to 'f'.
+    It is a chain of elements, each with an attribute and an association to
+    its predecessor. Every fifth element extends its predecessor."""
+    f.write('root = MetaModel()\n')
+    f.write('e0 = Element(of=root, name="E0")\n')
+    for i in range(1, max(2, size//3)):
+        extends = ", extends=e{0}".format(i-1) if i%5 == 0 else ""
+        f.write('e{0} = Element(of=root, name="E{0}"{1})\n'.format(i, extends))
+        f.write('Attribute(of=e{0}, name="x{0}")\n'.format(i))
+        f.write('Association(parent=e{0}, child=e{1}, parentname="p{1}", childname="c{1}", optional=False)\n'.format(i-1, i))
+
+
+# For each meta model: the file describing it, a function writing instances
+# and the shipped transformation scripts that apply to it.
+models = dict(
+    petrinets=("petrinets.m2", writepetrinet, ["petrinetskeleton.py", "petrinet2graphviz.py"]),
+    declare=("declare.m2", writedeclare, ["declare2graphviz.py"]),
+    mof=("mof.m3", writemof, ["mof2graphviz.py"]),
+)
+
+# The measurements, which are written as JSON when requested.
+results = []
+
+# The file to which the measurements are printed.
+log = sys.stdout
+
+def report(benchmark, name, n, duration, peak, **extra):
+    """Prints a measurement and adds it to the results."""
+    record = dict(benchmark=benchmark, name=name, elements=n, seconds=duration, 
+        elements_per_second=n/duration if duration else None, peak_bytes=peak)
+    record.update(extra)
+    results.append(record)
+    print("{0:8} {1:24}: {2} elements, {3:.2f} s, {4:.0f} elements/s, peak +{5:.1f} MB".format(
+        benchmark, name, n, duration, record["elements_per_second"] or 0, peak/1e6), file=log)
+
+
+def measure(f, *args, setup=None):
+    """Calls f in a forked process and returns its result, the time it took 
+    and by how much it increased the peak memory usage of the process.
+    The result must be serializable as JSON. If 'setup' is given, its result
+    is passed as first argument to f and it is not measured."""
+    (rd, wr) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child process: run f and report the measurements to the parent.
+        os.close(rd)
+        if setup is not None:
+            args = (setup(),) + args
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        r = f(*args)
+        duration = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        with os.fdopen(wr, "w") as out:
+            json.dump([r, duration, peak*1024], out)
+        os._exit(0)
+    os.close(wr)
+    with os.fdopen(rd) as result:
+        data = result.read()
+    os.waitpid(pid, 0)
+    return tuple(json.loads(data))
+
+
+def run(script, *arguments):
+    """Runs a python script in a separate process and returns the time it 
+    took and its peak memory usage. Its output is discarded."""
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.execv(sys.executable, [sys.executable, script] + list(arguments))
+    (pid, status, usage) = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError("{0} failed with status {1}".format(script, status))
+    return (time.time() - start, usage.ru_maxrss*1024)
+
+
+def count(instance):
+    """Returns the number of elements reachable from the root of 'instance'."""
+    root = instance.root()
+    return 1 + len(root.places) + len(root.transitions) + sum(
+        len(place.totransitions) + len(place.fromtransitions) for place in root.places)
+
+
+def neighbourhood(instance):
+    """Visits the transitions connected to the first place of 'instance' and 
+    returns the number of elements that were created by doing so."""
+    place = instance.identifiers["first"]
+    for arc in place.totransitions:
+        len(arc.dest.toplaces)
+    for arc in place.fromtransitions:
+        len(arc.source.fromplaces)
+    return size(instance)
+
+
+def size(instance):
+    """Returns the number of elements of 'instance'."""
+    return len(instance.all_of(metamodel.AbstractElement))
+
+
+def memory(args):
+    """Reports the memory used per element of a petrinet, for both the
+    default and the compact storage."""
+    for compact in (False, True):
+        net = metamodel.load("petrinets.m2", compact=compact)
+        gc.collect()
+        tracemalloc.start()
+        start = time.time()
+        instance = petrinet(net, args.elements)
+        duration = time.time() - start
+        (used, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        n = count(instance)
+        report("memory", "compact" if compact else "default", n, duration, peak, bytes_per_element=used/n)
+        del instance
+
+
+def bulk(args):
+    """Compares creating a petrinet element by element to creating it in bulk."""
+    for compact in (False, True):
+        net = metamodel.load("petrinets.m2", compact=compact)
+        for create in (petrinet, bulkpetrinet):
+            (n, duration, peak) = measure(lambda: count(create(net, args.elements)))
+            report("bulk", "{0} {1}".format(create.__name__, "compact" if compact else "default"), n, duration, peak)
+
+
+class DispatchElement(object):
+    """Mimics the generic __getattr__ dispatch that was used before fields 
+    became descriptors, for comparing the field access to."""
+    
+    def __init__(self, element):
+        self.__dict__["_fields"] = element._fields
+        self.__dict__["_values"] = dict(element._values)
+    
+    def __getattr__(self, name):
+        if name[0]=="_":
+            return self.__dict__[name]
+        if name in self._values:
+            return self._values[name]
+        if name not in self._fields:
+            raise AttributeError("Unknown Attribute '{0}'".format(name))
+        if isinstance(self._fields[name], metamodel.ChildListField):
+            self._values[name] = r = set()
+            return r
+        return None
+
+
+def dispatchconstruct(cls, **kwargs):
+    """Mimics the constructor that was used before the element classes were
+    frozen, for comparing the construction of elements to."""
+    element = cls.__new__(cls)
+    metamodel.setinstance(element, None)
+    metamodel.setfield(element, "_values", dict())
+    fields = cls._fields
+    for (k,v) in kwargs.items():
+        if k not in fields:
+            raise AttributeError("Unknown Attribute '{0}'".format(k))
+        setattr(element, k, v)
+    err = [k for (k,v) in fields.items() if isinstance(v, metamodel.ParentField) and not v.optional and getattr(element, k) is None]
+    if err:
+        raise AttributeError("No parents specified for association(s) {0}".format(err))
+    return element
+
+
+def fields(args):
+    """Compares accessing fields and constructing elements to the generic
+    implementations that were used before the element classes were frozen.
+    Each measurement is the best of 5 runs, alternating between both."""
+    net = metamodel.load("petrinets.m2")
+    M = net.elements
+    place = net.instance().load("petrinet.m1").identifiers["p6"]
+    reference = DispatchElement(place)
+    n = args.elements
+    for field in ("tokens", "capacity", "of", "totransitions"):
+        expr = "e.{0}".format(field)
+        old = min(timeit.repeat(expr, globals=dict(e=reference), number=n, repeat=5))
+        new = min(timeit.repeat(expr, globals=dict(e=place), number=n, repeat=5))
+        report("fields", "access {0} dispatch".format(field), n, old, 0)
+        report("fields", "access {0}".format(field), n, new, 0, speedup=old/new)
+    
+    root = M["Petrinet"](name="net")
+    source = M["Place"](of=root)
+    dest = M["Transition"](of=root)
+    D = metamodel.load("declare.m2").elements
+    diagram = D["DeclareDiagram"]()
+    activity = D["Activity"](of=diagram, name="a")
+    n = max(1, args.elements // 10)
+    for (cls, kwargs) in (
+            (M["Place"], dict(of=root, name="p", tokens=0)),
+            (M["InputArc"], dict(source=source, dest=dest, weight=1)),
+            (D["Activity"], dict(of=diagram, name="b", existence=1)),
+            (D["Response"], dict(left=activity, right=activity))):
+        old = new = float("inf")
+        for i in range(5):
+            old = min(old, timeit.timeit(lambda: dispatchconstruct(cls, **kwargs), number=n))
+            new = min(new, timeit.timeit(lambda: cls(**kwargs), number=n))
+        report("fields", "construct {0} dispatch".format(cls.__name__), n, old, 0)
+        report("fields", "construct {0}".format(cls.__name__), n, new, 0, speedup=old/new)
+
+
+def load(args):
+    """Compares loading an instance by executing it to reading it, with
+    and without deferred validation."""
+    net = metamodel.load("petrinets.m2")
+    (fd, filename) = tempfile.mkstemp(suffix=".m1")
+    try:
+        with os.fdopen(fd, "w") as f:
+            writepetrinet(f, args.elements)
+        for method in (metamodel.ModelInstance.load, metamodel.ModelInstance.bulkload):
+            for validate in (True, False):
+                (n, duration, peak) = measure(lambda: count(method(net.instance(), filename, validate)))
+                report("load", method.__name__ + ("" if validate else " deferred"), n, duration, peak)
+    finally:
+        os.remove(filename)
+
+
+def binary(args):
+    """Compares loading an instance from a text file to loading a binary snapshot."""
+    net = metamodel.load("petrinets.m2")
+    (fd, filename) = tempfile.mkstemp(suffix=".m1")
+    (fd2, binfilename) = tempfile.mkstemp(suffix=".bin")
+    os.close(fd2)
+    try:
+        with os.fdopen(fd, "w") as f:
+            writepetrinet(f, args.elements)
+        # Create the snapshot in a separate process, to not affect the measurements.
+        measure(lambda: net.instance().bulkload(filename).save_binary(binfilename))
+        for (method, path) in ((metamodel.ModelInstance.load, filename), 
+                               (metamodel.ModelInstance.bulkload, filename),
+                               (metamodel.ModelInstance.load_binary, binfilename)):
+            (n, duration, peak) = measure(lambda: count(method(net.instance(), path)))
+            report("binary", method.__name__, n, duration, peak, file_bytes=os.path.getsize(path))
+        # Loading lazily only creates the elements that are used, here the neighbourhood of one place.
+        (n, duration, peak) = measure(lambda: neighbourhood(net.instance().load_binary(binfilename, lazy=True)))
+        report("binary", "load_binary lazy", n, duration, peak, file_bytes=os.path.getsize(binfilename))
+    finally:
+        os.remove(filename)
+        os.remove(binfilename)
+
+
+def simulation(args):
+    """Measures compiling a petrinet for simulation, with a token in every
+    other place, and firing as many transitions as it has elements."""
+    net = metamodel.load("petrinets.m2")
+    def create():
+        instance = bulkpetrinet(net, args.elements)
+        for place in list(instance.root().places)[::2]:
+            place.tokens = 1
+        return instance
+    def compile():
+        return petrinetsimulation.Simulation(create().root())
+    (n, duration, peak) = measure(lambda instance: petrinetsimulation.Simulation(instance.root()) and count(instance), setup=create)
+    report("simulation", "compile", n, duration, peak)
+    for (name, rng) in (("run", None), ("run random", 1)):
+        (n, duration, peak) = measure(lambda simulation: simulation.run(args.elements, rng), setup=compile)
+        report("simulation", name, n, duration, peak, firings_per_second=n/duration if duration else None)
+
+
+def reachability(args):
+    """Measures exploring the markings of a ring of 16 places, with enough
+    tokens to have at least as many markings as elements, in memory, with 
+    the states on disk and with 2 worker processes."""
+    net = metamodel.load("petrinets.m2")
+    M = net.elements
+    tokens = 1
+    while math.comb(15 + tokens, tokens) < args.elements:
+        tokens += 1
+    def create():
+        with net.instance():
+            root = M["Petrinet"]()
+            ring = [M["Place"](of=root, tokens=1 if i < tokens else 0) for i in range(16)]
+            for i in range(16):
+                t = M["Transition"](of=root)
+                M["InputArc"](source=ring[i], dest=t)
+                M["OutputArc"](source=t, dest=ring[(i+1) % 16])
+        return root
+    for (name, kwargs) in (("memory", dict()), ("disk", dict(memory=10**7)), ("processes 2", dict(processes=2))):
+        (n, duration, peak) = measure(lambda root: petrinetreachability.StateSpace(root, **kwargs).explore()["states"], setup=create)
+        report("reachability", name, n, duration, peak, states_per_second=n/duration if duration else None)
+
+
+def composition(args):
+    """Measures flattening a composition 10 levels deep, alternating Sync
+    and Async, that composes 1024 rings of places and transitions. Each
+    ring has an interface place and transition with a name shared by all
+    rings, which are fused, and ones with a name of their own."""
+    composed = metamodel.load("composedpetrinets.m2")
+    M = composed.elements
+    segments = max(1, args.elements // 1024 // 4)
+    def ring(parent, i):
+        root = M["Petrinet"](of=parent, name="net{0}".format(i))
+        places = [M["InterfacePlace"](of=root, name="shared", tokens=1)]
+        places += [M["InterfacePlace"](of=root, name="p{0}".format(i), tokens=0)][:segments-1]
+        places += [M["Place"](of=root, tokens=0) for j in range(len(places), segments)]
+        transitions = [M["InterfaceTransition"](of=root, name="shared")]
+        transitions += [M["InterfaceTransition"](of=root, name="t{0}".format(i))][:segments-1]
+        transitions += [M["Transition"](of=root) for j in range(len(transitions), segments)]
+        for j in range(segments):
+            M["InputArc"](source=places[j], dest=transitions[j])
+            M["OutputArc"](source=transitions[j], dest=places[(j+1) % segments])
+    def compose(parent, depth, leaves):
+        if depth == 0:
+            ring(parent, leaves)
+            return parent
+        composition = M["Sync" if depth % 2 else "Async"]()
+        if parent is not None:
+            composition.of = parent
+        compose(composition, depth - 1, 2*leaves)
+        compose(composition, depth - 1, 2*leaves + 1)
+        return composition
+    def create():
+        instance = composed.instance()
+        with instance:
+            instance.identifiers["root"] = compose(None, 10, 0)
+        return instance
+    (n, duration, peak) = measure(lambda instance: composedpetrinet2petrinet.flatten(instance) and size(instance), setup=create)
+    report("composition", "flatten", n, duration, peak)
+
+
+def query(args):
+    """Compares a path expression to the equivalent loop over the child 
+    lists and compares finding a place by name with and without an index."""
+    net = metamodel.load("petrinets.m2")
+    def create():
+        # Add the elements to the extents, which bulkpetrinet does not do.
+        instance = bulkpetrinet(net, args.elements)
+        root = instance.root()
+        instance.add_all([root])
+        for elements in (root.places, root.transitions):
+            instance.add_all(list(elements))
+        instance.add_all([arc for place in root.places for arc in place.totransitions])
+        instance.add_all([arc for place in root.places for arc in place.fromtransitions])
+        return instance
+    def loop(instance):
+        return sum(1 for root in instance.all_of(net.elements["Petrinet"]) for place in root.places 
+            if place.tokens is not None and place.tokens < 1 for arc in place.totransitions if arc.dest)
+    expression = "Petrinet.places[tokens<1].totransitions.dest"
+    for (name, f) in (("loop", loop), ("query", lambda instance: sum(1 for t in instance.query(expression)))):
+        (n, duration, peak) = measure(lambda instance: f(instance) and size(instance), setup=create)
+        report("query", name, n, duration, peak)
+    for name in ("scan", "index"):
+        if name == "index":
+            net.index(net.elements["Place"], "name")
+        (n, duration, peak) = measure(lambda instance: list(instance.query("Place[name='p0']")) and size(instance), setup=create)
+        report("query", name, n, duration, peak)
+
+
+def declare(args):
+    """Measures checking a log with as many events as elements against
+    declare.m1, in one process and with 2 worker processes. The traces
+    contain 10 random activities of the model, starting with its initial
+    activity."""
+    model = metamodel.load("declare.m2")
+    diagram = model.instance().load("declare.m1").root()
+    names = [activity.name for activity in diagram.activities]
+    (fd, filename) = tempfile.mkstemp(suffix=".csv")
+    try:
+        rng = random.Random(1)
+        with os.fdopen(fd, "w") as f:
+            f.write("case,activity\n")
+            for i in range(max(1, args.elements // 10)):
+                f.write("{0},examine patient\n".format(i))
+                for name in rng.choices(names, k=9):
+                    f.write("{0},{1}\n".format(i, name))
+        for processes in (1, 2):
+            (n, duration, peak) = measure(lambda: declarechecker.Checker(diagram).run(filename, processes=processes)["events"])
+            report("declare", "processes {0}".format(processes), n, duration, peak, events_per_second=n/duration if duration else None)
+    finally:
+        os.remove(filename)
+
+
+def metaload(args):
+    """Compares loading the meta models with and without the cache."""
+    directory = tempfile.mkdtemp()
+    saved = metamodel.cache
+    try:
+        for (name, cache) in (("uncached", None), ("cached", metamodel.MetaModelCache(directory))):
+            metamodel.cache = cache
+            for filename in ("petrinets.m2", "declare.m2", "mof.m3"):
+                metamodel.load(filename)
+                start = time.time()
+                for i in range(100):
+                    metamodel.load(filename)
+                duration = (time.time() - start) / 100
+                report("metaload", "{0} {1}".format(name, filename), len(metamodel.load(filename).elements), duration, 0)
+    finally:
+        metamodel.cache = saved
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def instances(args):
+    """Measures loading, reading, printing and saving generated instances of
+    each meta model, and running the shipped transformations on them."""
+    for (modelname, (modelfile, write, scripts)) in sorted(models.items()):
+        model = metamodel.load(modelfile)
+        (fd, filename) = tempfile.mkstemp(suffix=".m1")
+        (fd2, savefilename) = tempfile.mkstemp(suffix=".m1")
+        os.close(fd2)
+        try:
+            with os.fdopen(fd, "w") as f:
+                write(f, args.elements)
+            load = lambda: model.instance().load(filename)
+            for (name, f, setup) in (
+                    ("load", lambda: size(load()), None),
+                    ("bulkload", lambda: size(model.instance().bulkload(filename)), None),
+                    ("repr", lambda instance: len(repr(instance)) and size(instance), load),
+                    ("save", lambda instance: instance.save(savefilename) or size(instance), load)):
+                (n, duration, peak) = measure(f, setup=setup)
+                report("instances", "{0} {1}".format(modelname, name), n, duration, peak, model=modelname)
+            n = measure(lambda: size(load()))[0]
+            for script in scripts:
+                (duration, peak) = run(script, filename)
+                report("instances", "{0} {1}".format(modelname, script), n, duration, peak, model=modelname)
+        finally:
+            os.remove(filename)
+            os.remove(savefilename)
+
+
+benchmarks = dict(
+    binary=binary,
+    bulk=bulk,
+    composition=composition,
+    declare=declare,
+    fields=fields,
+    instances=instances,
+    load=load,
+    memory=memory,
+    metaload=metaload,
+    query=query,
+    reachability=reachability,
+    simulation=simulation,
+)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the metamodel module.")
+    parser.add_argument("benchmark", nargs="*", help="benchmarks to run: {0} (default: all)".format(", ".join(sorted(benchmarks))))
+    parser.add_argument("--elements", type=int, nargs="+", default=[1000000], help="sizes of the generated instances")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE ('-' for standard output)")
+    args = parser.parse_args()
+    # Do not measure or fill the on-disk cache of the meta models, except
+    # in the metaload benchmark, which uses a temporary one.
+    metamodel.cache = None
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error("unknown benchmark '{0}'".format(name))
+    if args.json == "-":
+        log = sys.stderr
+    sizes = args.elements
+    for args.elements in sizes:
+        for name in args.benchmark or sorted(benchmarks):
+            benchmarks[name](args)
+    if args.json:
+        output = dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            sizes=sizes,
+            results=results,
+        )
+        if args.json == "-":
+            json.dump(output, sys.stdout, indent=1)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(output, f, indent=1)
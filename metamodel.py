@@ -15,13 +15,41 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
+import array
+import ast
+import bisect
+import contextvars
+import gc
+import gzip
+import hashlib
+import importlib
+import io
+import json
 import keyword
+import mmap
+import multiprocessing
+import operator
+import os
+import re
+import struct
 import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, Set
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from operator import attrgetter
 from weakref import WeakKeyDictionary
 
 
 class FieldDescriptor(object):
-    """Describes a field of an Element. This is an abstract class."""
+    """Describes a field of an Element. This is an abstract class.
+    
+    Field descriptors are also installed on the Element classes as data
+    descriptors, such that reading and writing a field does not need to
+    go through a generic dispatch. The values are stored in the element's
+    '_values' dictionary."""
     
     def __init__(self, name):
         """Creates a descriptor."""
@@ -30,6 +58,16 @@ class FieldDescriptor(object):
     def describe(self, name):
         """Used for creating a human readable description of a field."""
         return "<unknown> {1}".format(self.name)
+    
+    def __get__(self, element, elementtype=None):
+        """Returns the value of the field, or None if it is not set."""
+        if element is None:
+            return self
+        return element._values.get(self.name)
+    
+    def __set__(self, element, value):
+        """Assigns a value to the field."""
+        element._values[self.name] = value
 
 
 class AttributeField(FieldDescriptor):
@@ -37,9 +75,78 @@ class AttributeField(FieldDescriptor):
     
     def __init__(self, name):
         FieldDescriptor.__init__(self, name)
+        # Whether ModelInstances keep an index of the values of this attribute.
+        self.indexed = False
         
     def describe(self):
-        return "<attribute> {0}".format(self.name)
+        return "<attribute> {0}{1}".format(self.name, " (indexed)" if self.indexed else "")
+
+
+class ChildList(Set):
+    """Contains the children of an element in a child-list field, in the
+    order in which they were added. Small child-lists store the children 
+    in a list, larger ones in a dictionary, such that adding, removing and
+    testing membership take constant time. It supports the operations of
+    (immutable) sets, as well as 'add' and 'discard'."""
+    
+    __slots__ = ("items",)
+    
+    # The number of children above which they are stored in a dictionary.
+    threshold = 8
+    
+    def __init__(self, children=()):
+        self.items = []
+        for child in children:
+            self.add(child)
+    
+    def add(self, child):
+        """Adds 'child' at the end, unless it is already present."""
+        items = self.items
+        if type(items) is list:
+            if child not in items:
+                items.append(child)
+                if len(items) > self.threshold:
+                    self.items = dict.fromkeys(items)
+        else:
+            items[child] = None
+    
+    def extend(self, children):
+        """Adds the 'children' that are not yet present at the end."""
+        items = self.items
+        if type(items) is list and len(items) + len(children) <= self.threshold:
+            for child in children:
+                if child not in items:
+                    items.append(child)
+        else:
+            if type(items) is list:
+                self.items = items = dict.fromkeys(items)
+            items.update(dict.fromkeys(children))
+    
+    def discard(self, child):
+        """Removes 'child', if it is present."""
+        items = self.items
+        if type(items) is list:
+            if child in items:
+                items.remove(child)
+        else:
+            items.pop(child, None)
+    
+    def __contains__(self, child):
+        return child in self.items
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __repr__(self):
+        return "ChildList({0})".format(list(self.items))
+    
+    @classmethod
+    def _from_iterable(cls, children):
+        """Used by the set operations for creating their result."""
+        return ChildList(children)
 
 
 class ChildListField(FieldDescriptor):
@@ -57,10 +164,33 @@ class ChildListField(FieldDescriptor):
         self.parentname = parentname
         self.elementtype = elementtype
         self.limit = limit
+        # The object installed on the element class that manages the 
+        # childlist. This is replaced when compact storage is used.
+        self.accessor = self
         
     def describe(self):
         return "{0}[{2}] {1}".format(self.elementtype.__name__, self.name, self.limit if self.limit!=None else "")
 
+    def __get__(self, element, elementtype=None):
+        """Returns the child-list. If it is not yet set, it is 
+        initialized with an empty ChildList. This ChildList can (but 
+        usually should not) be modified."""
+        if element is None:
+            return self
+        values = element._values
+        r = values.get(self.name)
+        if r is None:
+            values[self.name] = r = ChildList()
+        return r
+
+    def __set__(self, element, value):
+        """Child-lists can not be set."""
+        raise AttributeError("Setting value of childlist '{0}'".format(self.name))
+
+    def children(self, element):
+        """Returns the childlist, such that it can be modified."""
+        return self.__get__(element)
+
 
 class ParentField(FieldDescriptor):
     """Describes a reference to a parent object."""
@@ -76,15 +206,219 @@ class ParentField(FieldDescriptor):
         self.childname = childname
         self.elementtype = elementtype
         self.optional = optional
+        # The ChildListField counterpart, set when the association is created.
+        self.childfield = None
 
     def describe(self):
         return "{0} {1}{2}".format(self.elementtype.__name__, self.name, " (optional)" if self.optional else "")
 
+    def __set__(self, element, value):
+        """Sets the parent."""
+        values = element._values
+        self.link(element, values.get(self.name), value)
+        values[self.name] = value
+
+    def link(self, element, oldvalue, value):
+        """Does type checking and moves 'element' from the childlist 
+        of the old parent to the childlist of the new parent."""
+        
+        # Check that value is of the right type and raise a meaningful error otherwise.
+        if not isinstance(value, self.elementtype):
+            raise AttributeError("Setting '{0}' to value {1}, which is not an {2}".format(
+                self.name, value, self.elementtype.__name__))
+        
+        # Ignore the assignment if it does not change the value
+        if oldvalue is value:
+            return
+        
+        # Get a reference to the parent's childlist.
+        childfield = self.childfield
+        childlist = childfield.accessor.children(value)
+        
+        # Check whether the parent still has room for another child.
+        if childfield.limit!=None:
+            self.check_limit(childlist)
+        
+        # Remove the element from the childlist of the old parent
+        if oldvalue is not None:
+            childfield.accessor.children(oldvalue).discard(element)
+        
+        # (and) insert it into the new one.
+        childlist.add(element)
+    
+    def check_limit(self, childlist):
+        """Raises a KeyError if 'childlist', of the new parent, has no room
+        for another child."""
+        childfield = self.childfield
+        if len(childlist)>=childfield.limit:
+            raise KeyError("Setting {0} causes {1} to exceed its limit".format(self.describe(), childfield.describe()))
+
+
+class EmptyChildList(ChildList):
+    """An empty ChildList that can not be modified. A single one is shared 
+    by the empty child-lists of elements with compact storage, such that 
+    reading them does not create a ChildList for each element."""
+    
+    __slots__ = ()
+    
+    def add(self, child):
+        raise TypeError("Adding to an empty child-list of compact storage; set the parent of the child instead")
+    
+    def extend(self, children):
+        self.add(None)
+    
+    def discard(self, child):
+        pass
+
+
+# Returned when reading an empty childlist of an element with compact storage.
+emptychildlist = EmptyChildList()
+
+class CompactParentField(object):
+    """Manages a ParentField of an element class with compact storage.
+    The value is stored in a slot, of which 'slot' is the member descriptor."""
+    
+    __slots__ = ("field", "slot")
+    
+    def __init__(self, field, slot):
+        self.field = field
+        self.slot = slot
+    
+    def __get__(self, element, elementtype=None):
+        if element is None:
+            return self.field
+        return self.slot.__get__(element, elementtype)
+
+    def __set__(self, element, value):
+        self.field.link(element, self.__get__(element), value)
+        self.slot.__set__(element, value)
+
+
+class CompactChildListField(object):
+    """Manages a ChildListField of an element class with compact storage.
+    The set of children is stored in a slot, of which 'slot' is the member
+    descriptor. The set is not created until the first child is added."""
+    
+    __slots__ = ("field", "slot")
+    
+    def __init__(self, field, slot):
+        self.field = field
+        self.slot = slot
+    
+    def __get__(self, element, elementtype=None):
+        if element is None:
+            return self.field
+        r = self.slot.__get__(element, elementtype)
+        return emptychildlist if r is None else r
+    
+    def __set__(self, element, value):
+        self.field.__set__(element, value)
+    
+    def children(self, element):
+        """Returns the childlist, such that it can be modified."""
+        r = self.slot.__get__(element)
+        if r is None:
+            r = ChildList()
+            self.slot.__set__(element, r)
+        return r
+
+
+class AttributeIndexer(object):
+    """Manages an indexed attribute. Setting the attribute also updates 
+    the index of the ModelInstance the element belongs to. The value is 
+    stored using 'accessor', which is the descriptor that was installed 
+    before the attribute became indexed."""
+    
+    __slots__ = ("field", "accessor")
+    
+    def __init__(self, field, accessor):
+        self.field = field
+        self.accessor = accessor
+    
+    def __get__(self, element, elementtype=None):
+        if element is None:
+            return self.field
+        return self.accessor.__get__(element, elementtype)
+    
+    def __set__(self, element, value):
+        oldvalue = self.accessor.__get__(element)
+        self.accessor.__set__(element, value)
+        if element._instance is not None:
+            element._instance.reindex(element, self.field, oldvalue, value)
+
+
+class FieldTracker(object):
+    """Manages a field of an element class of a tracked MetaModel. While a
+    tracking TransformationContext applies a rule, reading the field is 
+    recorded. Changing the field is recorded by the ModelInstance the 
+    element belongs to. For parents, the change of the child-lists of the
+    old and new parent is recorded as well. The value is stored using 
+    'accessor', which is the descriptor that was installed before the 
+    model was tracked."""
+    
+    __slots__ = ("field", "accessor")
+    
+    def __init__(self, field, accessor):
+        self.field = field
+        self.accessor = accessor
+    
+    def __get__(self, element, elementtype=None):
+        if element is None:
+            return self.field
+        reads = watching.reads
+        if reads is not None:
+            reads.append((element, self.field.name))
+        return self.accessor.__get__(element, elementtype)
+    
+    def __set__(self, element, value):
+        field = self.field
+        oldvalue = self.accessor.__get__(element)
+        self.accessor.__set__(element, value)
+        if oldvalue is value:
+            return
+        if element._instance is not None:
+            element._instance.changed(element, field.name)
+        if isinstance(field, ParentField):
+            for parent in (oldvalue, value):
+                if parent is not None and parent._instance is not None:
+                    parent._instance.changed(parent, field.childname)
+
+
+# Assigns a field of an element, bypassing AbstractElement.__setattr__.
+setfield = object.__setattr__
 
 class AbstractElement(object):
     """The abstract base class used by elements. 
     subclasses need to define self.fields, as a
-    dictionary mapping field name to FieldDescriptor."""
+    dictionary mapping field name to FieldDescriptor.
+    The fields themselves are accessed through the
+    FieldDescriptors, which are installed on the subclass."""
+    
+    __slots__ = ("__weakref__", "_instance")
+    
+    # Set to True for element classes that store their fields in slots.
+    _compact = False
+    
+    # The AttributeFields of which the ModelInstances keep an index.
+    _indexed = ()
+    
+    # Set to True for element classes of which the changes are recorded.
+    _tracked = False
+    
+    # The member descriptors of the slots, when compact storage is used.
+    _slots = ()
+    
+    # The plan used for constructing elements, which is made when the 
+    # MetaModel is frozen: the fields of each kind, the names of the 
+    # parents that must be specified and a dictionary mapping the names of
+    # the attributes and parents to a (ParentField, slot) pair, where the
+    # ParentField is None for attributes and the slot is the member 
+    # descriptor of the field when compact storage is used and None otherwise.
+    _attributes = ()
+    _parents = ()
+    _children = ()
+    _required = ()
+    _plan = dict()
     
     def __init__(self, **kwargs):
         """Creates an instance of the element."""
@@ -92,115 +426,186 @@ class AbstractElement(object):
         if self._abstract:
             raise RuntimeError("Can't instantiate abstract class {0}".format(self.__class__.__name__))
         
-        # Create a dictionary for storing the values of the fields.
-        self._values = dict()
-
-        # Assign the values specified in the constructor.
-        for (k,v) in kwargs.items():
-            setattr(self,k,v)
+        # The ModelInstance this element belongs to.
+        setinstance(self, None)
+        
+        # Create a dictionary for storing the values of the fields. 
+        # With compact storage, the slots are initialized to None instead.
+        if self._compact:
+            for slot in self._slots:
+                slot.__set__(self, None)
+        else:
+            values = dict()
+            setfield(self, "_values", values)
+        
+        if self._tracked:
+            # Assign the values specified in the constructor through their 
+            # fields, such that the changes are recorded.
+            for (k,v) in kwargs.items():
+                if k not in self._fields:
+                    raise AttributeError("Unknown Attribute '{0}'".format(k))
+                setattr(self,k,v)
+        else:
+            # Store the values specified in the constructor directly, 
+            # after adding the element to the child-lists of its parents.
+            plan = self._plan
+            for (k,v) in kwargs.items():
+                try:
+                    (parent, slot) = plan[k]
+                except KeyError:
+                    if k in self._fields:
+                        raise AttributeError("Setting value of childlist '{0}'".format(k))
+                    raise AttributeError("Unknown Attribute '{0}'".format(k))
+                if parent is not None:
+                    parent.link(self, None, v)
+                if slot is None:
+                    values[k] = v
+                else:
+                    slot.__set__(self, v)
             
-        # Verify that all PARENT type attributes are set.
+        # Verify that all PARENT type attributes are set. Parents can not be
+        # set to None, so this holds for those specified in the constructor.
+        err = [k for k in self._required if k not in kwargs]
+        if err:
+            raise AttributeError("No parents specified for association(s) {0}".format(err))
+        
+        # Add the element to the instance that is being built.
+        instances = building.instances
+        if instances:
+            instances[-1].add(self)
+
+    @classmethod
+    def bulk(cls, **columns):
+        """Creates elements in bulk and returns them as a list. Each keyword
+        argument is a column containing the values of a field, one for each
+        element. For example, 'Place.bulk(of=[net, net], tokens=[1, 2])'
+        creates two places. A None in the column of an optional parent leaves
+        that parent unset. The parents are type checked and the limits of
+        their child-lists are checked once per column, before any element
+        is created. The elements are created without calling __init__."""
+
+        if cls._abstract:
+            raise RuntimeError("Can't instantiate abstract class {0}".format(cls.__name__))
+
+        # Check the columns.
+        fields = cls._fields
+        n = None
+        for (k, column) in columns.items():
+            field = fields.get(k)
+            if field is None:
+                raise AttributeError("Unknown Attribute '{0}'".format(k))
+            if isinstance(field, ChildListField):
+                raise AttributeError("Setting value of childlist '{0}'".format(k))
+            if n is None:
+                n = len(column)
+            elif len(column) != n:
+                raise ValueError("Column '{0}' has {1} values instead of {2}".format(k, len(column), n))
+        if not n:
+            return []
+
+        # Check the types of the parents and whether they are all set.
         err = None
-        for (k,v) in self._fields.items():
-            if isinstance(v, ParentField) and not v.optional and k not in self._values:
-                if err == None:
-                    err = []
-                err.append(k)
-        # Raise an error if not.
+        for field in cls._parents:
+            column = columns.get(field.name)
+            types = set() if column is None else set(map(type, column))
+            if column is None or type(None) in types:
+                if not field.optional:
+                    if err == None:
+                        err = []
+                    err.append(field.name)
+                types.discard(type(None))
+            for t in types:
+                if not issubclass(t, field.elementtype):
+                    value = next(v for v in column if type(v) is t)
+                    raise AttributeError("Setting '{0}' to value {1}, which is not an {2}".format(
+                        field.name, value, field.elementtype.__name__))
         if err != None:
             raise AttributeError("No parents specified for association(s) {0}".format(err))
-                
-        
-    def __getattr__(self, name):
-        """Returns the requested field of the element.
-        If the requested field is a child-list and is not
-        yet set, it is initialized with an empty set.
-        This set can (but usually should not) be modified."""
 
-        # If name start with an underscore, it is an internal attribute
-        if name[0]=="_":
-            return self.__dict__[name]
+        # Check whether the parents have room for their new children.
+        parents = [field for field in cls._parents if field.name in columns]
+        for field in parents:
+            childfield = field.childfield
+            if childfield.limit is None:
+                continue
+            counts = dict()
+            for parent in columns[field.name]:
+                counts[parent] = counts.get(parent, 0) + 1
+            counts.pop(None, None)
+            for (parent, count) in counts.items():
+                if len(childfield.accessor.children(parent)) + count > childfield.limit:
+                    raise KeyError("Setting {0} causes {1} to exceed its limit".format(field.describe(), childfield.describe()))
 
-        # is the value set?, return it.
-        if name in self._values:
-            return self._values[name]
-            
-        # if not, check whether it actually is a valid field name.
-        if name not in self._fields:
-            raise AttributeError("Unknown Attribute '{0}'".format(name))
-        
-        # If it is a child-list, we need to initialize it first, 
-        # as the return value might be modified.
-        if isinstance(self._fields[name], ChildListField):
-            self._values[name] = r = set()
-            return r
-        
-        # Return the default value.
-        return None
-        
-    def __setattr__(self, name, value):
-        """Assigns value to the field name. 
-        Except when the field is a child-list, because
-        it can not be set."""
-        
-        # If name start with an underscore, it is an internal attribute
-        if name[0]=="_":
-            self.__dict__[name]=value
-            return
-        
-        # Verify that name denotes a valid field name
-        if name not in self._fields:
-            raise AttributeError("Unknown Attribute '{0}'".format(name))
-        
-        # Verify that the field is not a childlist
-        if isinstance(self._fields[name], ChildListField):
-            raise AttributeError("Setting value of childlist '{0}'".format(name))
-        
-        # If a parent field is set, also update the parent's childlist and
-        # do type checking.
-        field = self._fields[name]
-        if isinstance(field, ParentField):
-            # Check that value is of the right type and raise a meaningful error otherwise.
-            if not isinstance(value, field.elementtype):
-                raise AttributeError("Setting '{0}' to value {1}, which is not an {2}".format(
-                    name, value, field.elementtype.__name__))
+        # Create the elements and store the values directly, one column at 
+        # a time, using the member descriptors of their slots. The garbage
+        # collector is paused, as the many new objects would trigger it.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            elements = list(map(cls.__new__, repeat(cls, n)))
+            deque(map(AbstractElement._instance.__set__, elements, repeat(None)), 0)
+            if cls._compact:
+                for slot in cls._slots:
+                    column = columns.get(slot.__name__)
+                    deque(map(slot.__set__, elements, repeat(None) if column is None else column), 0)
+            else:
+                rows = map(dict, map(zip, repeat(tuple(columns)), zip(*columns.values())))
+                deque(map(cls._values.__set__, elements, rows), 0)
 
-            # Get a reference to the parent's childlist.
-            childlist = getattr(value, field.childname)
-                
-            # Check of the field was already set
-            if name in self._values:
-                # Ignore the assignment if it does not change the value
-                if id(self._values[name]) == id(self):
-                    return
-
-                # Remove the old value
-                oldvalue = self._values[name]
-                if oldvalue in childlist:
-                    childlist.remove(oldvalue)
-            
-            # Check whether the parent still has room for another child.
-            otherfield = value._fields[field.childname]
-            if otherfield.limit!=None and len(childlist)>=otherfield.limit:
-                raise KeyError("Setting {0} causes {1} to exceed its limit".format(field.describe(), otherfield.describe()))
-            
-            # (and) insert the new one.
-            childlist.add(self)
-            
-        # Set the field to the new value.
-        self._values[name] = value
+            # Add the elements to the child-lists of their parents.
+            for field in parents:
+                children = field.childfield.accessor.children
+                groups = dict()
+                for (element, parent) in zip(elements, columns[field.name]):
+                    groups.setdefault(parent, []).append(element)
+                groups.pop(None, None)
+                for (parent, group) in groups.items():
+                    children(parent).extend(group)
+        finally:
+            if enabled:
+                gc.enable()
+
+        # Add the elements to the instance that is being built.
+        instances = building.instances
+        if instances:
+            instances[-1].add_all(elements)
+        return elements
+
+
+    def __getattr__(self, name):
+        """Only called for names that are not a field of this element, 
+        as fields are handled by their FieldDescriptor."""
+        raise AttributeError("Unknown Attribute '{0}'".format(name))
+    
+    def __setattr__(self, name, value):
+        """Assigns the field through its FieldDescriptor. Names that are 
+        neither a field nor defined by the class can not be assigned."""
+        try:
+            setfield(self, name, value)
+        except AttributeError:
+            if name in self._fields or hasattr(type(self), name):
+                raise
+            raise AttributeError("Unknown Attribute '{0}'".format(name)) from None
     
     def __dir__(self):
         """Returns the field names specified by this Element."""
         return self._fields.keys()
        
        
+# Sets the ModelInstance an element belongs to.
+setinstance = AbstractElement._instance.__set__
+
+
 class MetaModel:
     """The MetaModel class. Instances of this class describe 
     the structure of a model."""
     
-    def __init__(self, script):
-        """Creates an empty meta model."""
+    def __init__(self, script, compact=False, definitions=None):
+        """Creates an empty meta model. If 'compact' is True, the elements 
+        store their fields in slots instead of a dictionary, which uses
+        far less memory for large instances. If 'definitions' is given,
+        the script is not executed and the model is recreated from the
+        definitions of another model instead, see 'save_definitions'."""
         
         # Create a dictionary for the different types of elements.
         self.elements=dict()
@@ -208,6 +613,18 @@ class MetaModel:
         # Create a dictionary in which the identifiers are stored that are used in the model description.
         self.identifiers=dict()
         
+        # Create a list in which the calls to Element, Attribute and Association are recorded.
+        self.definitions=[]
+        
+        # Whether the changes to the elements are recorded, see 'track'.
+        self.tracking=False
+        
+        # Whether fields can no longer be added, see '__freeze'.
+        self.frozen=False
+        
+        # The compiled path expressions, see 'query'.
+        self.queries=dict()
+        
         # Create the meta-model creation environment.
         modelapi=dict(
             MetaModel=self.metamodel,
@@ -217,7 +634,17 @@ class MetaModel:
         )
         
         # Load the meta-model
-        exec(script, modelapi, self.identifiers)
+        if definitions is None:
+            exec(script, modelapi, self.identifiers)
+        else:
+            self.__replay(definitions)
+        
+        # Now that the fields are known, switch to compact storage if requested.
+        if compact:
+            self.__compact()
+        
+        # Fields can no longer be added, see '__freeze'.
+        self.__freeze()
 
     def metamodel(self):
         """Returns self. Used during the load process."""
@@ -242,18 +669,24 @@ class MetaModel:
             fields = dict()
             
         # Create the Element as a subclass of extends.
-        self.elements[name]=r=type(name, (extends,), dict(_fields=fields, _subclasses=set(), _abstract=abstract))
+        # The __slots__ prevent the creation of a per-instance __dict__, such
+        # that assigning to an unknown field raises an error, see __setattr__.
+        slots = ("_values",) if extends==AbstractElement else ()
+        self.elements[name]=r=type(name, (extends,), dict(__slots__=slots, _fields=fields, _subclasses=set(), _abstract=abstract))
         
         # Add the new element to the list of subclasses of its superclass.
         # This allows the superclass to get more fields and add these to this class as well.
         if extends!=AbstractElement:
             extends._subclasses.add(r)
         
+        self.definitions.append(("element", name, None if extends==AbstractElement else extends.__name__, abstract))
+        
         # Return the new Element
         return r
         
-    def attribute(self, of, name):
-        """Adds an Attribute to an Element."""
+    def attribute(self, of, name, indexed=False):
+        """Adds an Attribute to an Element. If 'indexed' is True, the 
+        instances keep an index of its values, see 'index'."""
 
         # Disallow starting with an underscore.
         if name[0]=="_":
@@ -261,7 +694,44 @@ class MetaModel:
 
         # (Attempt to) add the field.
         self.addfield(of, AttributeField(name=name))
+        if indexed:
+            self.index(of, name)
+        self.definitions.append(("attribute", of.__name__, name, indexed))
+    
+    def index(self, element, name):
+        """Makes the instances of this model keep an index of the values of
+        the attribute 'name' of 'element', which is used by ModelInstance.find.
+        The index is updated whenever the attribute is set."""
+        
+        field = element._fields.get(name)
+        if not isinstance(field, AttributeField):
+            raise AttributeError("Only attributes can be indexed: {0}".format(name))
+        if field.indexed:
+            return
+        field.indexed = True
+        
+        # Wrap the installed descriptors, such that the index is updated.
+        for e in self.elements.values():
+            if e._fields.get(name) is field:
+                e._indexed = tuple(k for k in e._fields.values() if isinstance(k, AttributeField) and k.indexed)
+                if name in e.__dict__:
+                    setattr(e, name, AttributeIndexer(field, e.__dict__[name]))
         
+    def track(self):
+        """Makes the instances of this model record which elements were 
+        created and which fields were changed, see ModelInstance.changes,
+        and makes tracking TransformationContexts record which fields are
+        read by each application of a rule. This slows down accessing the
+        fields."""
+        if self.tracking:
+            return
+        self.tracking = True
+        for e in self.elements.values():
+            e._tracked = True
+            for (name, field) in e._fields.items():
+                if name in e.__dict__:
+                    setattr(e, name, FieldTracker(field, e.__dict__[name]))
+    
     def association(self, parent, child, parentname, childname, limit=None, optional=False):
         """Creates a association between 'parent' and 'child'."""
 
@@ -284,13 +754,21 @@ class MetaModel:
             raise AttributeError("Limit '{2}' must be a positive integer: {0} -> {1}".format(childname, parentname, limit))
 
         # (Attempt to) add the fields.
-        self.addfield(child, ParentField(name=parentname, childname=childname, elementtype=parent, optional=optional))
-        self.addfield(parent, ChildListField(name=childname, parentname=parentname, elementtype=child, limit=limit))
+        parentfield = ParentField(name=parentname, childname=childname, elementtype=parent, optional=optional)
+        childfield = ChildListField(name=childname, parentname=parentname, elementtype=child, limit=limit)
+        parentfield.childfield = childfield
+        self.addfield(child, parentfield)
+        self.addfield(parent, childfield)
+        self.definitions.append(("association", parent.__name__, child.__name__, parentname, childname, limit, optional))
     
     def addfield(self, element, fielddescriptor):
         """Verifies that the field does not redefine an old one, 
         adds the field and asks subclasses to do the same."""
         
+        # The plans of frozen element classes would become invalid.
+        if self.frozen:
+            raise RuntimeError("Can't add field {0} to a loaded MetaModel".format(fielddescriptor.name))
+        
         # Verify that there are no fields with the same names.
         if fielddescriptor.name in element._fields:
             raise KeyError("Redefinition of field {0}".format(element._fields[fielddescriptor.name].describe()))
@@ -299,15 +777,120 @@ class MetaModel:
         if keyword.iskeyword(fielddescriptor.name):
             raise SyntaxError("Python keywords are not allowed: {0}".format(fielddescriptor.name))
 
-        # Add the field
+        # Add the field and install its descriptor on the element.
         element._fields[fielddescriptor.name] = fielddescriptor
+        setattr(element, fielddescriptor.name, fielddescriptor)
         
         if hasattr(element, "_subclasses"):
             for subclass in element._subclasses:
                 self.addfield(subclass, fielddescriptor)
     
+    def __compact(self):
+        """Recreates the element classes, such that each field is stored in 
+        a slot. This can only be done after all fields are known."""
+        
+        replaced = dict()
+        def rebuild(element):
+            if element in replaced:
+                return replaced[element]
+            base = element.__bases__[0]
+            if base!=AbstractElement:
+                base = rebuild(base)
+            
+            # Only the fields that are not inherited need a slot.
+            own = [k for k in element._fields if k not in getattr(base, "_fields", ())]
+            replaced[element]=r=type(element.__name__, (base,), dict(
+                __slots__=tuple(own), _fields=dict(element._fields), _subclasses=set(), 
+                _abstract=element._abstract, _compact=True, _indexed=element._indexed))
+            r._slots = base._slots + tuple(r.__dict__[k] for k in own)
+            if base!=AbstractElement:
+                base._subclasses.add(r)
+            
+            # Attributes are accessed directly through their slot, the other
+            # fields need to keep their childlists up to date.
+            for k in own:
+                field = r._fields[k]
+                if isinstance(field, ParentField):
+                    setattr(r, k, CompactParentField(field, r.__dict__[k]))
+                elif isinstance(field, ChildListField):
+                    field.accessor = CompactChildListField(field, r.__dict__[k])
+                    setattr(r, k, field.accessor)
+                elif field.indexed:
+                    setattr(r, k, AttributeIndexer(field, r.__dict__[k]))
+            return r
+        
+        for element in list(self.elements.values()):
+            rebuild(element)
+        
+        # Update the references to the old classes.
+        for element in replaced.values():
+            for field in element._fields.values():
+                if hasattr(field, "elementtype"):
+                    field.elementtype = replaced.get(field.elementtype, field.elementtype)
+        for (k,v) in self.elements.items():
+            self.elements[k] = replaced[v]
+        for (k,v) in self.identifiers.items():
+            if isinstance(v, type) and v in replaced:
+                self.identifiers[k] = replaced[v]
+    
+    def __freeze(self):
+        """Makes the plan used for constructing the elements of each element
+        class, see AbstractElement, after which no fields can be added."""
+        for element in self.elements.values():
+            fields = element._fields.values()
+            element._attributes = tuple(k for k in fields if isinstance(k, AttributeField))
+            element._parents = tuple(k for k in fields if isinstance(k, ParentField))
+            element._children = tuple(k for k in fields if isinstance(k, ChildListField))
+            element._required = tuple(k.name for k in element._parents if not k.optional)
+            slots = dict((slot.__name__, slot) for slot in element._slots)
+            element._plan = dict((k.name, (None, slots.get(k.name))) for k in element._attributes)
+            element._plan.update((k.name, (k, slots.get(k.name))) for k in element._parents)
+        self.frozen = True
+    
+    def save_definitions(self):
+        """Returns the definitions made by the script of this model and its
+        identifiers as a JSON compatible list, or None if the identifiers 
+        refer to values that can not be stored."""
+        identifiers = []
+        for (k,v) in self.identifiers.items():
+            if v is self:
+                identifiers.append((k, "model", None))
+            elif isinstance(v, type) and self.elements.get(v.__name__) is v:
+                identifiers.append((k, "element", v.__name__))
+            elif v is None or type(v) in (bool, int, float, str):
+                identifiers.append((k, "value", v))
+            else:
+                return None
+        return [self.definitions, identifiers]
+    
+    def __replay(self, definitions):
+        """Recreates a model from the output of 'save_definitions'."""
+        (calls, identifiers) = definitions
+        for call in calls:
+            if call[0]=="element":
+                self.element(self, call[1], self.elements[call[2]] if call[2] else AbstractElement, call[3])
+            elif call[0]=="attribute":
+                self.attribute(self.elements[call[1]], call[2], call[3])
+            elif call[0]=="association":
+                self.association(self.elements[call[1]], self.elements[call[2]], *call[3:])
+        for (k, kind, v) in identifiers:
+            if kind=="model":
+                self.identifiers[k] = self
+            elif kind=="element":
+                self.identifiers[k] = self.elements[v]
+            else:
+                self.identifiers[k] = v
+    
     def instance(self):
         return ModelInstance(self)
+    
+    def query(self, expression):
+        """Returns the Query compiled from 'expression', which is cached."""
+        try:
+            return self.queries[expression]
+        except KeyError:
+            plan = self.queries[expression] = Query(self, expression)
+            return plan
         
     def __str__(self):
         """Creates a human readable description of the model."""
@@ -319,12 +902,215 @@ class MetaModel:
             r.append("Element {0}{1}".format(k, fields))
         return "\n  ".join(r)
         
-def load(filename):
-    """Loads the MetaModel stored in 'filename'."""
-    with open(filename) as f:
-        script = compile(f.read(), filename, "exec")
-    return MetaModel(script)
+class MetaModelCache:
+    """An on-disk cache for the definitions of meta models, which is used by
+    'load'. The definitions are stored in 'directory', using the hash of the
+    content of the meta model file as key. When the total size of the cache
+    exceeds 'maxsize' bytes, the least recently used entries are removed.
+    Errors while accessing the cache are ignored."""
+    
+    # Changing this invalidates the existing cache entries.
+    version = b"metamodel cache 1\n"
+    
+    def __init__(self, directory, maxsize=4*1024*1024):
+        self.directory = directory
+        self.maxsize = maxsize
+    
+    def key(self, source):
+        """Returns the key for the contents of a meta model file."""
+        return hashlib.sha256(self.version + source).hexdigest()
+    
+    def get(self, key):
+        """Returns the definitions stored for 'key', or None."""
+        path = os.path.join(self.directory, key + ".json")
+        try:
+            with open(path) as f:
+                definitions = json.load(f)
+            # Mark the entry as recently used.
+            os.utime(path, None)
+            return definitions
+        except (OSError, ValueError):
+            return None
+    
+    def put(self, key, definitions):
+        """Stores the definitions for 'key' and evicts old entries if needed."""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, key + ".json")
+            temp = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(temp, "w") as f:
+                json.dump(definitions, f)
+            os.replace(temp, path)
+            
+            # Remove the least recently used entries, until the cache is small enough.
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            entries.sort()
+            total = sum(e[1] for e in entries)
+            for (mtime, size, name) in entries:
+                if total <= self.maxsize:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+        except OSError:
+            pass
+
+# The cache used by 'load', or None. It is only enabled when the
+# METAMODEL_CACHE environment variable gives its directory.
+cache = MetaModelCache(
+    os.environ["METAMODEL_CACHE"],
+    int(os.environ.get("METAMODEL_CACHE_SIZE", 4*1024*1024)),
+) if os.environ.get("METAMODEL_CACHE") else None
+
+def load(filename, compact=False):
+    """Loads the MetaModel stored in 'filename'. If the cache contains the
+    definitions of the file's content, the file is not executed."""
+    with open(filename, "rb") as f:
+        source = f.read()
+    if cache is not None:
+        key = cache.key(source)
+        definitions = cache.get(key)
+        if definitions is not None:
+            return MetaModel(None, compact, definitions)
+    script = compile(source, filename, "exec")
+    model = MetaModel(script, compact)
+    if cache is not None:
+        definitions = model.save_definitions()
+        if definitions is not None:
+            cache.put(key, definitions)
+    return model
+
+
+# Binary snapshots (see ModelInstance.save_binary) start with this header,
+# followed by a byte with the byte order of the machine that wrote it.
+binary_magic = b"MMBIN\x01"
+# The kinds of attribute columns in binary snapshots.
+(binary_none, binary_int, binary_str, binary_literal) = range(4)
+# The reprs of the floats that ast.literal_eval does not accept.
+binary_floats = {"inf": float("inf"), "-inf": float("-inf"), "nan": float("nan")}
+
+def decode_literal(v):
+    """Returns the value of the repr 'v' of a literal column."""
+    return binary_floats[v] if v in binary_floats else ast.literal_eval(v)
 
+class BinaryColumn:
+    """An attribute column of a binary snapshot. The 'mask' contains a 
+    nonzero byte for each element that has a value. Integers are stored 
+    in the array 'values', other values as the substrings of the string 
+    'values' given by the array 'offsets'. Values are decoded when they are
+    indexed, or all at once by 'tolist'."""
+    
+    __slots__ = ("kind", "mask", "values", "offsets")
+    
+    def __init__(self, kind, mask, values, offsets=None):
+        self.kind = kind
+        self.mask = mask
+        self.values = values
+        self.offsets = offsets
+    
+    def __getitem__(self, j):
+        if not self.mask[j]:
+            return None
+        if self.kind == binary_int:
+            return self.values[j]
+        v = self.values[self.offsets[j]:self.offsets[j+1]]
+        return decode_literal(v) if self.kind == binary_literal else v
+    
+    def tolist(self):
+        mask = self.mask
+        if self.kind == binary_int:
+            values = self.values.tolist()
+        else:
+            (blob, offsets) = (self.values, self.offsets)
+            values = [blob[offsets[j]:offsets[j+1]] for j in range(len(mask))]
+            if self.kind == binary_literal:
+                values = [decode_literal(v) if mask[j] else None for (j,v) in enumerate(values)]
+        return [v if mask[j] else None for (j,v) in enumerate(values)]
+
+# Regular expressions used by ModelInstance.read for parsing instance descriptions.
+# The start of a statement, up to and including the opening parenthesis.
+statement_start = re.compile(r"\s*((?:[A-Za-z_]\w*\s*=\s*)*)([A-Za-z_]\w*)\s*\(")
+# A field and the comma or closing parenthesis following it. The value is either
+# an identifier, a string or a number.
+statement_field = re.compile(r"""\s*([A-Za-z_]\w*)\s*=\s*(?:([A-Za-z_]\w*)|("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|([-+]?\.?\d[\w.]*(?:[eE][-+]\d+)?))\s*([,)])""")
+# A closing parenthesis directly following a comma or opening parenthesis.
+statement_end = re.compile(r"\s*\)")
+# Whitespace and comments.
+statement_blank = re.compile(r"\s*(?:#.*)?$")
+# Constants that can be used as value.
+statement_constants = {"True": True, "False": False, "None": None}
+
+# A step of a query: the name of an element or field, preceded by a dot
+# unless it is the first step.
+query_step = re.compile(r"\s*(\.?)\s*([A-Za-z_]\w*)")
+# A condition of a query: a field name, optionally compared to a constant,
+# a string or a number.
+query_condition = re.compile(r"""\s*\[\s*([A-Za-z_]\w*)\s*(?:(==|=|!=|<=|>=|<|>)\s*(?:(True|False|None)|("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|([-+]?\.?\d[\w.]*(?:[eE][-+]\d+)?)))?\s*\]""")
+# The comparison operators of a query condition.
+query_operators = {"=": operator.eq, "==": operator.eq, "!=": operator.ne, 
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+class InstanceStack(threading.local):
+    """Keeps track of the ModelInstances to which newly created elements 
+    are added, separately for each thread."""
+    
+    def __init__(self):
+        self.instances = []
+
+building = InstanceStack()
+
+def construct(elementtype, values):
+    """Creates an element of 'elementtype' with the field values given by
+    the dictionary 'values', without checking them or adding the element
+    to the child-lists of its parents or to a ModelInstance. With the 
+    default storage, 'values' becomes the dictionary of the element."""
+    plan = elementtype._plan
+    if not values.keys() <= plan.keys():
+        for k in values:
+            if k in elementtype._fields and k not in plan:
+                raise AttributeError("Setting value of childlist '{0}'".format(k))
+            elif k not in plan:
+                raise AttributeError("Unknown Attribute '{0}'".format(k))
+    element = elementtype.__new__(elementtype)
+    setinstance(element, None)
+    if elementtype._compact:
+        for slot in elementtype._slots:
+            slot.__set__(element, None)
+        for (k,v) in values.items():
+            plan[k][1].__set__(element, v)
+    else:
+        setfield(element, "_values", values)
+    return element
+
+def detach(element):
+    """Removes the element from the child-lists of its parents and from the
+    ModelInstance it belongs to. Its parent fields are left unchanged, such
+    that it can no longer be reached from the other elements."""
+    elementtype = type(element)
+    (reads, watching.reads) = (watching.reads, None)
+    for field in elementtype._parents:
+        parent = getattr(element, field.name)
+        if parent is not None:
+            field.childfield.accessor.children(parent).discard(element)
+            if parent._instance is not None and elementtype._tracked:
+                parent._instance.changed(parent, field.childname)
+    watching.reads = reads
+    if element._instance is not None:
+        element._instance.remove(element)
+
+class ReadLog(threading.local):
+    """Collects the fields of elements of tracked MetaModels that are read
+    while a rule is applied, separately for each thread. The 'reads' list
+    contains (element, fieldname) pairs and is None if nothing is recorded."""
+    
+    def __init__(self):
+        self.reads = None
+
+watching = ReadLog()
 
 class ModelInstance:
     def __init__(self, model):
@@ -336,115 +1122,1341 @@ class ModelInstance:
         # Create a dictionary for storing the named elements of the instance.
         # By convention, the 'graph' will be stored in instance["root"]
         self.identifiers = dict()
+        
+        # Create a dictionary mapping each element class to the elements of
+        # this instance that are an instance of that class. These are stored
+        # as the keys of a dictionary, in the order in which they were added,
+        # such that removing an element takes constant time.
+        self.extents = dict()
+        
+        # Maps each element class to the element classes it is an instance of.
+        self.__superclasses = dict()
+        
+        # Create a dictionary mapping each indexed AttributeField to its index.
+        # The index maps each value to the elements having that value, which
+        # are stored as the keys of a dictionary.
+        self.indexes = dict()
+        
+        # When the model is tracked, this maps each created or changed 
+        # element to the set of names of its changed fields.
+        self.changes = dict()
+
+    def __enter__(self):
+        """Elements created within a 'with instance:' block are added to 
+        this instance."""
+        building.instances.append(self)
+        return self
+    
+    def __exit__(self, *exc_info):
+        building.instances.pop()
+    
+    def add(self, element):
+        """Adds the element to the extents and indexes of this instance."""
+        elementtype = type(element)
+        setinstance(element, self)
+        for field in elementtype._indexed:
+            value = getattr(element, field.name)
+            if value is not None:
+                self.__index(field).setdefault(value, dict())[element] = None
+        for extent in self.__extents(elementtype):
+            extent[element] = None
+        
+        # Record the creation and the change of the parents' child-lists.
+        if elementtype._tracked:
+            self.changes.setdefault(element, set())
+            (reads, watching.reads) = (watching.reads, None)
+            for field in elementtype._parents:
+                parent = getattr(element, field.name)
+                if parent is not None and parent._instance is not None:
+                    parent._instance.changed(parent, field.childname)
+            watching.reads = reads
+    
+    def add_all(self, elements):
+        """Adds the elements, which must be of the same type, to this 
+        instance. This is faster than adding them one by one."""
+        if not elements:
+            return
+        elementtype = type(elements[0])
+        if elementtype._indexed or elementtype._tracked:
+            for element in elements:
+                self.add(element)
+            return
+        for element in elements:
+            setinstance(element, self)
+        added = dict.fromkeys(elements)
+        for extent in self.__extents(elementtype):
+            extent.update(added)
+    
+    def __extents(self, elementtype):
+        """Returns the extents to which elements of 'elementtype' belong."""
+        try:
+            return self.__superclasses[elementtype]
+        except KeyError:
+            superclasses = [c for c in elementtype.__mro__ if issubclass(c, AbstractElement)]
+            superclasses = self.__superclasses[elementtype] = [self.extents.setdefault(c, dict()) for c in superclasses]
+            return superclasses
+    
+    def remove(self, element):
+        """Removes the element from the extents and indexes of this instance.
+        See also 'detach'."""
+        elementtype = type(element)
+        (reads, watching.reads) = (watching.reads, None)
+        for field in elementtype._indexed:
+            self.reindex(element, field, getattr(element, field.name), None)
+        watching.reads = reads
+        for c in elementtype.__mro__:
+            if c in self.extents:
+                del self.extents[c][element]
+        setinstance(element, None)
+    
+    def changed(self, element, name):
+        """Records that the field 'name' of 'element' was changed."""
+        self.changes.setdefault(element, set()).add(name)
+    
+    def pop_changes(self):
+        """Returns the changes recorded since the previous call, see 'changes'."""
+        changes = self.changes
+        self.changes = dict()
+        return changes
+    
+    def all_of(self, elementtype):
+        """Returns the elements of this instance that are an instance of 
+        'elementtype', in the order in which they were added, as a 
+        read-only view that follows the changes of this instance."""
+        extent = self.extents.get(elementtype)
+        return () if extent is None else extent.keys()
+    
+    def __index(self, field):
+        """Returns the index of the AttributeField 'field'. It is created
+        if the attribute was indexed after elements were added."""
+        try:
+            return self.indexes[field]
+        except KeyError:
+            self.indexes[field] = index = dict()
+            for element in self.all_of(AbstractElement):
+                if field in type(element)._indexed:
+                    value = getattr(element, field.name)
+                    if value is not None:
+                        index.setdefault(value, dict())[element] = None
+            return index
+    
+    def reindex(self, element, field, oldvalue, value):
+        """Updates the index of 'field', after it was changed from 
+        'oldvalue' to 'value' for 'element'."""
+        index = self.indexes.get(field)
+        if index is None:
+            return
+        if oldvalue is not None:
+            elements = index[oldvalue]
+            del elements[element]
+            if not elements:
+                del index[oldvalue]
+        if value is not None:
+            index.setdefault(value, dict())[element] = None
+    
+    def find(self, elementtype, **criteria):
+        """Returns a list of the elements of this instance that are an 
+        instance of 'elementtype' and whose fields have the values given
+        as keyword arguments. Indexed attributes are looked up in their 
+        index, the other fields are compared for each candidate."""
+        
+        # Iterate over a copy, as the index or extent changes if a candidate
+        # is changed or created while the results are collected.
+        candidates = tuple(self.__candidates(elementtype, criteria.items()))
+        return [el for el in candidates if isinstance(el, elementtype) and 
+            all(getattr(el, name) == value for (name, value) in criteria.items())]
+    
+    def __candidates(self, elementtype, criteria):
+        """Returns the elements of the smallest index entry of the indexed
+        attributes in the (name, value) pairs 'criteria', or the extent of
+        'elementtype' if none is indexed. These can include elements of 
+        other types."""
+        candidates = None
+        for (name, value) in criteria:
+            field = elementtype._fields.get(name)
+            if field is None:
+                raise AttributeError("Unknown Attribute '{0}'".format(name))
+            if field in elementtype._indexed and value is not None:
+                elements = self.__index(field).get(value, ())
+                if candidates is None or len(elements) < len(candidates):
+                    candidates = elements
+        
+        if candidates is None:
+            candidates = self.extents.get(elementtype, ())
+        return candidates
+    
+    def query(self, expression):
+        """Returns a generator of the results of the path expression, for
+        example "Petrinet.places[tokens>2].totransitions.dest", see Query.
+        The expression is compiled once for each MetaModel. The elements of
+        the first step are taken from the extent of its type, or from an
+        index if it has a condition that compares an indexed attribute for
+        equality. The candidates of the first step are copied when this is
+        called, so elements that are added or changed while the results are
+        generated are not included or excluded because of that."""
+        plan = self.model.query(expression)
+        elementtype = plan.elementtype
+        candidates = self.__candidates(elementtype, plan.criteria)
+        if candidates is not self.extents.get(elementtype, ()):
+            candidates = tuple(el for el in candidates if isinstance(el, elementtype))
+        else:
+            candidates = tuple(candidates)
+        return plan(candidates)
 
-    def load(self, filename):
+    def load(self, filename, validate=True):
         """Loads the instance of this MetaModel specified by the filename.
-        This instance must be new. A reference to 'self' is returned."""
+        This instance must be new. A reference to 'self' is returned.
+        See 'parse' for the 'validate' argument."""
         if filename=="-":
             script = compile(sys.stdin.read(), sys.stdin.name, "exec")
         else:    
             with open(filename) as f:
                 script = compile(f.read(), filename, "exec")
-        return self.parse(script)
+        return self.parse(script, validate)
 
-    def parse(self, script):
-        # Load the instance
-        exec(script, self.model.elements, self.identifiers)
+    def parse(self, script, validate=True):
+        """Loads the instance described by 'script'. If 'validate' is False,
+        the elements are not checked and not added to the child-lists of 
+        their parents when they are created. Instead, this is done for all
+        elements together after the script has been executed, see 'check',
+        and a ValueError listing all violations is raised if there are any.
+        This is faster for large, trusted instances, but the script can not
+        use the child-lists while it is executed."""
+        if validate:
+            with self:
+                exec(script, dict(self.model.elements), self.identifiers)
+        else:
+            created = []
+            def deferred(elementtype):
+                return lambda **kwargs: self.__create(elementtype, kwargs, created)
+            exec(script, dict((k, deferred(v)) for (k,v) in self.model.elements.items()), self.identifiers)
+            self.__validate(created)
         
         if "root" not in self.identifiers:
             raise KeyError("Instance description does not specify the required 'root' element")
         
         return self
+    
+    def bulkload(self, filename, validate=True):
+        """Loads the instance of this MetaModel specified by the filename,
+        like load, but without executing it as Python code. See 'read'."""
+        if filename=="-":
+            return self.read(sys.stdin, sys.stdin.name, validate)
+        with open(filename) as f:
+            return self.read(f, filename, validate)
+    
+    def read(self, lines, filename="<string>", validate=True):
+        """Reads an instance description from 'lines', which can be a
+        file object or any other iterable of lines. Only the syntax given 
+        in the README is accepted, which is parsed one line at a time 
+        instead of being compiled and executed. Statements are only allowed
+        to continue on the next line within the parentheses. See 'parse' 
+        for the 'validate' argument."""
+        identifiers = self.identifiers
+        if validate:
+            with self:
+                for (element, kwargs, names) in self.__statements(lines, filename):
+                    # Create the element and assign it to the identifiers.
+                    value = element(**kwargs)
+                    for identifier in names:
+                        identifiers[identifier] = value
+        else:
+            created = []
+            for (element, kwargs, names) in self.__statements(lines, filename):
+                value = self.__create(element, kwargs, created)
+                for identifier in names:
+                    identifiers[identifier] = value
+            self.__validate(created)
+        
+        if "root" not in self.identifiers:
+            raise KeyError("Instance description does not specify the required 'root' element")
+        
+        return self
+    
+    def __create(self, elementtype, kwargs, created):
+        """Creates an element using 'construct', adds it to this instance
+        and appends it to 'created'."""
+        element = construct(elementtype, kwargs)
+        self.add(element)
+        created.append(element)
+        return element
+    
+    def __validate(self, created):
+        """Adds the elements created by __create to the child-lists of their
+        parents and raises a ValueError if the instance is not valid. The 
+        garbage collector is paused, as the many new objects would trigger it."""
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            violations = self.__check(created, True)
+        finally:
+            if enabled:
+                gc.enable()
+        if violations:
+            raise ValueError("Instance has {0} integrity violation(s):\n{1}".format(len(violations), "\n".join(violations)))
+    
+    def check(self):
+        """Verifies, in one pass over the elements of each element class, 
+        that the parents have the right type, that all required parents 
+        are set, that no child-list exceeds its limit and that no abstract
+        class is instantiated. Returns a list describing the violations."""
+        return self.__check(self.all_of(AbstractElement), False)
+    
+    def __check(self, elements, link):
+        """Implements 'check' for the given elements. If 'link' is True, the
+        elements are first added to the child-lists of their parents, if 
+        those have the right type."""
+        
+        # Group the elements by their class.
+        groups = dict()
+        for element in elements:
+            try:
+                groups[type(element)].append(element)
+            except KeyError:
+                groups[type(element)] = [element]
+        
+        # Maps each element with violations to a list of descriptions.
+        violations = dict()
+        def violation(element, message):
+            violations.setdefault(element, []).append(message)
+        
+        for (elementtype, group) in groups.items():
+            if elementtype._abstract:
+                for element in group:
+                    violation(element, "Can't instantiate abstract class {0}".format(elementtype.__name__))
+            missing = dict()
+            for field in elementtype._parents:
+                if elementtype._compact:
+                    column = list(map(attrgetter(field.name), group))
+                else:
+                    column = list(map(dict.get, map(attrgetter("_values"), group), repeat(field.name)))
+                types = set(map(type, column))
+                wrong = set(t for t in types if t is not type(None) and not issubclass(t, field.elementtype))
+                if type(None) in types and not field.optional:
+                    for (element, parent) in zip(group, column):
+                        if parent is None:
+                            missing.setdefault(element, []).append(field.name)
+                if wrong:
+                    for (element, parent) in zip(group, column):
+                        if type(parent) in wrong:
+                            violation(element, "Setting '{0}' to value {1}, which is not an {2}".format(
+                                field.name, parent, field.elementtype.__name__))
+                if link:
+                    children = dict()
+                    for (element, parent) in zip(group, column):
+                        if parent is not None and type(parent) not in wrong:
+                            children.setdefault(parent, []).append(element)
+                    accessor = field.childfield.accessor
+                    for (parent, new) in children.items():
+                        accessor.children(parent).extend(new)
+            for (element, names) in missing.items():
+                violation(element, "No parents specified for association(s) {0}".format(names))
+        
+        # The limits are checked once all elements are added to their parents.
+        for (elementtype, group) in groups.items():
+            for field in elementtype._children:
+                if field.limit is not None:
+                    for element in group:
+                        if len(getattr(element, field.name)) > field.limit:
+                            violation(element, "{0} exceeds its limit".format(field.describe()))
+        
+        # Describe the violations in the order of the elements.
+        if not violations:
+            return []
+        names = dict()
+        for (k,v) in self.identifiers.items():
+            if isinstance(v, AbstractElement):
+                names.setdefault(v, k)
+        r = []
+        for (i, element) in enumerate(elements):
+            if element in violations:
+                name = names.get(element, "#{0}".format(i+1))
+                r += ["{0} {1}: {2}".format(type(element).__name__, name, message) for message in violations[element]]
+        return r
+    
+    def __statements(self, lines, filename):
+        """Parses the statements in 'lines' and generates for each statement
+        the element class, the keyword arguments of the constructor and the 
+        identifiers to which the new element must be assigned. Identifiers 
+        used as values are looked up when the statement is parsed."""
+        elements = self.model.elements
+        identifiers = self.identifiers
+        lines = iter(lines)
+        lineno = 0
+        for line in lines:
+            lineno += 1
+            m = statement_start.match(line)
+            if not m:
+                if statement_blank.match(line):
+                    continue
+                raise SyntaxError("invalid syntax", (filename, lineno, 1, line))
+            
+            # Look up the element that is created.
+            try:
+                element = elements[m.group(2)]
+            except KeyError:
+                raise NameError("name '{0}' is not defined".format(m.group(2)))
+            
+            # Parse the fields.
+            kwargs = dict()
+            pos = m.end()
+            end = statement_end.match(line, pos)
+            while not end:
+                f = statement_field.match(line, pos)
+                if not f:
+                    # The statement might continue on the next line.
+                    if statement_blank.match(line, pos):
+                        nextline = next(lines, None)
+                        if nextline is None:
+                            raise SyntaxError("unexpected EOF while parsing", (filename, lineno, pos+1, line))
+                        line = line[:pos] + nextline
+                        lineno += 1
+                        end = statement_end.match(line, pos)
+                        continue
+                    raise SyntaxError("invalid syntax", (filename, lineno, pos+1, line))
+                (name, identifier, string, number, sep) = f.groups()
+                if name in kwargs:
+                    raise SyntaxError("keyword argument repeated", (filename, lineno, pos+1, line))
+                if identifier:
+                    if identifier in identifiers:
+                        value = identifiers[identifier]
+                    elif identifier in statement_constants:
+                        value = statement_constants[identifier]
+                    else:
+                        raise NameError("name '{0}' is not defined".format(identifier))
+                elif string:
+                    value = string[1:-1] if "\\" not in string else ast.literal_eval(string)
+                else:
+                    try:
+                        value = int(number)
+                    except ValueError:
+                        value = ast.literal_eval(number)
+                kwargs[name] = value
+                pos = f.end()
+                if sep==")":
+                    break
+                end = statement_end.match(line, pos)
+            else:
+                pos = end.end()
+            
+            # Anything after the statement must be a comment.
+            if not statement_blank.match(line, pos):
+                raise SyntaxError("invalid syntax", (filename, lineno, pos+1, line))
+            
+            names = m.group(1)
+            yield (element, kwargs, [k.strip() for k in names.split("=")[:-1]] if names else ())
         
     def save(self, filename):
         """Writes this instance to a file."""
         with open(filename, "w") as f:
-            print(self, file=f)
+            self.dump(f)
     
-    def root(self):
-        return self.identifiers["root"]
+    def dump(self, f):
+        """Writes this instance to the file object 'f', one line at a time."""
+        for line in self.iter_lines():
+            f.write(line)
+            f.write("\n")
+    
+    def save_binary(self, filename):
+        """Writes a binary snapshot of this instance to a file. 
+        
+        The snapshot contains a table of element types, the type of each 
+        element and, for each element type, a column per attribute and per 
+        parent field. The elements are numbered in the order in which they 
+        are described by repr, which allows creating them in the same order.
+        Parents are stored as the number of the element and attributes are 
+        stored as integers, strings or, for other values, their repr. The
+        reprs of infinite floats and of nan are decoded explicitly, as they
+        are not literals. Numbers are stored with the byte order of the 
+        machine."""
+        
+        elements = list(self.iter_elements())
+        index = dict((el, i) for (i, el) in enumerate(elements))
+        
+        # Create the element type table and group the elements by type.
+        types = []
+        typeindex = dict()
+        members = []
+        typecolumn = array.array("I")
+        for el in elements:
+            t = type(el)
+            if t not in typeindex:
+                typeindex[t] = len(types)
+                types.append((t, [k.name for k in t._attributes], [k.name for k in t._parents]))
+                members.append([])
+            typecolumn.append(typeindex[t])
+            members[typeindex[t]].append(el)
+        
+        with open(filename, "wb") as f:
+            def write(fmt, *values):
+                f.write(struct.pack("="+fmt, *values))
+            def writestr(value):
+                value = value.encode("utf-8")
+                write("I", len(value))
+                f.write(value)
+            def writearray(data):
+                # Arrays are aligned to 8 bytes, such that they can be used in place.
+                f.write(b"\0" * (-f.tell() % 8))
+                data.tofile(f)
             
-    def __serialize_element(self, el):
-        """Adds the element to the __repr array. 
-        Dependencies are added first."""
-        if el in self.__printed:
-            return
-        self.__printed.add(el)
-
-        args=[]
-        children=[]
-        # Build the argument list and create a list of children
-        for (name,desc) in type(el)._fields.items():
-            value = getattr(el, name)
-            if isinstance(desc, AttributeField):
-                if value != None:
-                    args.append("{0}={1}".format(name, repr(value)))
-            elif isinstance(desc, ParentField):
-                if value!=None:
-                    par_el = value
-                    self.__serialize_element(par_el)
-                    args.append("{0}={1}".format(name, self.__identifiernames[par_el][0]))
-            elif isinstance(desc, ChildListField):
-                children += value
-        
-        # Get a string with the identifier(s)
-        if el in self.__identifiernames:
-            names = " = ".join(self.__identifiernames[el])+" = "
-        elif children:
-            # Create identifier names for those elements that need it and not yet have one.
-            names = "e{0}".format(self.__identifiercounter)
-            self.__identifiernames[el] = [names]
-            self.__identifiercounter += 1
-            names += " = "
+            f.write(binary_magic + (b"l" if sys.byteorder=="little" else b"b"))
+            
+            # The element type table
+            write("I", len(types))
+            for ((t, attributes, parents), m) in zip(types, members):
+                writestr(t.__name__)
+                write("I", len(m))
+                write("I", len(attributes))
+                for name in attributes:
+                    writestr(name)
+                write("I", len(parents))
+                for name in parents:
+                    writestr(name)
+            
+            # The types of the elements
+            write("I", len(elements))
+            writearray(typecolumn)
+            
+            # The columns of each type
+            for ((t, attributes, parents), m) in zip(types, members):
+                for name in attributes:
+                    values = [getattr(el, name) for el in m]
+                    present = [v for v in values if v is not None]
+                    if not present:
+                        write("B", binary_none)
+                        continue
+                    mask = bytearray(v is not None for v in values)
+                    if all(type(v)==int and -2**63 <= v < 2**63 for v in present):
+                        write("B", binary_int)
+                        f.write(mask)
+                        writearray(array.array("q", (0 if v is None else v for v in values)))
+                        continue
+                    if all(type(v)==str for v in present):
+                        write("B", binary_str)
+                    else:
+                        write("B", binary_literal)
+                        values = [None if v is None else repr(v) for v in values]
+                    f.write(mask)
+                    offsets = array.array("Q", [0])
+                    for v in values:
+                        offsets.append(offsets[-1] + (0 if v is None else len(v)))
+                    writearray(offsets)
+                    blob = "".join(v for v in values if v is not None).encode("utf-8")
+                    write("Q", len(blob))
+                    f.write(blob)
+                for name in parents:
+                    writearray(array.array("q", (-1 if getattr(el, name) is None else index[getattr(el, name)] for el in m)))
+            
+            # The identifiers
+            identifiers = [(k, v) for (k, v) in self.identifiers.items() if v in index]
+            write("I", len(identifiers))
+            for (k, v) in identifiers:
+                writestr(k)
+                write("I", index[v])
+    
+    def load_binary(self, filename, lazy=False):
+        """Loads a binary snapshot written by save_binary. The file is 
+        memory mapped and its columns are used to create all elements in 
+        bulk. This instance must be new. A reference to 'self' is returned.
+        
+        If 'lazy' is True, only the columns are read, together with an 
+        index of the children of each element. The elements are created 
+        when they are first reached, from the identifiers, as the parent 
+        of a created element or by using the child-list of a created 
+        element, see LazySnapshot. Until then, they are not included in 
+        the extents and indexes of this instance."""
+        
+        (types, typecolumn, columns, identifiers) = self.__read_binary(filename)
+        
+        if lazy:
+            snapshot = LazySnapshot(self, types, typecolumn, columns)
+            self.identifiers = LazyIdentifiers(snapshot, identifiers)
         else:
-            names = ""
+            # Create the elements
+            columns = [[(name, parent, values if parent else values.tolist()) for (name, parent, values) in c] for c in columns]
+            elements = []
+            counters = [0] * len(types)
+            with self:
+                for t in typecolumn:
+                    j = counters[t]
+                    counters[t] = j+1
+                    kwargs = dict()
+                    for (name, parent, values) in columns[t]:
+                        v = values[j]
+                        if parent:
+                            if v >= 0:
+                                kwargs[name] = elements[v]
+                        elif v is not None:
+                            kwargs[name] = v
+                    elements.append(types[t][0](**kwargs))
             
-        # Add the element to __repr
-        self.__repr.append("{0}{1}({2})".format(names, type(el).__name__, ", ".join(args)))
+            for (k, i) in identifiers:
+                self.identifiers[k] = elements[i]
         
-        # Descent into the children
-        for child in children:
-            self.__serialize_element(child)
+        if "root" not in self.identifiers:
+            raise KeyError("Instance description does not specify the required 'root' element")
+        
+        return self
+    
+    def __read_binary(self, filename):
+        """Reads a binary snapshot. Returns the element type table as a list
+        of (element class, count, attribute names, parent names) tuples, 
+        an array with the type of each element, for each type a list of 
+        (name, is parent, column) tuples and the identifiers as a list of
+        (name, element number) pairs. The columns of parents are arrays of 
+        element numbers, which are -1 for parents that are not set. Those of
+        attributes are BinaryColumns. Attributes that are never set have
+        no column."""
+        
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = memoryview(mm)
+            if data[:len(binary_magic)] != binary_magic:
+                data.release()
+                raise ValueError("{0} is not a binary model instance".format(filename))
+            order = "<" if data[len(binary_magic):len(binary_magic)+1] == b"l" else ">"
+            swap = order != ("<" if sys.byteorder=="little" else ">")
+            pos = [len(binary_magic)+1]
             
-    def __repr__(self):
-        """Creates a string which should create the same instance when loaded
-        with this instance's meta model."""
+            def read(fmt):
+                (value,) = struct.unpack_from(order+fmt, data, pos[0])
+                pos[0] += struct.calcsize(order+fmt)
+                return value
+            def readbytes(n):
+                r = data[pos[0]:pos[0]+n]
+                pos[0] += n
+                return r
+            def readstr():
+                with readbytes(read("I")) as r:
+                    return str(r, "utf-8")
+            def readarray(typecode, n):
+                pos[0] += -pos[0] % 8
+                r = array.array(typecode)
+                with readbytes(n*r.itemsize) as b:
+                    r.frombytes(b)
+                if swap:
+                    r.byteswap()
+                return r
+            
+            try:
+                # The element type table
+                types = []
+                for i in range(read("I")):
+                    name = readstr()
+                    if name not in self.model.elements:
+                        raise KeyError("Unknown Element '{0}'".format(name))
+                    count = read("I")
+                    attributes = [readstr() for j in range(read("I"))]
+                    parents = [readstr() for j in range(read("I"))]
+                    types.append((self.model.elements[name], count, attributes, parents))
+                
+                # The types of the elements
+                n = read("I")
+                typecolumn = readarray("I", n)
+                
+                # The columns of each type
+                columns = []
+                for (t, count, attributes, parents) in types:
+                    c = []
+                    for name in attributes:
+                        kind = read("B")
+                        if kind == binary_none:
+                            continue
+                        with readbytes(count) as r:
+                            mask = bytes(r)
+                        if kind == binary_int:
+                            column = BinaryColumn(kind, mask, readarray("q", count))
+                        else:
+                            offsets = readarray("Q", count+1)
+                            with readbytes(read("Q")) as r:
+                                column = BinaryColumn(kind, mask, str(r, "utf-8"), offsets)
+                        c.append((name, False, column))
+                    for name in parents:
+                        c.append((name, True, readarray("q", count)))
+                    columns.append(c)
+                
+                # The identifiers
+                identifiers = []
+                uint = struct.Struct(order+"I")
+                count = read("I")
+                p = pos[0]
+                for i in range(count):
+                    (n,) = uint.unpack_from(data, p)
+                    with data[p+4:p+4+n] as r:
+                        name = str(r, "utf-8")
+                    p += 4+n
+                    identifiers.append((name, uint.unpack_from(data, p)[0]))
+                    p += 4
+                pos[0] = p
+            finally:
+                data.release()
+        
+        return (types, typecolumn, columns, identifiers)
+    
+    def root(self):
+        return self.identifiers["root"]
+    
+    def iter_elements(self):
+        """Generates the elements reachable from the root, in the order in
+        which they are described. An element comes after the elements it
+        depends on and is followed by its children. Instead of using
+        recursion, an explicit stack is used, such that deep models do
+        not exceed the recursion limit."""
 
         # Make sure that root is set
         if "root" not in self.identifiers:
             raise KeyError("ModelInstance has no root specified")
         
-        # Create some temporary fields
-        self.__repr = r = []
-        self.__printed = set() # used to check whether an element still needs printing
-        self.__identifiernames = dict() # contains arrays like ["root"]
-        self.__identifiercounter = 0 # used for generating identifiers
+        # Each entry of the stack describes an element that is being visited:
+        # [element, iterator over its fields, children, iterator over its children]
+        # The last one is None while the fields are being processed.
+        root = self.identifiers["root"]
+        visited = set([root])
+        stack = [[root, iter(type(root)._fields.items()), [], None]]
+        while stack:
+            frame = stack[-1]
+            (el, fields, children, descent) = frame
+            
+            if descent is None:
+                # Visit the parents first and create a list of children.
+                for (name,desc) in fields:
+                    if isinstance(desc, ParentField):
+                        value = getattr(el, name)
+                        if value!=None and value not in visited:
+                            visited.add(value)
+                            stack.append([value, iter(type(value)._fields.items()), [], None])
+                            break
+                    elif isinstance(desc, ChildListField):
+                        children += getattr(el, name)
+                else:
+                    yield el
+                    frame[3] = iter(children)
+                continue
+            
+            # Descent into the children
+            for child in descent:
+                if child not in visited:
+                    visited.add(child)
+                    stack.append([child, iter(type(child)._fields.items()), [], None])
+                    break
+            else:
+                stack.pop()
+    
+    def iter_lines(self):
+        """Generates the lines of the description of this instance."""
+        
+        identifiernames = dict() # contains arrays like ["root"]
+        identifiercounter = 0 # used for generating identifiers
         
         # Create identifier names for the elements in self.identifiers.
         for (k,v) in self.identifiers.items():
-            if v not in self.__identifiernames:
-                self.__identifiernames[v] = []
-            self.__identifiernames[v].append(k)
+            if v not in identifiernames:
+                identifiernames[v] = []
+            identifiernames[v].append(k)
+        
+        for el in self.iter_elements():
+            # Build the argument list and check for children.
+            args=[]
+            children=False
+            for (name,desc) in type(el)._fields.items():
+                value = getattr(el, name)
+                if isinstance(desc, AttributeField):
+                    if value != None:
+                        args.append("{0}={1}".format(name, repr(value)))
+                elif isinstance(desc, ParentField):
+                    if value!=None:
+                        args.append("{0}={1}".format(name, identifiernames[value][0]))
+                elif isinstance(desc, ChildListField):
+                    children = children or len(value)>0
+            
+            # Get a string with the identifier(s)
+            if el in identifiernames:
+                names = " = ".join(identifiernames[el])+" = "
+            elif children:
+                # Create identifier names for those elements that need it and not yet have one.
+                names = "e{0}".format(identifiercounter)
+                identifiernames[el] = [names]
+                identifiercounter += 1
+                names += " = "
+            else:
+                names = ""
+            
+            yield "{0}{1}({2})".format(names, type(el).__name__, ", ".join(args))
+    
+    def __repr__(self):
+        """Creates a string which should create the same instance when loaded
+        with this instance's meta model."""
+        return "\n".join(self.iter_lines())
+
+class LazySnapshot:
+    """Creates the elements of a binary snapshot when they are first 
+    reached, see ModelInstance.load_binary. The elements are numbered as 
+    in the snapshot. The elements of each type are found with 'members', 
+    which contains their numbers in ascending order. The children of an 
+    element are found with 'parents', which maps each parent field of 
+    each type to the numbers of the parents, sorted, and the positions 
+    of the elements having them. Creating an element also creates its 
+    parents. Its child-lists are LazyChildLists, which create the 
+    children when they are used. Elements are created without checking
+    them, as the snapshot was made from a valid instance."""
+    
+    def __init__(self, instance, types, typecolumn, columns):
+        self.instance = instance
+        self.types = types
+        self.typecolumn = typecolumn
+        self.columns = columns
+        
+        # Maps the numbers of the created elements to the elements.
+        self.elements = dict()
+        
+        # Group the element numbers by type. The sort is stable.
+        order = sorted(range(len(typecolumn)), key=typecolumn.__getitem__)
+        self.members = []
+        start = 0
+        for (t, count, attributes, parents) in types:
+            self.members.append(array.array("q", order[start:start+count]))
+            start += count
+        
+        # Sort the elements of each type by their parents.
+        self.parents = dict()
+        for (k, ((t, count, attributes, parents), c)) in enumerate(zip(types, columns)):
+            for (name, parent, column) in c:
+                if parent:
+                    positions = sorted(range(count), key=column.__getitem__)
+                    self.parents[k, name] = (array.array("q", map(column.__getitem__, positions)), array.array("q", positions))
+        
+        # Maps each ChildListField of each type to the parent columns of 
+        # the types whose elements can be in the child-list.
+        self.sources = dict()
+    
+    def element(self, i):
+        """Returns element number 'i', which is created if necessary."""
+        elements = self.elements
+        if i in elements:
+            return elements[i]
+        # Create the parents that do not exist yet first, without recursion.
+        stack = [i]
+        while stack:
+            k = stack[-1]
+            t = self.typecolumn[k]
+            j = bisect.bisect_left(self.members[t], k)
+            missing = [v for (name, parent, column) in self.columns[t] if parent 
+                for v in (column[j],) if v >= 0 and v not in elements]
+            if missing:
+                stack += missing
+                continue
+            stack.pop()
+            if k not in elements:
+                elements[k] = self.__create(k, t, j)
+        return elements[i]
+    
+    def __create(self, i, t, j):
+        """Creates element number 'i', which is element 'j' of type 't'."""
+        elementtype = self.types[t][0]
+        values = dict()
+        for (name, parent, column) in self.columns[t]:
+            v = column[j]
+            if parent:
+                if v >= 0:
+                    values[name] = self.elements[v]
+            elif v is not None:
+                values[name] = v
+        element = construct(elementtype, values)
+        for field in elementtype._children:
+            children = self.children(elementtype, field, i)
+            if children:
+                childlist = LazyChildList(self, children)
+                if elementtype._compact:
+                    field.accessor.slot.__set__(element, childlist)
+                else:
+                    element._values[field.name] = childlist
+        self.instance.add(element)
+        return element
+    
+    def children(self, elementtype, field, i):
+        """Returns the numbers of the children in the child-list 'field' of
+        element number 'i', which has type 'elementtype'."""
+        try:
+            sources = self.sources[elementtype, field]
+        except KeyError:
+            sources = self.sources[elementtype, field] = [(self.members[k],) + self.parents[k, name] 
+                for (k, name) in self.parents if name == field.parentname and 
+                getattr(self.types[k][0]._fields.get(name), "childfield", None) is field]
+        children = []
+        for (members, parents, positions) in sources:
+            lo = bisect.bisect_left(parents, i)
+            hi = bisect.bisect_right(parents, i, lo)
+            children += map(members.__getitem__, positions[lo:hi])
+        if len(sources) > 1:
+            children.sort()
+        return children
+
+
+class LazyChildList(ChildList):
+    """A child-list of an element created by a LazySnapshot. The children,
+    given by 'pending' as element numbers, are created when the child-list
+    is first used."""
+    
+    __slots__ = ("snapshot", "pending")
+    
+    def __init__(self, snapshot, pending):
+        ChildList.__init__(self)
+        self.snapshot = snapshot
+        self.pending = pending
+    
+    def load(self):
+        """Creates the pending children."""
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            ChildList.extend(self, [self.snapshot.element(i) for i in pending])
+    
+    def add(self, child):
+        self.load()
+        ChildList.add(self, child)
+    
+    def extend(self, children):
+        self.load()
+        ChildList.extend(self, children)
+    
+    def discard(self, child):
+        self.load()
+        ChildList.discard(self, child)
+    
+    def __contains__(self, child):
+        self.load()
+        return ChildList.__contains__(self, child)
+    
+    def __iter__(self):
+        self.load()
+        return ChildList.__iter__(self)
+    
+    def __len__(self):
+        self.load()
+        return ChildList.__len__(self)
+    
+    def __repr__(self):
+        self.load()
+        return ChildList.__repr__(self)
+
+
+class LazyIdentifiers(MutableMapping):
+    """The identifiers of an instance loaded lazily from a binary snapshot.
+    The elements are created by the LazySnapshot when they are looked up."""
+    
+    def __init__(self, snapshot, identifiers):
+        self.snapshot = snapshot
+        # Maps the identifiers to their element, or to its element number 
+        # for those in 'pending'.
+        self.values = dict(identifiers)
+        self.pending = set(self.values)
+    
+    def __getitem__(self, name):
+        value = self.values[name]
+        if name in self.pending:
+            value = self.values[name] = self.snapshot.element(value)
+            self.pending.discard(name)
+        return value
+    
+    def __setitem__(self, name, value):
+        self.values[name] = value
+        self.pending.discard(name)
+    
+    def __delitem__(self, name):
+        del self.values[name]
+        self.pending.discard(name)
+    
+    def __iter__(self):
+        return iter(self.values)
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def __contains__(self, name):
+        return name in self.values
+
+
+class Query:
+    """A path expression compiled against the FieldDescriptors of a 
+    MetaModel, see ModelInstance.query. The expression starts with the name
+    of an element, which selects the elements of that type, followed by 
+    field names separated by dots. A child-list field selects the children
+    of the selected elements, a parent field their parents and an attribute,
+    which must be the last step, the values of the attribute that are set.
+    Each step can be followed by conditions in brackets: '[name]' keeps the
+    elements of which the field is set, or for child-lists not empty, and
+    '[name op value]' compares an attribute to a constant, with op one of 
+    =, ==, !=, <, <=, > and >=. Attributes that are not set only match 
+    '[name=None]' and '[name!=...]'.
+    
+    The plan is a list of steps, each a function that maps an iterator of
+    elements to an iterator of the next elements, such that the results are
+    generated lazily. Each parent is generated once, in the order in which
+    it is first reached. The conditions on the first step that compare
+    an indexed attribute for equality are looked up in the index."""
+    
+    def __init__(self, model, expression):
+        """Parses 'expression' and creates the plan for the elements of 
+        'model'. Raises a SyntaxError if the expression is invalid, a 
+        NameError for unknown elements and an AttributeError for unknown 
+        fields."""
+        self.expression = expression
+        # The element type of the first step and the (name, value) pairs of
+        # its equality conditions, which can be looked up in an index.
+        self.elementtype = None
+        self.criteria = []
+        # The steps, as functions, and their description.
+        self.steps = []
+        self.descriptions = []
+        
+        pos = 0
+        elementtype = None
+        last = None
+        while pos < len(expression):
+            m = query_step.match(expression, pos)
+            if not m or bool(m.group(1)) != (elementtype is not None) or last is AttributeField:
+                self.__error(pos)
+            name = m.group(2)
+            if elementtype is None:
+                # The elements of a type.
+                try:
+                    elementtype = self.elementtype = model.elements[name]
+                except KeyError:
+                    raise NameError("name '{0}' is not defined".format(name))
+                last = elementtype
+            else:
+                field = self.__field(elementtype, name)
+                get = attrgetter(name)
+                if isinstance(field, ChildListField):
+                    self.steps.append(lambda elements, get=get: chain.from_iterable(map(get, elements)))
+                    self.descriptions.append("children {0}".format(name))
+                elif isinstance(field, ParentField):
+                    self.steps.append(lambda elements, get=get: distinct(map(get, elements)))
+                    self.descriptions.append("parent {0}".format(name))
+                else:
+                    self.steps.append(lambda elements, get=get: (v for v in map(get, elements) if v is not None))
+                    self.descriptions.append("attribute {0}".format(name))
+                last = type(field)
+                elementtype = field.elementtype if last is not AttributeField else None
+            pos = m.end()
+            
+            # Parse the conditions.
+            while True:
+                c = query_condition.match(expression, pos)
+                if not c:
+                    break
+                if last is AttributeField:
+                    self.__error(pos)
+                self.__condition(elementtype, c.groups(), last is self.elementtype)
+                pos = c.end()
+            if expression[pos:].strip() == "":
+                break
+        if elementtype is None and last is None:
+            self.__error(0)
+    
+    def __error(self, pos):
+        raise SyntaxError("invalid syntax", ("<query>", 1, pos+1, self.expression))
+    
+    def __field(self, elementtype, name):
+        """Returns the FieldDescriptor 'name' of 'elementtype'."""
+        field = elementtype._fields.get(name)
+        if field is None:
+            raise AttributeError("Unknown field '{0}' of Element '{1}'".format(name, elementtype.__name__))
+        return field
+    
+    def __condition(self, elementtype, groups, first):
+        """Adds a step that filters the elements on a condition."""
+        (name, op, constant, string, number) = groups
+        field = self.__field(elementtype, name)
+        get = attrgetter(name)
+        if op is None:
+            if isinstance(field, ChildListField):
+                self.steps.append(lambda elements: (e for e in elements if len(get(e))))
+            else:
+                self.steps.append(lambda elements: (e for e in elements if get(e) is not None))
+            self.descriptions.append("filter {0}".format(name))
+            return
+        if not isinstance(field, AttributeField):
+            raise AttributeError("Only attributes can be compared: {0}".format(name))
+        if constant:
+            value = statement_constants[constant]
+        elif string:
+            value = string[1:-1] if "\\" not in string else ast.literal_eval(string)
+        else:
+            try:
+                value = int(number)
+            except ValueError:
+                value = ast.literal_eval(number)
+        compare = query_operators[op]
+        if value is None:
+            if compare is operator.eq:
+                self.steps.append(lambda elements: (e for e in elements if get(e) is None))
+            elif compare is operator.ne:
+                self.steps.append(lambda elements: (e for e in elements if get(e) is not None))
+            else:
+                raise TypeError("None can only be compared with = and !=: {0}".format(name))
+        elif compare is operator.ne:
+            self.steps.append(lambda elements: (e for e in elements if get(e) != value))
+        else:
+            def condition(elements):
+                for e in elements:
+                    v = get(e)
+                    if v is not None and compare(v, value):
+                        yield e
+            self.steps.append(condition)
+            if first and compare is operator.eq:
+                self.criteria.append((name, value))
+        self.descriptions.append("filter {0} {1} {2!r}".format(name, op, value))
+    
+    def describe(self):
+        """Returns a list of strings that describe the steps of the plan."""
+        indexed = [name for (name, value) in self.criteria if self.elementtype._fields[name].indexed]
+        if indexed:
+            source = "index {0}.{1}".format(self.elementtype.__name__, indexed[0])
+        else:
+            source = "extent {0}".format(self.elementtype.__name__)
+        return [source] + self.descriptions
+    
+    def __call__(self, elements):
+        """Returns a generator of the results of the plan, where 'elements'
+        are the elements selected by the first step."""
+        for step in self.steps:
+            elements = step(elements)
+        yield from elements
+
+
+def distinct(elements):
+    """Generates the elements that are not None, each only the first time."""
+    seen = set()
+    for element in elements:
+        if element is not None and element not in seen:
+            seen.add(element)
+            yield element
+
+
+class TransformationContext:
+    """Contains the state of applying TransformationRules: the results
+    of the rules and the applications that are pending. Rules use the 
+    context that was entered using 'with context:' in the current thread
+    or asyncio task. Otherwise each thread uses its own default context, 
+    which is returned by 'current_context()'. 
+    
+    A context must not be used by multiple threads at the same time. 
+    The results of the rules are freed when the context is cleared or 
+    no longer used.
+    
+    If 'track' is True, the context records for each application of a 
+    rule which fields of tracked elements it read, which other results 
+    it used and which elements it created. The 'update' method uses this 
+    to re-apply only the rules affected by changes to the source model.
+    Tracking contexts apply all rules in the current process."""
+    
+    def __init__(self, track=False):
+        # The results of the rules, for each rule a dictionary from element to result.
+        # The rules are weak keys, such that the results of a rule that is no
+        # longer used, for instance one defined in a function, are freed with it.
+        self.results = WeakKeyDictionary()
+        
+        # The delayed applications, for each rule a dictionary from element 
+        # to the remaining arguments.
+        self.delays = WeakKeyDictionary()
+        
+        # This set will contain all rules that have pending transformations.
+        # It will be empty when the initial transformation call returns.
+        self.pending = set()
         
-        # Add all elements reachable from the 'root' to 'r'
-        self.__serialize_element(self.identifiers["root"])
+        # Used by TransformationRule to determine whether to enter the pending 
+        # rules handling loop, or not.
+        self.transforming = False
+        
+        # The tokens for restoring the previous context when leaving a 'with' block.
+        self.tokens = []
+        
+        # Whether the applications of the rules are recorded.
+        self.tracking = track
+        
+        # Maps each recorded application (rule, element) to its arguments,
+        # the fields it read and the elements it created.
+        self.applications = dict()
+        
+        # Maps each (element, fieldname) to the applications that read it.
+        self.readers = dict()
+        
+        # Maps each application to the applications that used its result.
+        self.users = dict()
+        
+        # The applications that are being performed.
+        self.applying = []
+    
+    def __enter__(self):
+        self.tokens.append(transformation_context.set(self))
+        return self
+    
+    def __exit__(self, *exc_info):
+        transformation_context.reset(self.tokens.pop())
+    
+    def cache(self, rule):
+        """Returns the dictionary with the results of 'rule'."""
+        try:
+            return self.results[rule]
+        except KeyError:
+            if rule.maxsize is not None:
+                r = BoundedResults(rule.maxsize)
+            elif rule.scope == "run":
+                r = RunResults()
+            else:
+                r = Results()
+            self.results[rule] = r
+            return r
+    
+    def stats(self):
+        """Returns the statistics of the caches of the rules used in this 
+        context, see TransformationRule.stats."""
+        return dict((rule, rule.stats(self)) for rule in self.results)
+    
+    def delayed(self, rule):
+        """Returns the dictionary with the delayed applications of 'rule'."""
+        try:
+            return self.delays[rule]
+        except KeyError:
+            self.delays[rule] = r = WeakKeyDictionary()
+            return r
+    
+    def clear(self):
+        """Forgets all results and pending applications."""
+        if self.transforming:
+            raise RuntimeError("Clearing a TransformationContext during a transformation")
+        self.results.clear()
+        self.delays.clear()
+        self.pending.clear()
+        self.applications.clear()
+        self.readers.clear()
+        self.users.clear()
+    
+    def update(self, changes):
+        """Forgets the results of the applications that read a field listed
+        in 'changes', which maps elements to the names of their changed 
+        fields, as returned by ModelInstance.pop_changes. This is repeated
+        for the applications that used a forgotten result. The elements 
+        created by the forgotten applications are removed and the 
+        applications are delayed, such that they are applied again by the 
+        next call to any rule in this context. Returns the number of 
+        forgotten applications."""
+        if not self.tracking:
+            raise RuntimeError("Updating a TransformationContext that does not track")
+        if self.transforming:
+            raise RuntimeError("Updating a TransformationContext during a transformation")
         
-        # Remove the temporary fields
-        del self.__identifiercounter
-        del self.__identifiernames 
-        del self.__printed
-        del self.__repr
+        # Find the affected applications.
+        work = [key for (element, names) in changes.items() for name in names 
+                for key in self.readers.get((element, name), ())]
+        invalid = set()
+        while work:
+            key = work.pop()
+            if key not in invalid:
+                invalid.add(key)
+                work.extend(self.users.pop(key, ()))
         
-        # Return the description
-        return "\n".join(r)
+        # Undo them and apply them again later.
+        for key in invalid:
+            (rule, element) = key
+            self.cache(rule).pop(element, None)
+            (args, kwargs, reads, created) = self.applications.pop(key)
+            for read in reads:
+                readers = self.readers.get(read)
+                if readers is not None:
+                    readers.discard(key)
+                    if not readers:
+                        del self.readers[read]
+            for e in created:
+                detach(e)
+            self.delayed(rule)[element] = (args, kwargs)
+            self.pending.add(rule)
+        return len(invalid)
 
-# Used by TransformationRule to determine whether to enter the pending rules 
-# handling loop, or not.
-transforming = False
+# The TransformationContext of the current thread or asyncio task.
+transformation_context = contextvars.ContextVar("transformation_context")
 
-# This set will contain all rules that have pending transformations.
-# It will be empty when the initial transformation call returns.
-pending_rules = set()
+def current_context():
+    """Returns the TransformationContext that is used by TransformationRules
+    in the current thread or asyncio task."""
+    try:
+        return transformation_context.get()
+    except LookupError:
+        context = TransformationContext()
+        transformation_context.set(context)
+        return context
+
+# The number of processes over which the pending applications of a parallel
+# rule are distributed. With 1, all rules are applied in the current process.
+transform_processes = os.cpu_count() or 1
+
+# The minimum number of pending applications of a parallel rule for which it
+# is worth to distribute them over multiple processes.
+transform_batch = 1000
+
+class Results(WeakKeyDictionary):
+    """Stores the results of a TransformationRule, for as long as the 
+    elements exist. It also counts the cache hits, misses and evictions."""
+    
+    def __init__(self):
+        WeakKeyDictionary.__init__(self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+class RunResults(dict):
+    """Stores the results of a TransformationRule until the outermost call
+    of a rule returns."""
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+class BoundedResults(OrderedDict):
+    """Stores at most 'maxsize' results of a TransformationRule, forgetting
+    the least recently used ones. Results that are being computed are
+    not forgotten."""
+    
+    def __init__(self, maxsize):
+        OrderedDict.__init__(self)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        skipped = 0
+        while len(self) > self.maxsize and skipped < len(self):
+            (k, v) = self.popitem(last=False)
+            if v is TransformationRule:
+                OrderedDict.__setitem__(self, k, v)
+                skipped += 1
+            else:
+                self.evictions += 1
+
+class ElementCollector:
+    """Records the elements that are created by a tracked application of a 
+    rule, and passes them on to the ModelInstance that is being built, if any."""
+    
+    def __init__(self, instance):
+        # Skip other collectors, such that each only records its own elements.
+        if isinstance(instance, ElementCollector):
+            instance = instance.instance
+        self.instance = instance
+        self.elements = []
+    
+    def add(self, element):
+        self.elements.append(element)
+        if self.instance is not None:
+            self.instance.add(element)
 
 class TransformationRule:
     """Changes the meaning of a function, such that it can be used to get 
@@ -463,59 +2475,477 @@ class TransformationRule:
     
     TransformationRules work independant of MetaModels and ModelInstances.
     Therefore you can also apply them on non-ModelInstances or create
-    non-ModelInstances as a result."""
+    non-ModelInstances as a result.
+    
+    The results and pending applications are stored in the current 
+    TransformationContext. By default, the results are kept for as long as 
+    their elements exist. If 'maxsize' is given, only that many results are
+    kept, forgetting the least recently used ones. If 'scope' is "run", the
+    results are forgotten when the outermost call to a rule returns. In both
+    cases, a rule can be applied to the same element more than once. 
     
-    def __init__(self, f):
+    If 'inputs' is given, the function is applied to 'inputs(element)' 
+    instead of the element itself. If 'parallel' is True, the pending 
+    applications of the rule are divided over 'transform_processes' worker
+    processes, once there are at least 'transform_batch' of them. This is 
+    only allowed for rules without side effects: the function must be 
+    defined at module level, must not create elements or apply other rules
+    and its inputs, other arguments and result must be picklable. As 
+    elements are not, parallel rules usually need 'inputs' to extract the 
+    values they use. The 'configure' method can be used to create a 
+    decorator with these options."""
+    
+    def __init__(self, f, maxsize=None, scope="context", parallel=False, inputs=None):
+        if scope not in ("context", "run"):
+            raise ValueError("Unknown TransformationRule scope '{0}'".format(scope))
+        if maxsize is not None and not (isinstance(maxsize, int) and maxsize>0):
+            raise ValueError("TransformationRule maxsize '{0}' must be a positive integer".format(maxsize))
+        if parallel and "<locals>" in f.__qualname__:
+            raise ValueError("Parallel TransformationRule '{0}' must be defined at module level".format(f.__name__))
         self.f = f
-        self.cache = WeakKeyDictionary()
-        self.delayed = WeakKeyDictionary()
+        self.maxsize = maxsize
+        self.scope = scope
+        self.parallel = parallel
+        self.inputs = inputs
+        # The function that computes the result for an element.
+        if inputs is None:
+            self.function = f
+        else:
+            self.function = lambda element, *args, **kwargs: f(inputs(element), *args, **kwargs)
+    
+    @classmethod
+    def configure(cls, maxsize=None, scope="context", parallel=False, inputs=None):
+        """Returns a decorator that creates TransformationRules with the 
+        given options."""
+        return lambda f: cls(f, maxsize, scope, parallel, inputs)
+    
+    def stats(self, context=None):
+        """Returns a dictionary with the number of cache hits, misses and 
+        evictions of this rule and the number of results that are cached, 
+        in 'context' or the current TransformationContext."""
+        cache = (context or current_context()).cache(self)
+        return dict(hits=cache.hits, misses=cache.misses, evictions=cache.evictions, size=len(cache))
+    
+    @property
+    def cache(self):
+        """The results of this rule in the current TransformationContext."""
+        return current_context().cache(self)
+    
+    @property
+    def delayed(self):
+        """The delayed applications of this rule in the current TransformationContext."""
+        return current_context().delayed(self)
     
     def __call__(self, element, *args, **kwargs):
+        context = current_context()
+        cache = context.cache(self)
+        
         # Are we in the middle of a transformation. If not, set to true and 
         # be the one who applies pending transformations.
-        global transforming
-        if not transforming:
+        if not context.transforming:
             # This is the initial call, so we delay it, enter transformation 
             # mode and divert to the pending rules handling loop.
-            transforming = True
-            self.later(element, *args, **kwargs)
-            self.__handle_pending()
-            # We are done.
-            transforming = False
+            context.transforming = True
+            try:
+                r = self(element, *args, **kwargs)
+                self.__handle_pending(context)
+            except BaseException:
+                # Drop the pending rules, such that a next transformation
+                # starts from a clean state.
+                context.delays.clear()
+                context.pending.clear()
+                raise
+            finally:
+                # We are done.
+                context.transforming = False
+                for (rule, results) in context.results.items():
+                    if rule.scope == "run":
+                        results.clear()
             # Return the requested element.
-            return self.cache[element]
+            return r
+        
+        # Record that the application that is being performed uses this result.
+        if context.applying:
+            context.users.setdefault((self, element), set()).add(context.applying[-1])
         
         # Check if we have performed the transformation already.
         try:
-            r = self.cache[element]
+            r = cache[element]
             # Check for circular transformation.
             if r == TransformationRule:
                 raise RuntimeError("Applying circular transformation '{0}'".format(self.f.__name__))
             # Return the cached value.
+            cache.hits += 1
             return r
         except KeyError:
             # Not converted, so do that next.
-            pass
+            cache.misses += 1
         # set the dict value for the current element to 'being transformed'
-        self.cache[element] = TransformationRule
-        self.cache[element] = r = self.f(element, *args, **kwargs)
+        cache[element] = TransformationRule
+        try:
+            if context.tracking:
+                return self.__apply_tracked(context, cache, element, args, kwargs)
+            cache[element] = r = self.function(element, *args, **kwargs)
+        except BaseException:
+            # Forget that the element is being transformed, such that the
+            # rule can be applied to it again.
+            if cache.get(element) is TransformationRule:
+                del cache[element]
+            raise
+        return r
+    
+    def __apply_tracked(self, context, cache, element, args, kwargs):
+        """Applies the rule and records the fields it reads and the 
+        elements it creates."""
+        key = (self, element)
+        reads = []
+        collector = ElementCollector(building.instances[-1] if building.instances else None)
+        previous = watching.reads
+        watching.reads = reads
+        building.instances.append(collector)
+        context.applying.append(key)
+        try:
+            cache[element] = r = self.function(element, *args, **kwargs)
+        finally:
+            context.applying.pop()
+            building.instances.remove(collector)
+            watching.reads = previous
+        context.applications[key] = (args, kwargs, reads, collector.elements)
+        for read in reads:
+            context.readers.setdefault(read, set()).add(key)
         return r
     
     def later(self, element, *args, **kwargs):
         """Will delay the transformation of the specified element, 
         until the transformation returns to the pending rule handling loop."""
-        if element in self.cache:
+        context = current_context()
+        if element in context.cache(self):
             return
-        self.delayed[element] = (args, kwargs)
-        pending_rules.add(self)
+        context.delayed(self)[element] = (args, kwargs)
+        context.pending.add(self)
     
-    def __handle_pending(self):
+    def __handle_pending(self, context):
         """Executes the pending rules handling loop."""
-        while len(pending_rules)>0:
+        while len(context.pending)>0:
             # Obtain a pending rule
-            rule = pending_rules.pop()
+            rule = context.pending.pop()
+            delayed = context.delayed(rule)
             
-            while len(rule.delayed)>0:
-                (element, (args, kwargs)) = rule.delayed.popitem()
-                rule(element, *args, **kwargs)
+            while len(delayed)>0:
+                if (rule.parallel and transform_processes > 1 
+                        and len(delayed) >= max(2, transform_batch) and not context.tracking):
+                    batch = list(delayed.items())
+                    rule.__apply_parallel(context, batch)
+                    # Only forget the applications once their results are stored.
+                    for (element, arguments) in batch:
+                        delayed.pop(element, None)
+                else:
+                    (element, (args, kwargs)) = delayed.popitem()
+                    rule(element, *args, **kwargs)
+    
+    def __apply_parallel(self, context, batch):
+        """Applies this parallel rule to the pending elements in 'batch', by
+        dividing them over 'transform_processes' worker processes. Only the
+        inputs and other arguments of the applications are sent to the 
+        workers, which look up the function by its module and name. 
+        Therefore only rules that are pure functions of their inputs are 
+        supported: elements and instances are never sent to the workers, 
+        so rules that create or refer to elements can not be parallel.
+        
+        Starting the workers takes some time, see 'worker_pool', so this 
+        only pays off for rules that spend much more time on computing 
+        their results than on pickling them."""
+        cache = context.cache(self)
+        batch = [(element, args, kwargs) for (element, (args, kwargs)) in batch if element not in cache]
+        if self.inputs is not None:
+            applications = [((self.inputs(element),) + args, kwargs) for (element, args, kwargs) in batch]
+        else:
+            applications = [((element,) + args, kwargs) for (element, args, kwargs) in batch]
+        
+        # Each worker applies the rule to a consecutive part of the batch.
+        size = -(-len(applications) // transform_processes)
+        with worker_pool(transform_processes) as pool:
+            futures = [pool.submit(apply_parallel, self.f.__module__, self.f.__qualname__, applications[i:i+size])
+                    for i in range(0, len(applications), size)]
+            results = [r for future in futures for r in future.result()]
+        
+        # Store the results in the order of the batch.
+        for ((element, args, kwargs), r) in zip(batch, results):
+            cache.misses += 1
+            cache[element] = r
+    
+
+def worker_pool(processes, initializer=None, initargs=()):
+    """Returns a ProcessPoolExecutor with 'processes' worker processes. They
+    are started with 'forkserver' or 'spawn', such that they do not inherit
+    the state of other threads of this process, and therefore only have 
+    what is sent to them. If 'initializer' is given, each worker calls 
+    initializer(*initargs) when it starts."""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(processes, mp_context=context, initializer=initializer, initargs=initargs)
+
+def apply_parallel(module, name, applications):
+    """Applies the function of the parallel TransformationRule 'name' in 
+    'module' to the (args, kwargs) of each of the 'applications' and returns
+    the list of results. It is called in the worker processes."""
+    rule = importlib.import_module(module)
+    for part in name.split("."):
+        rule = getattr(rule, part)
+    if isinstance(rule, TransformationRule):
+        rule = rule.f
+    return [rule(*args, **kwargs) for (args, kwargs) in applications]
+
+
+class DotWriter:
+    """Writes a graphviz graph in the DOT language to the file object 'file',
+    one statement at a time, such that large graphs do not have to be kept
+    in memory. It is used as a context manager:
+    
+        with DotWriter(sys.stdout, "overlap=false;") as dot:
+            dot.write("a -> b;")
+    
+    On entering the block, the graph is opened and the given graph 
+    statements are written. On leaving it, the graph is closed. The graph 
+    is a 'digraph' unless 'graph' specifies otherwise. Node identifiers 
+    should be numbered using 'count', instead of global counters, such that
+    a graph written twice by the same process is the same. For the same 
+    reason, the block uses a new TransformationContext, such that the rules
+    that write the graph do not reuse the results of a previous graph."""
+    
+    def __init__(self, file, *statements, graph="digraph"):
+        self.file = file
+        self.statements = statements
+        self.graph = graph
+        self.counters = dict()
+        self.close = False
+        self.context = None
+    
+    @classmethod
+    def open(cls, filename, *statements, graph="digraph"):
+        """Creates a DotWriter that writes to the file 'filename', which is 
+        closed when the block is left. If 'filename' is '-', standard output
+        is used. If it ends with '.gz', the graph is compressed with gzip. 
+        The time stamp in its header is left empty, such that the same graph
+        always results in the same file."""
+        if filename == "-":
+            return cls(sys.stdout, *statements, graph=graph)
+        if filename.endswith(".gz"):
+            file = io.TextIOWrapper(gzip.GzipFile(filename, "wb", mtime=0), encoding="utf-8")
+        else:
+            file = open(filename, "w", encoding="utf-8")
+        writer = cls(file, *statements, graph=graph)
+        writer.close = True
+        return writer
+    
+    def __enter__(self):
+        self.context = TransformationContext()
+        self.context.__enter__()
+        self.write(self.graph + " {")
+        for statement in self.statements:
+            self.write(statement)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.write("}")
+            self.file.flush()
+        finally:
+            self.context.__exit__(exc_type, exc_value, traceback)
+            self.context = None
+            if self.close:
+                self.file.close()
     
+    def write(self, statement):
+        """Writes a line to the graph."""
+        self.file.write(statement + "\n")
+    
+    def count(self, name):
+        """Returns how often 'count' was called before with 'name'."""
+        n = self.counters.get(name, 0)
+        self.counters[name] = n + 1
+        return n
+
+
+class Instrumentation:
+    """Measures how often, and how long, elements are constructed (one at 
+    a time, in bulk, or without validation), parents are assigned, 
+    child-list limits are checked, child-lists are created, elements of 
+    lazy snapshots are created, TransformationRules are called and 
+    instances are parsed, read, loaded and serialized. Within a 
+    'with Instrumentation() as probe:' block, the measured methods are 
+    replaced by wrappers. Therefore, there is no overhead when 
+    instrumentation is disabled. The measurements include
+    all threads, and the time of an event includes the time of the events
+    that happen during it. If 'callback' is given, it is called as 
+    callback(kind, name, duration) for each event."""
+    
+    # The Instrumentation that is enabled, if any.
+    active = None
+    
+    def __init__(self, callback=None):
+        self.callback = callback
+        # Maps (kind, name) to a list [count, total duration].
+        self.events = dict()
+        # Serializes the updates of 'events' by different threads.
+        self.lock = threading.Lock()
+        # The replaced methods as (class or module, name, method) triples, while enabled.
+        self.originals = None
+    
+    def __enter__(self):
+        self.enable()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.disable()
+    
+    def record(self, kind, name, duration):
+        """Records an event. The events of all threads are counted."""
+        with self.lock:
+            try:
+                event = self.events[(kind, name)]
+            except KeyError:
+                self.events[(kind, name)] = event = [0, 0.0]
+            event[0] += 1
+            event[1] += duration
+        if self.callback is not None:
+            self.callback(kind, name, duration)
+    
+    def report(self):
+        """Returns the measurements as a dictionary, mapping each kind of 
+        event to a dictionary that maps names to their count and total time. 
+        The kinds are 'construct', 'bulk', 'assign', 'limitcheck', 
+        'childlist', 'materialize', 'rule-hit', 'rule-miss' and 'instance'. 
+        Elements created by 'bulk' are not counted as 'construct' events, 
+        while those created without validation or by a lazy snapshot are."""
+        report = dict()
+        for ((kind, name), (count, duration)) in self.events.items():
+            report.setdefault(kind, dict())[name] = dict(count=count, time=duration)
+        return report
+    
+    def enable(self):
+        """Replaces the measured methods by wrappers."""
+        if Instrumentation.active is not None:
+            raise RuntimeError("Instrumentation is already enabled")
+        Instrumentation.active = self
+        
+        perf = time.perf_counter
+        record = self.record
+        def timed(kind, name, f):
+            def wrapper(*args, **kwargs):
+                start = perf()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    record(kind, name, perf() - start)
+            return wrapper
+        
+        init = AbstractElement.__init__
+        def initialize(element, **kwargs):
+            start = perf()
+            try:
+                init(element, **kwargs)
+            finally:
+                record("construct", type(element).__name__, perf() - start)
+        
+        unchecked = construct
+        def constructunchecked(elementtype, values):
+            start = perf()
+            try:
+                return unchecked(elementtype, values)
+            finally:
+                record("construct", elementtype.__name__, perf() - start)
+        
+        bulk = AbstractElement.__dict__["bulk"].__func__
+        def constructbulk(cls, **columns):
+            start = perf()
+            try:
+                return bulk(cls, **columns)
+            finally:
+                record("bulk", cls.__name__, perf() - start)
+        
+        link = ParentField.link
+        def assign(field, element, oldvalue, value):
+            start = perf()
+            try:
+                link(field, element, oldvalue, value)
+            finally:
+                record("assign", "{0}.{1}".format(type(element).__name__, field.name), perf() - start)
+        
+        check = ParentField.check_limit
+        def limitcheck(field, childlist):
+            start = perf()
+            try:
+                check(field, childlist)
+            finally:
+                record("limitcheck", "{0}.{1}".format(field.elementtype.__name__, field.childfield.name), perf() - start)
+        
+        get = ChildListField.__get__
+        def childlist(field, element, elementtype=None):
+            if element is None or field.name in element._values:
+                return get(field, element, elementtype)
+            start = perf()
+            r = get(field, element, elementtype)
+            record("childlist", "{0}.{1}".format(type(element).__name__, field.name), perf() - start)
+            return r
+        
+        children = CompactChildListField.children
+        def compactchildren(accessor, element):
+            if accessor.slot.__get__(element) is not None:
+                return children(accessor, element)
+            start = perf()
+            r = children(accessor, element)
+            record("childlist", "{0}.{1}".format(type(element).__name__, accessor.field.name), perf() - start)
+            return r
+        
+        element = LazySnapshot.element
+        def materialize(snapshot, i):
+            if i in snapshot.elements:
+                return element(snapshot, i)
+            start = perf()
+            try:
+                return element(snapshot, i)
+            finally:
+                record("materialize", snapshot.types[snapshot.typecolumn[i]][0].__name__, perf() - start)
+        
+        call = TransformationRule.__call__
+        def apply(rule, element, *args, **kwargs):
+            context = current_context()
+            # The outermost call calls the rule again, which is measured instead.
+            if not context.transforming:
+                return call(rule, element, *args, **kwargs)
+            kind = "rule-hit" if element in context.cache(rule) else "rule-miss"
+            start = perf()
+            try:
+                return call(rule, element, *args, **kwargs)
+            finally:
+                record(kind, rule.f.__name__, perf() - start)
+        
+        replacements = [
+            (AbstractElement, "__init__", initialize),
+            (AbstractElement, "bulk", classmethod(constructbulk)),
+            (sys.modules[__name__], "construct", constructunchecked),
+            (ParentField, "link", assign),
+            (ParentField, "check_limit", limitcheck),
+            (ChildListField, "__get__", childlist),
+            (CompactChildListField, "children", compactchildren),
+            (LazySnapshot, "element", materialize),
+            (TransformationRule, "__call__", apply),
+        ]
+        for name in ("parse", "read", "load_binary", "dump", "__repr__"):
+            replacements.append((ModelInstance, name, timed("instance", name, ModelInstance.__dict__[name])))
+        
+        self.originals = [(cls, name, cls.__dict__[name]) for (cls, name, f) in replacements]
+        for (cls, name, f) in replacements:
+            setattr(cls, name, f)
+    
+    def disable(self):
+        """Restores the measured methods. Does nothing if they were not 
+        replaced by this Instrumentation."""
+        if self.originals is None:
+            return
+        for (cls, name, f) in self.originals:
+            setattr(cls, name, f)
+        self.originals = None
+        Instrumentation.active = None
@@ -18,8 +18,34 @@
 
 from __future__ import print_function
 
+import composedpetrinet2petrinet
+import declarechecker
+import gc
+import gzip
+import io
+import math
 import metamodel
+import os
+import petrinetreachability
+import petrinetsimulation
+import sys
+import tempfile
+import threading
 import unittest
+import weakref
+
+# The tests do not use the on-disk cache of the meta models, unless they
+# set one themselves.
+saved_cache = None
+
+def setUpModule():
+    global saved_cache
+    saved_cache = metamodel.cache
+    metamodel.cache = None
+
+def tearDownModule():
+    metamodel.cache = saved_cache
+
 
 class IntegrationTests(unittest.TestCase):
     """Some tests that test whether the whole system works together."""
@@ -52,9 +78,396 @@ class IntegrationTests(unittest.TestCase):
         mof2 = metamodel.MetaModel(mofdesc)
         mofi2 = mof2.instance().parse(mofdesc)
 
+    def test_bulkload(self):
+        for (model, filename) in [("petrinets.m2", "petrinet.m1"), ("declare.m2", "declare.m1"), ("mof.m3", "mof.m3")]:
+            m = metamodel.load(model)
+            netin = m.instance().load(filename)
+            bulkin = m.instance().bulkload(filename)
+            self.assertEqual(sorted(netin.identifiers), sorted(bulkin.identifiers))
+            for (k,v) in netin.identifiers.items():
+                w = bulkin.identifiers[k]
+                self.assertEqual(type(v), type(w))
+                for name in v._fields:
+                    value = getattr(v, name)
+                    if isinstance(value, metamodel.AbstractElement):
+                        self.assertEqual(type(value), type(getattr(w, name)))
+                    elif isinstance(value, metamodel.ChildList):
+                        self.assertEqual([type(c) for c in value], [type(c) for c in getattr(w, name)])
+                    else:
+                        self.assertEqual(value, getattr(w, name))
+
+    def test_child_list(self):
+        for compact in (False, True):
+            net = metamodel.load("petrinets.m2", compact=compact)
+            with net.instance():
+                root = net.elements["Petrinet"](name="a")
+                places = [net.elements["Place"](of=root, name=str(i)) for i in range(20)]
+                self.assertIsInstance(root.places, metamodel.ChildList)
+                self.assertEqual(list(root.places), places)
+                self.assertEqual(type(root.places.items), dict)
+                for place in places[::2]:
+                    metamodel.detach(place)
+                self.assertEqual(list(root.places), places[1::2])
+                self.assertIn(places[1], root.places)
+                self.assertNotIn(places[0], root.places)
+
+                # Small child-lists are kept in a list.
+                transition = net.elements["Transition"](of=root)
+                arcs = [net.elements["InputArc"](source=p, dest=transition) for p in places[3:0:-1]]
+                self.assertEqual(type(transition.fromplaces.items), list)
+                self.assertEqual(list(transition.fromplaces), arcs)
+                self.assertEqual(transition.fromplaces | set(), set(arcs))
+                self.assertEqual(repr(transition.fromplaces), "ChildList({0})".format(arcs))
+
+    def test_deferred_validation(self):
+        for (model, filename) in [("petrinets.m2", "petrinet.m1"), ("declare.m2", "declare.m1"), ("mof.m3", "mof.m3")]:
+            for compact in (False, True):
+                m = metamodel.load(model, compact=compact)
+                netin = m.instance().load(filename)
+                self.assertEqual(netin.check(), [])
+                for deferred in (m.instance().load(filename, validate=False), m.instance().bulkload(filename, validate=False)):
+                    self.assertEqual(repr(deferred), repr(netin))
+                    self.assertEqual(deferred.check(), [])
+
+        declare = metamodel.load("declare.m2")
+        script = (
+            'root = DeclareDiagram()\n'
+            'a = InitialActivity(of=root)\n'
+            'InitialActivity(of=root)\n'
+            'Response(left=a)\n'
+            'BinaryRelation(left=root, right=a)\n'
+        )
+        for (compact, load) in ((False, "parse"), (True, "parse"), (False, "read"), (True, "read")):
+            instance = metamodel.load("declare.m2", compact=compact).instance()
+            with self.assertRaises(ValueError) as cm:
+                if load == "parse":
+                    instance.parse(script, validate=False)
+                else:
+                    instance.read(script.splitlines(True), validate=False)
+            self.assertEqual(str(cm.exception).split("\n")[1:], [
+                "DeclareDiagram root: InitialActivity[1] init exceeds its limit",
+                "Response #4: No parents specified for association(s) ['right']",
+                "BinaryRelation #5: Can't instantiate abstract class BinaryRelation",
+                "BinaryRelation #5: Setting 'left' to value {0}, which is not an BaseActivity".format(instance.root()),
+            ])
+            self.assertEqual(len(instance.check()), 4)
+            self.assertEqual(len(instance.root().init), 2)
+        with self.assertRaisesRegexp(AttributeError, "Unknown Attribute 'unknown'"):
+            declare.instance().read(['root = DeclareDiagram(unknown=1)\n'], validate=False)
+
+    def test_read(self):
+        net = metamodel.load("petrinets.m2")
+        netin = net.instance().read([
+            '# A comment\n',
+            'root = net = Petrinet(name="a\\"b") # Another comment\n',
+            '\n',
+            'Place(of=root,\n',
+            '  tokens=-3, capacity=1.5e3, # Multiple lines\n',
+            "  name='c',)\n",
+            'Transition(of=root)',
+        ])
+        self.assertEqual(netin.root(), netin.identifiers["net"])
+        self.assertEqual(netin.root().name, 'a"b')
+        place = list(netin.root().places)[0]
+        self.assertEqual(place.tokens, -3)
+        self.assertEqual(place.capacity, 1500.0)
+        self.assertEqual(place.name, "c")
+        self.assertEqual(len(netin.root().transitions), 1)
+        
+        with self.assertRaises(SyntaxError):
+            net.instance().read(['root = Petrinet(name=1+2)\n'])
+        with self.assertRaises(SyntaxError):
+            net.instance().read(['root = Petrinet()\n', 'import os\n'])
+        with self.assertRaises(SyntaxError):
+            net.instance().read(['root = Petrinet(\n'])
+        with self.assertRaisesRegexp(NameError, "name 'p' is not defined"):
+            net.instance().read(['root = Petrinet()\n', 'Place(of=p)\n'])
+        with self.assertRaisesRegexp(NameError, "name 'Foo' is not defined"):
+            net.instance().read(['root = Foo()\n'])
+        
+    def test_dump(self):
+        net = metamodel.load("petrinets.m2")
+        netin = net.instance().load("petrinet.m1")
+        f = io.StringIO()
+        netin.dump(f)
+        self.assertEqual(f.getvalue(), repr(netin)+"\n")
+        self.assertEqual(list(netin.iter_lines()), repr(netin).split("\n"))
+    
+    def test_deep_serialization(self):
+        chain = metamodel.MetaModel(
+            'root = MetaModel()\n'
+            'node = Element(of=root, name="Node")\n'
+            'Attribute(of=node, name="depth")\n'
+            'Association(parent=node, child=node, parentname="up", childname="down", optional=True)\n'
+        )
+        depth = sys.getrecursionlimit()*2
+        instance = chain.instance()
+        instance.identifiers["root"] = node = chain.elements["Node"](depth=0)
+        for i in range(depth):
+            node = chain.elements["Node"](up=node, depth=i+1)
+        lines = list(instance.iter_lines())
+        self.assertEqual(len(lines), depth+1)
+        copy = chain.instance().read(lines)
+        node = copy.root()
+        while node.down:
+            (node,) = node.down
+        self.assertEqual(node.depth, depth)
+        
+    def test_binary(self):
+        (fd, filename) = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        try:
+            for (model, instance) in [("petrinets.m2", "petrinet.m1"), ("declare.m2", "declare.m1"), ("mof.m3", "mof.m3")]:
+                m = metamodel.load(model)
+                netin = m.instance().load(instance)
+                netin.save_binary(filename)
+                binin = m.instance().load_binary(filename)
+                self.assertEqual(sorted(netin.identifiers), sorted(binin.identifiers))
+                self.assertEqual(sorted(repr(netin).split("\n")), sorted(repr(binin).split("\n")))
+            
+            net = metamodel.load("petrinets.m2")
+            netin = net.instance().read([
+                'root = Petrinet(name="\\u1234")\n',
+                'Place(of=root, name="", tokens=True, capacity=2.5)\n',
+                'Place(of=root, name="a\\nb", tokens=100000000000000000000)\n',
+                'Place(of=root, name="inf", tokens=1e999, capacity=-1e999)\n',
+            ])
+            next(iter(netin.root().places)).tokens = float("nan")
+            netin.save_binary(filename)
+            binin = net.instance().load_binary(filename)
+            self.assertEqual(sorted(repr(netin).split("\n")), sorted(repr(binin).split("\n")))
+            places = list(binin.root().places)
+            self.assertTrue(math.isnan(places[0].tokens))
+            self.assertEqual((places[2].tokens, places[2].capacity), (float("inf"), float("-inf")))
+            lazy = net.instance().load_binary(filename, lazy=True)
+            places = list(lazy.root().places)
+            self.assertTrue(math.isnan(places[0].tokens))
+            self.assertEqual(places[2].capacity, float("-inf"))
+            
+            with self.assertRaisesRegexp(ValueError, "is not a binary model instance"):
+                net.instance().load_binary("petrinet.m1")
+        finally:
+            os.remove(filename)
+
+    def test_lazy_binary(self):
+        (fd, filename) = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        try:
+            for compact in (False, True):
+                net = metamodel.load("petrinets.m2", compact=compact)
+                E = net.elements
+                netin = net.instance().load("petrinet.m1")
+                netin.save_binary(filename)
+
+                # Only the elements that are reached are created.
+                lazy = net.instance().load_binary(filename, lazy=True)
+                self.assertEqual(len(lazy.all_of(metamodel.AbstractElement)), 0)
+                p4 = lazy.identifiers["p4"]
+                self.assertEqual(p4.tokens, 3)
+                self.assertEqual(len(lazy.all_of(metamodel.AbstractElement)), 2)
+                (arc,) = p4.totransitions
+                self.assertEqual(arc.dest.name, "t1")
+                self.assertEqual(len(lazy.all_of(metamodel.AbstractElement)), 4)
+                self.assertTrue(lazy.identifiers["t1"] is arc.dest)
+                eager = net.instance().load_binary(filename)
+                self.assertEqual([p.tokens for p in lazy.root().places], [p.tokens for p in eager.root().places])
+
+                # Children added to a child-list that is not yet loaded.
+                Place = E["Place"]
+                with lazy:
+                    Place(of=lazy.identifiers["root"], tokens=7)
+                self.assertEqual(len(lazy.root().places), 8)
+
+                lazy = net.instance().load_binary(filename, lazy=True)
+                self.assertEqual(repr(lazy), repr(eager))
+                self.assertEqual(len(lazy.all_of(metamodel.AbstractElement)), 20)
+                self.assertEqual(lazy.check(), [])
+        finally:
+            os.remove(filename)
+
+    def test_extents(self):
+        net = metamodel.load("petrinets.m2")
+        E = net.elements
+        for netin in (net.instance().load("petrinet.m1"), net.instance().bulkload("petrinet.m1")):
+            self.assertEqual(len(netin.all_of(E["Place"])), 7)
+            self.assertEqual(len(netin.all_of(E["InterfacePlace"])), 2)
+            self.assertEqual(len(netin.all_of(E["InterfaceTransition"])), 1)
+            self.assertEqual(len(netin.all_of(E["InputArc"])), 4)
+            self.assertEqual(len(netin.all_of(metamodel.AbstractElement)), 20)
+            self.assertEqual(set(netin.all_of(E["Place"])), netin.root().places)
+            self.assertTrue(netin.identifiers["p6"] in netin.all_of(E["Place"]))
+        
+        # Elements created in a with block are added to the instance.
+        with netin:
+            place = E["Place"](of=netin.root())
+        E["Place"](of=netin.root())
+        self.assertEqual(len(netin.all_of(E["Place"])), 8)
+        self.assertTrue(place in netin.all_of(E["Place"]))
+        self.assertEqual(len(net.instance().all_of(E["Place"])), 0)
+        
+        # Removing elements keeps the order of the others.
+        places = list(netin.all_of(E["Place"]))
+        metamodel.detach(places[2])
+        metamodel.detach(place)
+        self.assertEqual(list(netin.all_of(E["Place"])), places[:2] + places[3:-1])
+        self.assertNotIn(place, netin.all_of(metamodel.AbstractElement))
+    
+    def test_find(self):
+        for compact in (False, True):
+            net = metamodel.MetaModel(
+                'root = MetaModel()\n'
+                'net = Element(of=root, name="Net")\n'
+                'place = Element(of=root, name="Place")\n'
+                'iplace = Element(of=root, name="InterfacePlace", extends=place)\n'
+                'Attribute(of=place, name="name", indexed=True)\n'
+                'Attribute(of=place, name="tokens")\n'
+                'Association(parent=net, child=place, parentname="of", childname="places")\n',
+                compact=compact,
+            )
+            self.assertTrue("    <attribute> name (indexed)" in str(net).split("\n"))
+            E = net.elements
+            netin = net.instance().read([
+                'root = Net()\n',
+                'a = Place(of=root, name="a", tokens=1)\n',
+                'b = InterfacePlace(of=root, name="b", tokens=1)\n',
+                'c = Place(of=root, name="b", tokens=2)\n',
+            ])
+            (a, b, c) = [netin.identifiers[k] for k in "abc"]
+            self.assertEqual(netin.find(E["Place"], name="a"), [a])
+            self.assertEqual(set(netin.find(E["Place"], name="b")), set([b, c]))
+            self.assertEqual(netin.find(E["InterfacePlace"], name="b"), [b])
+            self.assertEqual(netin.find(E["Place"], name="b", tokens=2), [c])
+            self.assertEqual(netin.find(E["Place"], name="d"), [])
+            
+            # The index is updated when the attribute changes.
+            c.name = "d"
+            self.assertEqual(netin.find(E["Place"], name="b"), [b])
+            self.assertEqual(netin.find(E["Place"], name="d"), [c])
+            
+            # Attributes that are not indexed are searched.
+            self.assertEqual(set(netin.find(E["Place"], tokens=1)), set([a, b]))
+            
+            # Indexes can also be created after loading.
+            net.index(E["Place"], "tokens")
+            self.assertEqual(set(netin.find(E["Place"], tokens=1)), set([a, b]))
+            b.tokens = 3
+            self.assertEqual(netin.find(E["Place"], tokens=1), [a])
+            self.assertEqual(netin.find(E["Place"], tokens=3), [b])
+            
+            with self.assertRaisesRegexp(AttributeError, "Only attributes can be indexed"):
+                net.index(E["Place"], "of")
+            with self.assertRaisesRegexp(AttributeError, "Unknown Attribute 'foo'"):
+                netin.find(E["Place"], foo=3)
+    
+    def test_query(self):
+        for compact in (False, True):
+            net = metamodel.load("petrinets.m2", compact)
+            netin = net.instance().load("petrinet.m1")
+            I = netin.identifiers
+            query = netin.query("Petrinet.places[tokens>2].totransitions.dest")
+            self.assertEqual(next(query), I["t1"])
+            self.assertEqual(list(query), [I["t2"]])
+            self.assertEqual(list(netin.query("Place.name")), ["p1", "p2", "FiveTokens"])
+            self.assertEqual(list(netin.query("InterfacePlace[name='p1'].totransitions.dest.toplaces.dest.tokens")), [0, 2])
+            self.assertEqual(list(netin.query("Place[capacity=None][tokens>=5]")), [I["p6"], I["p7"]])
+            self.assertEqual(list(netin.query("Transition[name][toplaces]")), [I["t1"]])
+            self.assertEqual(list(netin.query("Place[ name != 'p1' ].of")), [netin.root()])
+            self.assertIs(net.query("Place.name"), net.query(" Place.name"[1:]))
+            
+            for (expression, error) in (
+                    ("", SyntaxError), ("Place.", SyntaxError), (".Place", SyntaxError),
+                    ("Place.tokens.name", SyntaxError), ("Place[tokens=x]", SyntaxError), 
+                    ("Foo", NameError), ("Place.foo", AttributeError), ("Place[of=2]", AttributeError), 
+                    ("Place[tokens<None]", TypeError)):
+                with self.assertRaises(error):
+                    netin.query(expression)
+        
+        # Equality conditions on the first step use the index.
+        net = metamodel.load("petrinets.m2")
+        netin = net.instance().load("petrinet.m1")
+        self.assertEqual(net.query("Place[name='p2'].of").describe(), ["extent Place", "filter name = 'p2'", "parent of"])
+        net.index(net.elements["Place"], "name")
+        self.assertEqual(net.query("Place[name='p2'].of").describe(), ["index Place.name", "filter name = 'p2'", "parent of"])
+        self.assertEqual(list(netin.query("InterfacePlace[name='p2']")), [netin.identifiers["p2"]])
+        self.assertEqual(list(netin.query("Transition[name='p2']")), [])
+        
+        # The indexed attribute can be changed while the results are iterated.
+        places = list(netin.all_of(net.elements["Place"]))
+        for place in places:
+            place.name = "p2"
+        for place in netin.query("Place[name='p2']"):
+            place.name = "p3"
+        self.assertEqual(list(netin.query("Place[name='p3']")), places)
+    
+    def test_compact(self):
+        net = metamodel.load("petrinets.m2", compact=True)
+        netin = net.instance().load("petrinet.m1")
+        root = netin.root()
+        self.assertEqual(len(root.places), 7)
+        self.assertFalse(hasattr(root, "__dict__"))
+        p1 = netin.identifiers["p1"]
+        self.assertEqual(p1.tokens, 1)
+        self.assertEqual(p1.capacity, None)
+        self.assertEqual(len(p1.fromtransitions), 0)
+        self.assertTrue(isinstance(p1, net.elements["Place"]))
+        repr(netin)
+
+    def test_compact_empty_childlist(self):
+        results = []
+        for compact in (False, True):
+            net = metamodel.load("petrinets.m2", compact=compact)
+            netin = net.instance().load("petrinet.m1")
+            (p1, p2) = (netin.identifiers["p1"], netin.identifiers["p2"])
+            empty = p1.fromtransitions
+            self.assertIsInstance(empty, metamodel.ChildList)
+            self.assertIsInstance(empty | p2.fromtransitions, metamodel.ChildList)
+            results.append((repr(empty), list(empty), len(empty), empty == metamodel.ChildList(), 
+                p2 in empty, len(empty | p2.fromtransitions)))
+            
+            # Adding a child through its parent field makes the child-list non-empty.
+            arc = net.elements["OutputArc"](source=netin.identifiers["t"], dest=p1)
+            self.assertIsInstance(p1.fromtransitions, metamodel.ChildList)
+            self.assertEqual(list(p1.fromtransitions), [arc])
+        self.assertEqual(results[0], ("ChildList([])", [], 0, True, False, 1))
+        self.assertEqual(results[1], results[0])
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        saved = metamodel.cache
+        try:
+            metamodel.cache = metamodel.MetaModelCache(directory)
+            net = metamodel.load("petrinets.m2")
+            self.assertEqual(len(os.listdir(directory)), 1)
+            cached = metamodel.load("petrinets.m2", compact=True)
+            self.assertEqual(list(cached.elements), list(net.elements))
+            self.assertEqual(sorted(cached.identifiers), sorted(net.identifiers))
+            self.assertEqual(cached.definitions, net.definitions)
+            self.assertEqual(
+                repr(cached.instance().load("petrinet.m1")),
+                repr(net.instance().load("petrinet.m1")))
+            # Entries of other files evict the least recently used entry.
+            metamodel.cache.maxsize = os.path.getsize(os.path.join(directory, os.listdir(directory)[0]))
+            metamodel.load("mof.m3")
+            self.assertEqual(len(os.listdir(directory)), 1)
+        finally:
+            metamodel.cache = saved
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
 class ModelErrors(unittest.TestCase):
     """Test that errors in a meta model are detected."""
     
+    def test_frozen(self):
+        model = metamodel.load("petrinets.m2")
+        place = model.elements["Place"]
+        self.assertEqual(place._required, ("of",))
+        self.assertEqual([k.name for k in place._attributes], ["name", "capacity", "tokens"])
+        self.assertEqual([k.name for k in place._children], ["totransitions", "fromtransitions"])
+        self.assertEqual(model.elements["InterfacePlace"]._required, ("of",))
+        with self.assertRaisesRegexp(RuntimeError, "Can't add field extra to a loaded MetaModel"):
+            model.attribute(place, "extra")
+
     def test_duplicate_element(self):
         with self.assertRaisesRegexp(KeyError, "Redefinition of Element"):
             metamodel.MetaModel(
@@ -225,6 +638,8 @@ class ModelErrors(unittest.TestCase):
 class InstanceErrors(unittest.TestCase):
     """Test whether instance creation will raise errors when necessary."""
     
+    compact = False
+    
     def setUp(self):
         self.instance=metamodel.MetaModel(
             'root = MetaModel()\n'
@@ -235,7 +650,8 @@ class InstanceErrors(unittest.TestCase):
             'Element(of=root, name="SubTest2", extends=el2)\n'
             'Attribute(of=el, name="attr")\n'
             'Association(parent=el, child=el2, parentname="a", childname="a", limit=2)\n'
-            'Association(parent=el, child=el2, parentname="b", childname="b", optional=True)\n'
+            'Association(parent=el, child=el2, parentname="b", childname="b", optional=True)\n',
+            compact=self.compact,
         ).instance()
 
     def test_set_unknown_attribute(self):
@@ -251,6 +667,13 @@ class InstanceErrors(unittest.TestCase):
         with self.assertRaisesRegexp(AttributeError, "Unknown Attribute 'unknown'"):
             self.instance.root().unknown
 
+    def test_assign_unknown_attribute(self):
+        self.instance.parse(
+            'root = Test()\n'
+        )
+        with self.assertRaisesRegexp(AttributeError, "Unknown Attribute 'unknown'"):
+            self.instance.root().unknown = 3
+
     def test_known_attribute(self):
         self.instance.parse(
             'root = Test(attr=3)\n'
@@ -286,6 +709,20 @@ class InstanceErrors(unittest.TestCase):
             'Test2(a=root)\n'
         )
 
+    def test_reassign_parent(self):
+        self.instance.parse(
+            'root = Test()\n'
+            'other = Test()\n'
+            'child = Test2(a=root)\n'
+        )
+        root = self.instance.root()
+        other = self.instance.identifiers["other"]
+        child = self.instance.identifiers["child"]
+        child.a = other
+        self.assertEqual(child.a, other)
+        self.assertEqual(len(root.a), 0)
+        self.assertEqual(len(other.a), 1)
+
     def test_create_child_of_subclass(self):
         self.instance.parse(
             'root = SubTest()\n'
@@ -327,6 +764,765 @@ class InstanceErrors(unittest.TestCase):
             self.instance.parse(
                 'root = Abstract()\n'
             )
+
+    def test_bulk(self):
+        elements = self.instance.model.elements
+        (Test, SubTest, Test2) = (elements["Test"], elements["SubTest"], elements["Test2"])
+        with self.instance:
+            (a, b) = Test.bulk(attr=["a", "b"])
+            sub = SubTest()
+            children = Test2.bulk(a=[a, sub, a], b=[None, sub, b])
+        self.assertEqual([el.attr for el in (a, b)], ["a", "b"])
+        self.assertEqual(list(a.a), [children[0], children[2]])
+        self.assertEqual(list(sub.b), [children[1]])
+        self.assertEqual(list(b.b), [children[2]])
+        self.assertEqual(children[0].b, None)
+        self.assertEqual(list(self.instance.all_of(Test2)), children)
+        self.assertEqual(list(self.instance.all_of(Test)), [a, b, sub])
+        self.assertEqual(Test.bulk(), [])
+
+        with self.assertRaisesRegexp(AttributeError, "Unknown Attribute 'unknown'"):
+            Test.bulk(unknown=[1])
+        with self.assertRaisesRegexp(AttributeError, "Setting value of childlist 'a'"):
+            Test.bulk(a=[1])
+        with self.assertRaisesRegexp(ValueError, "Column 'b' has 1 values instead of 2"):
+            Test2.bulk(a=[a, a], b=[a])
+        with self.assertRaisesRegexp(AttributeError, "which is not an"):
+            Test2.bulk(a=[a, children[0]])
+        with self.assertRaisesRegexp(AttributeError, r"No parents specified for association\(s\)"):
+            Test2.bulk(b=[a])
+        with self.assertRaisesRegexp(AttributeError, r"No parents specified for association\(s\)"):
+            Test2.bulk(a=[b, None])
+        with self.assertRaisesRegexp(KeyError, "to exceed its limit"):
+            Test2.bulk(a=[b, b, b])
+        with self.assertRaisesRegexp(RuntimeError, "Can't instantiate abstract class"):
+            elements["Abstract"].bulk(attr=[1])
+        self.assertEqual(len(b.a), 0)
+        self.assertEqual(len(self.instance.all_of(Test2)), 3)
+
+class ReadInstanceErrors(InstanceErrors):
+    """Repeats the instance tests using ModelInstance.read instead of parse."""
+    
+    def setUp(self):
+        InstanceErrors.setUp(self)
+        instance = self.instance
+        instance.parse = lambda script: instance.read(script.splitlines(True))
+
+class CompactInstanceErrors(InstanceErrors):
+    """Repeats the instance tests using compact storage."""
+    
+    compact = True
+
+# The parallel transformation rules are defined at module level, such that
+# the worker processes can find them.
+@metamodel.TransformationRule.configure(parallel=True, inputs=lambda place: (place.name, place.tokens, place.capacity))
+def marking(values, separator):
+    (name, tokens, capacity) = values
+    return "{0}:{1}{2}{3}".format(name, tokens or 0, separator, capacity)
+
+@metamodel.TransformationRule.configure(parallel=True, inputs=lambda place: place.name)
+def process(name):
+    return os.getpid()
+
+@metamodel.TransformationRule.configure(parallel=True, inputs=lambda place: place.name)
+def failing(name):
+    raise ValueError("Failing rule")
+
+
+class Transformations(unittest.TestCase):
+    """Test applying transformation rules."""
+    
+    def setUp(self):
+        self.net = metamodel.load("petrinets.m2")
+        self.netin = self.net.instance().load("petrinet.m1")
+        self.saved = (metamodel.transform_processes, metamodel.transform_batch)
+        self.calls = []
+    
+    def tearDown(self):
+        (metamodel.transform_processes, metamodel.transform_batch) = self.saved
+    
+    def skeleton(self):
+        """Creates the rules of petrinetskeleton.py."""
+        M = type("PetrinetsModel", (), self.net.elements)
+        net = self.net
+        calls = self.calls
+        
+        @metamodel.TransformationRule
+        def skeleton(source):
+            r = net.instance()
+            r.identifiers["root"]=petrinet(source.root())
+            return r
             
+        @metamodel.TransformationRule
+        def petrinet(root):
+            for element in root.places:
+                copy_non_interface.later(element)
+            for element in root.transitions:
+                copy_non_interface.later(element)
+            return M.Petrinet()
+        
+        @metamodel.TransformationRule
+        def copy_non_interface(element):
+            calls.append(element)
+            if element.__class__ == M.Place:
+                for edge in element.totransitions:
+                    copy_edge.later(edge)
+                for edge in element.fromtransitions:
+                    copy_edge.later(edge)
+                return M.Place(of=petrinet(element.of), capacity=element.capacity, tokens=element.tokens, name=element.name)
+            elif element.__class__ == M.Transition:
+                return M.Transition(of=petrinet(element.of), name=element.name)
+            else:
+                return None
+        
+        @metamodel.TransformationRule
+        def copy_edge(element):
+            calls.append(element)
+            source = copy_non_interface(element.source)
+            dest = copy_non_interface(element.dest)
+            if source==None or dest==None:
+                return None
+            else:
+                return element.__class__(source=source, dest=dest, weight=element.weight)
+        
+        return skeleton
+    
+    def test_context(self):
+        calls = []
+        
+        @metamodel.TransformationRule
+        def name(place):
+            calls.append(place)
+            return place.name
+        
+        place = self.netin.identifiers["p1"]
+        with metamodel.TransformationContext() as context:
+            self.assertIs(metamodel.current_context(), context)
+            self.assertEqual(name(place), "p1")
+            self.assertEqual(name(place), "p1")
+            self.assertEqual(len(context.cache(name)), 1)
+            with metamodel.TransformationContext():
+                name(place)
+            self.assertIs(metamodel.current_context(), context)
+        self.assertIsNot(metamodel.current_context(), context)
+        self.assertEqual(len(calls), 2)
+        context.clear()
+        self.assertEqual(len(context.results), 0)
+    
+    def test_context_threads(self):
+        barrier = threading.Barrier(2)
+        results = []
+        
+        @metamodel.TransformationRule
+        def outer(root):
+            # Both threads are transforming at the same time.
+            barrier.wait(5)
+            return [inner(place) for place in root.places]
+        
+        @metamodel.TransformationRule
+        def inner(place):
+            return metamodel.current_context()
+        
+        root = self.netin.root()
+        threads = [threading.Thread(target=lambda: results.append(outer(root))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(set(results[0])), 1)
+        self.assertEqual(len(set(results[1])), 1)
+        self.assertIsNot(results[0][0], results[1][0])
+    
+    def test_context_rule_freed(self):
+        class Result:
+            pass
+        
+        @metamodel.TransformationRule
+        def copy(place):
+            for other in place.of.places:
+                copy.later(other)
+            return Result()
+        
+        with metamodel.TransformationContext() as context:
+            result = copy(self.netin.identifiers["p1"])
+            self.assertEqual(len(context.delays), 1)
+            rule = weakref.ref(copy)
+            result = weakref.ref(result)
+            del copy
+            gc.collect()
+            self.assertIsNone(rule())
+            self.assertIsNone(result())
+            self.assertEqual(len(context.results), 0)
+            self.assertEqual(len(context.delays), 0)
+    
+    def test_changes(self):
+        self.net.track()
+        netin = self.net.instance().load("petrinet.m1")
+        self.assertEqual(len(netin.pop_changes()), len(netin.all_of(metamodel.AbstractElement)))
+        p1 = netin.identifiers["p1"]
+        p1.tokens = 3
+        p1.tokens = 3
+        with netin:
+            place = self.net.elements["Place"](of=netin.root())
+        self.assertEqual(netin.pop_changes(), {p1: set(["tokens"]), place: set(), netin.root(): set(["places"])})
+        metamodel.detach(place)
+        self.assertNotIn(place, netin.root().places)
+        self.assertNotIn(place, netin.all_of(metamodel.AbstractElement))
+        self.assertEqual(netin.pop_changes(), {netin.root(): set(["places"])})
+    
+    def test_incremental(self):
+        self.net.track()
+        netin = self.net.instance().load("petrinet.m1")
+        netin.pop_changes()
+        skeleton = self.skeleton()
+        with metamodel.TransformationContext(track=True) as context:
+            result = skeleton(netin)
+            full = len(self.calls)
+            
+            # Changing a place only copies the place and its arcs again.
+            p6 = netin.identifiers["p6"]
+            p5 = netin.identifiers["p5"]
+            p6.tokens = 7
+            p5.tokens = 8
+            del self.calls[:]
+            arcs = len(p5.totransitions) + len(p5.fromtransitions) + len(p6.totransitions) + len(p6.fromtransitions)
+            copy = dict((p.tokens, p) for p in result.root().places)
+            edges = len(copy[4].totransitions) + len(copy[4].fromtransitions)
+            self.assertEqual(context.update(netin.pop_changes()), 2 + arcs)
+            self.assertIs(skeleton(netin), result)
+            self.assertEqual(len(self.calls), 2 + arcs)
+            copy = dict((p.tokens, p) for p in result.root().places)
+            self.assertEqual(sorted(copy), [2, 3, 6, 7, 8])
+            self.assertEqual(copy[7].name, "FiveTokens")
+            self.assertEqual(len(copy[8].totransitions) + len(copy[8].fromtransitions), edges)
+            
+            # Adding a place copies everything again, except the three interface 
+            # elements, as the petrinet rule reads the places and creates the root.
+            with netin:
+                self.net.elements["Place"](of=netin.root(), name="new")
+            del self.calls[:]
+            context.update(netin.pop_changes())
+            result = skeleton(netin)
+            self.assertEqual(len(self.calls), full + 1 - 3)
+            self.assertEqual(len(result.root().places), 6)
+        
+    def test_cache_policies(self):
+        places = [self.netin.identifiers["p{0}".format(i)] for i in range(1, 8)]
+        
+        @metamodel.TransformationRule
+        def unbounded(place):
+            return place.tokens
+        
+        @metamodel.TransformationRule.configure(maxsize=3)
+        def bounded(place):
+            return place.tokens
+        
+        @metamodel.TransformationRule.configure(scope="run")
+        def run(place):
+            return place.tokens
+        
+        with metamodel.TransformationContext() as context:
+            for rule in (unbounded, bounded, run):
+                total = metamodel.TransformationRule(lambda root: sum(rule(place) for place in places + places))
+                self.assertEqual(total(self.netin.root()), 42)
+                self.assertEqual(rule(places[6]), 6)
+            self.assertEqual(unbounded.stats(), dict(hits=8, misses=7, evictions=0, size=7))
+            self.assertEqual(bounded.stats(), dict(hits=1, misses=14, evictions=11, size=3))
+            self.assertEqual(run.stats(), dict(hits=7, misses=8, evictions=0, size=0))
+            self.assertEqual(context.stats()[total], dict(hits=0, misses=1, evictions=0, size=1))
+        
+        with self.assertRaisesRegexp(ValueError, "must be a positive integer"):
+            metamodel.TransformationRule(len, maxsize=0)
+        with self.assertRaisesRegexp(ValueError, "Unknown TransformationRule scope"):
+            metamodel.TransformationRule(len, scope="forever")
+    
+    def test_parallel(self):
+        places = list(self.netin.root().places)
+        
+        @metamodel.TransformationRule
+        def markings(root):
+            for place in root.places:
+                marking.later(place, "/")
+        
+        with metamodel.TransformationContext():
+            markings(self.netin.root())
+            serial = [marking(place, "/") for place in places]
+        metamodel.transform_processes = 3
+        metamodel.transform_batch = 2
+        with metamodel.TransformationContext():
+            markings(self.netin.root())
+            self.assertEqual(marking.stats(), dict(hits=0, misses=7, evictions=0, size=7))
+            parallel = [marking(place, "/") for place in places]
+        self.assertEqual(serial, parallel)
+        self.assertEqual(parallel[0], "p1:1/None")
+        
+        @metamodel.TransformationRule
+        def processes(root):
+            for place in root.places:
+                process.later(place)
+        
+        with metamodel.TransformationContext():
+            processes(self.netin.root())
+            self.assertNotIn(os.getpid(), [process(place) for place in places])
+        
+        with self.assertRaisesRegexp(ValueError, "must be defined at module level"):
+            metamodel.TransformationRule(lambda place: None, parallel=True)
+    
+    def test_retry(self):
+        calls = []
+        
+        @metamodel.TransformationRule
+        def flaky(place):
+            calls.append(place)
+            if len(calls) == 1:
+                raise ValueError("Failing once")
+            return place.name
+        
+        place = self.netin.identifiers["p1"]
+        with metamodel.TransformationContext():
+            with self.assertRaisesRegexp(ValueError, "Failing once"):
+                flaky(place)
+            self.assertEqual(flaky(place), "p1")
+        with metamodel.TransformationContext(track=True):
+            calls.clear()
+            with self.assertRaisesRegexp(ValueError, "Failing once"):
+                flaky(place)
+            self.assertEqual(flaky(place), "p1")
+    
+    def test_parallel_error(self):
+        metamodel.transform_processes = 3
+        metamodel.transform_batch = 2
+        
+        @metamodel.TransformationRule
+        def places(root):
+            for place in root.places:
+                failing.later(place)
+        
+        with metamodel.TransformationContext():
+            with self.assertRaisesRegexp(ValueError, "Failing rule"):
+                places(self.netin.root())
+
+    def test_dot_writer(self):
+        @metamodel.TransformationRule
+        def place2graphviz(place, dot):
+            tag = "p{0}".format(dot.count("place"))
+            dot.write('{0} [label="{1}"];'.format(tag, place.tokens))
+            for arc in place.totransitions:
+                dot.write("{0} -> {1};".format(tag, transition2graphviz(arc.dest, dot)))
+            return tag
+
+        @metamodel.TransformationRule
+        def transition2graphviz(transition, dot):
+            tag = "t{0}".format(dot.count("transition"))
+            dot.write("{0} [shape=square];".format(tag))
+            return tag
+
+        def write(file):
+            with metamodel.DotWriter(file, "model=mds;") as dot:
+                for place in self.netin.root().places:
+                    place2graphviz(place, dot)
+
+        out = io.StringIO()
+        write(out)
+        lines = out.getvalue().split("\n")
+        self.assertEqual(lines[:4], ["digraph {", "model=mds;", 'p0 [label="1"];', "t0 [shape=square];"])
+        self.assertEqual(lines[-2:], ["}", ""])
+
+        # Each writer numbers its nodes and applies the rules in its own 
+        # context, so writing the graph again gives the same output.
+        again = io.StringIO()
+        write(again)
+        self.assertEqual(again.getvalue(), out.getvalue())
+
+        (fd, filename) = tempfile.mkstemp(suffix=".dot.gz")
+        os.close(fd)
+        try:
+            with metamodel.DotWriter.open(filename, "model=mds;") as dot:
+                dot.write("a -> b;")
+            with open(filename, "rb") as f:
+                data = f.read()
+            with metamodel.DotWriter.open(filename, "model=mds;") as dot:
+                dot.write("a -> b;")
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(gzip.decompress(data), b"digraph {\nmodel=mds;\na -> b;\n}\n")
+        finally:
+            os.remove(filename)
+
+class Instrumentation(unittest.TestCase):
+    """Test measuring the hot paths."""
+    
+    def test_report(self):
+        net = metamodel.load("petrinets.m2")
+        events = []
+        init = metamodel.AbstractElement.__init__
+        with metamodel.Instrumentation(lambda *event: events.append(event)) as probe:
+            netin = net.instance().load("petrinet.m1")
+            
+            @metamodel.TransformationRule
+            def tokens(root):
+                return sum(count(place) for place in list(root.places) * 2)
+            
+            @metamodel.TransformationRule
+            def count(place):
+                return place.tokens
+            
+            self.assertEqual(tokens(netin.root()), 42)
+            with self.assertRaisesRegexp(RuntimeError, "already enabled"):
+                metamodel.Instrumentation().enable()
+        self.assertIs(metamodel.AbstractElement.__init__, init)
+        
+        report = probe.report()
+        self.assertEqual(report["construct"]["Place"]["count"], 5)
+        self.assertEqual(report["assign"]["InputArc.source"]["count"], 4)
+        self.assertEqual(report["childlist"]["Petrinet.places"]["count"], 1)
+        self.assertEqual(report["instance"]["parse"]["count"], 1)
+        self.assertEqual(sorted(report["rule-miss"]), ["count", "tokens"])
+        self.assertEqual(report["rule-miss"]["count"]["count"], 7)
+        self.assertEqual(report["rule-hit"]["count"]["count"], 7)
+        self.assertEqual(len(events), sum(e["count"] for kind in report.values() for e in kind.values()))
+        self.assertTrue(all(e["time"] >= 0 for kind in report.values() for e in kind.values()))
+    
+    def test_other_constructions(self):
+        net = metamodel.load("petrinets.m2")
+        netin = net.instance().load("petrinet.m1")
+        (fd, filename) = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        try:
+            netin.save_binary(filename)
+            with metamodel.Instrumentation() as probe:
+                deferred = net.instance().load("petrinet.m1", validate=False)
+                root = deferred.root()
+                net.elements["Place"].bulk(of=[root, root], tokens=[1, 2])
+                lazy = net.instance().load_binary(filename, lazy=True)
+                lazy.identifiers["p4"]
+        finally:
+            os.remove(filename)
+        
+        report = probe.report()
+        self.assertEqual(report["bulk"]["Place"]["count"], 1)
+        # Without validation, and by the lazy snapshot with its parent.
+        self.assertEqual(report["construct"]["Place"]["count"], 5 + 1)
+        self.assertEqual(report["construct"]["Petrinet"]["count"], 1 + 1)
+        self.assertEqual(list(report["materialize"]), ["Place"])
+        self.assertEqual(report["materialize"]["Place"]["count"], 1)
+    
+    def test_disable(self):
+        probe = metamodel.Instrumentation()
+        probe.disable()
+        with probe:
+            pass
+        with metamodel.Instrumentation():
+            pass
+        self.assertIsNone(metamodel.Instrumentation.active)
+    
+    def test_limit_check(self):
+        model = metamodel.MetaModel(
+            'root = MetaModel()\n'
+            'a = Element(of=root, name="A")\n'
+            'b = Element(of=root, name="B")\n'
+            'Association(parent=a, child=b, parentname="a", childname="b", limit=2)\n'
+        )
+        with metamodel.Instrumentation() as probe:
+            instance = model.instance().parse('root = A()\nB(a=root)\nB(a=root)\n')
+            with self.assertRaisesRegexp(KeyError, "exceed its limit"):
+                model.elements["B"](a=instance.root())
+        report = probe.report()["limitcheck"]
+        self.assertEqual(list(report), ["A.b"])
+        self.assertEqual(report["A.b"]["count"], 3)
+        self.assertGreater(report["A.b"]["time"], 0)
+    
+    def test_threads(self):
+        probe = metamodel.Instrumentation()
+        def record():
+            for i in range(10000):
+                probe.record("event", "name", 1.0)
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(probe.report()["event"]["name"], dict(count=40000, time=40000.0))
+
+class Simulation(unittest.TestCase):
+    """Test playing the token game on petrinets."""
+    
+    def setUp(self):
+        self.net = metamodel.load("petrinets.m2")
+        self.netin = self.net.instance().load("petrinet.m1")
+    
+    def test_fire(self):
+        I = self.netin.identifiers
+        simulation = petrinetsimulation.Simulation(self.netin.root())
+        self.assertEqual(simulation.enabled(), [I["t1"], I["t2"]])
+        with self.assertRaisesRegexp(ValueError, "is not enabled"):
+            simulation.fire(I["t"])
+        simulation.fire(I["t2"])
+        self.assertEqual(simulation.tokens(I["p7"]), 5)
+        self.assertEqual(simulation.tokens(I["p5"]), 5)
+        self.assertEqual(simulation.step(), I["t1"])
+        self.assertEqual([simulation.tokens(I[p]) for p in ("p3", "p4", "p5", "p6")], [1, 2, 6, 6])
+        self.assertEqual(I["p3"].tokens, 2)
+        simulation.apply()
+        self.assertEqual(I["p3"].tokens, 1)
+        self.assertEqual(simulation.fired, 2)
+    
+    def test_run(self):
+        root = self.netin.root()
+        simulation = petrinetsimulation.Simulation(root)
+        stepped = petrinetsimulation.Simulation(root)
+        self.assertEqual(simulation.run(5), 5)
+        for i in range(5):
+            stepped.step()
+        self.assertEqual(simulation.marking, stepped.marking)
+        
+        # Random firing is reproducible and stops when no transition is enabled.
+        first = petrinetsimulation.Simulation(root)
+        second = petrinetsimulation.Simulation(root)
+        n = first.run(1000, 42)
+        self.assertEqual(second.run(1000, 42), n)
+        self.assertLess(n, 1000)
+        self.assertEqual(first.marking, second.marking)
+        self.assertEqual(first.enabled(), [])
+        self.assertEqual(first.run(10), 0)
+    
+    def test_capacity(self):
+        M = self.net.elements
+        with self.net.instance():
+            root = M["Petrinet"]()
+            source = M["Place"](of=root, tokens=5)
+            sink = M["Place"](of=root, capacity=3)
+            t = M["Transition"](of=root)
+            M["InputArc"](source=source, dest=t)
+            M["OutputArc"](source=t, dest=sink, weight=2)
+            source.tokens = "5"
+            with self.assertRaisesRegexp(ValueError, "is not an integer"):
+                petrinetsimulation.Simulation(root)
+            source.tokens = 5
+            for (value, error) in ((2.7, "capacity of .* is not an integer: 2.7"),
+                    ("3", "capacity of .* is not an integer"), (-1, "capacity of .* is negative: -1")):
+                sink.capacity = value
+                with self.assertRaisesRegexp(ValueError, error):
+                    petrinetsimulation.Simulation(root)
+            sink.capacity = 3
+        simulation = petrinetsimulation.Simulation(root)
+        self.assertEqual(simulation.run(10), 1)
+        self.assertEqual(list(simulation.marking), [4, 2])
+        self.assertFalse(simulation.is_enabled(t))
+
+class Reachability(unittest.TestCase):
+    """Test exploring the reachable markings of petrinets."""
+    
+    def setUp(self):
+        self.net = metamodel.load("petrinets.m2")
+        self.netin = self.net.instance().load("petrinet.m1")
+    
+    def ring(self, places, tokens):
+        """Creates a ring of places, with a token in the first ones."""
+        M = self.net.elements
+        with self.net.instance():
+            root = M["Petrinet"]()
+            ring = [M["Place"](of=root, tokens=1 if i < tokens else 0) for i in range(places)]
+            for i in range(places):
+                t = M["Transition"](of=root)
+                M["InputArc"](source=ring[i], dest=t)
+                M["OutputArc"](source=t, dest=ring[(i+1) % places])
+        return (root, ring)
+    
+    def test_explore(self):
+        I = self.netin.identifiers
+        space = petrinetreachability.StateSpace(self.netin.root())
+        report = space.explore()
+        self.assertEqual((report["states"], report["edges"], report["deadlocks"]), (21, 32, 1))
+        self.assertTrue(report["bounded"])
+        self.assertTrue(report["complete"])
+        (deadlock,) = space.deadlocks
+        self.assertEqual(space.marking(deadlock)[I["p5"]], 12)
+        self.assertEqual(space.bounds()[I["p6"]], 7)
+        self.assertTrue(space.covers({I["p5"]: 12, I["p2"]: 0}))
+        self.assertFalse(space.covers({I["p5"]: 13}))
+        
+        # The other orders and storage find the same states.
+        states = set(space.states)
+        for kwargs in (dict(order="depth"), dict(memory=1000)):
+            other = petrinetreachability.StateSpace(self.netin.root(), **kwargs)
+            self.assertEqual(other.explore()["states"], 21)
+            self.assertEqual(set(other.states), states)
+        self.assertIsNotNone(other.states.db)
+        
+        limited = petrinetreachability.StateSpace(self.netin.root(), limit=5)
+        self.assertFalse(limited.explore()["complete"])
+    
+    def test_unbounded(self):
+        M = self.net.elements
+        with self.net.instance():
+            root = M["Petrinet"]()
+            source = M["Place"](of=root, tokens=1)
+            sink = M["Place"](of=root, tokens=250)
+            bounded = M["Place"](of=root, capacity=2)
+            t = M["Transition"](of=root)
+            M["InputArc"](source=source, dest=t)
+            M["OutputArc"](source=t, dest=source)
+            M["OutputArc"](source=t, dest=sink, weight=3)
+            u = M["Transition"](of=root)
+            M["OutputArc"](source=u, dest=bounded)
+        space = petrinetreachability.StateSpace(root)
+        report = space.explore()
+        self.assertFalse(report["bounded"])
+        self.assertTrue(report["complete"])
+        bounds = space.bounds()
+        self.assertEqual((bounds[source], bounds[sink], bounds[bounded]), (1, petrinetreachability.omega, 2))
+        self.assertTrue(space.covers({sink: 10**6, bounded: 2}))
+        self.assertFalse(space.covers({source: 2}))
+    
+    def test_widen(self):
+        M = self.net.elements
+        with self.net.instance():
+            root = M["Petrinet"]()
+            source = M["Place"](of=root, tokens=100)
+            sink = M["Place"](of=root, tokens=200)
+            t = M["Transition"](of=root)
+            M["InputArc"](source=source, dest=t)
+            M["OutputArc"](source=t, dest=sink)
+        for memory in (None, 1000):
+            space = petrinetreachability.StateSpace(root, memory=memory)
+            self.assertEqual(space.typecode, "B")
+            self.assertEqual(space.explore()["states"], 101)
+            self.assertEqual(space.typecode, "H")
+            self.assertEqual(space.bounds()[sink], 300)
+            self.assertTrue(space.bounded())
+    
+    def test_parallel(self):
+        (root, ring) = self.ring(12, 4)
+        serial = petrinetreachability.StateSpace(root)
+        parallel = petrinetreachability.StateSpace(root, processes=3, batch=50)
+        self.assertEqual(serial.explore()["states"], 1365)
+        self.assertEqual(parallel.explore()["states"], 1365)
+        self.assertEqual(list(serial.states), list(parallel.states))
+        self.assertEqual(serial.edges, parallel.edges)
+
+class Flattening(unittest.TestCase):
+    """Test flattening composed petrinets."""
+    
+    def setUp(self):
+        self.composed = metamodel.load("composedpetrinets.m2")
+        self.net = metamodel.load("petrinets.m2")
+    
+    def test_sample(self):
+        netin = composedpetrinet2petrinet.flatten(self.composed.instance().load("composedpetrinet.m1"))
+        root = netin.root()
+        self.assertEqual([p.tokens for p in root.places], [1, 0, 0])
+        (ready, full, done) = root.places
+        (handover, consume) = root.transitions
+        self.assertEqual((full.name, full.capacity), ("full", 2))
+        self.assertEqual(handover.name, "handover")
+        self.assertEqual([a.dest for a in handover.toplaces], [ready, full])
+        self.assertEqual([a.source for a in consume.fromplaces], [full])
+        
+        # The result is a valid instance of petrinets.m2.
+        simulation = petrinetsimulation.Simulation(root)
+        simulation.run(2)
+        self.assertEqual(simulation.tokens(full), 2)
+        self.assertFalse(simulation.is_enabled(handover))
+        self.assertEqual(simulation.step(), consume)
+        self.assertEqual(simulation.tokens(done), 1)
+    
+    def test_freed(self):
+        # Neither the source nor the result is kept alive by the rules.
+        refs = []
+        for i in range(3):
+            source = self.composed.instance().load("composedpetrinet.m1")
+            target = composedpetrinet2petrinet.flatten(source, self.net)
+            refs += [weakref.ref(source.root()), weakref.ref(target.root())]
+            del source, target
+        gc.collect()
+        self.assertEqual([ref() for ref in refs], [None] * 6)
+    
+    def test_nested(self):
+        M = self.composed.elements
+        with self.composed.instance() as instance:
+            instance.identifiers["root"] = top = M["Async"]()
+            sync = M["Sync"](of=top)
+            nets = [M["Petrinet"](of=parent, name=name) for (parent, name) in ((sync, "a"), (sync, "b"), (top, "c"))]
+            places = [M["InterfacePlace"](of=net, name="p", tokens=i+1, capacity=None if i else 5) for (i, net) in enumerate(nets)]
+            transitions = [M["InterfaceTransition"](of=net, name="t") for net in nets]
+            unnamed = [M["InterfaceTransition"](of=net) for net in nets[:2]]
+            for (place, transition) in zip(places, transitions):
+                M["InputArc"](source=place, dest=transition, weight=2)
+        root = composedpetrinet2petrinet.flatten(instance).root()
+        
+        # The places are fused by the Async composition, but only the
+        # transitions of 'a' and 'b' are fused by the Sync composition.
+        (place,) = root.places
+        self.assertEqual((type(place).__name__, place.tokens, place.capacity), ("InterfacePlace", 6, 5))
+        self.assertEqual([t.name for t in root.transitions], ["t", None, None, "t"])
+        self.assertEqual([len(t.fromplaces) for t in root.transitions], [2, 0, 0, 1])
+        self.assertEqual(len(place.totransitions), 3)
+
+class DeclareChecker(unittest.TestCase):
+    """Test checking event logs against Declare models."""
+    
+    def setUp(self):
+        self.declare = metamodel.load("declare.m2")
+        self.declarein = self.declare.instance().load("declare.m1")
+        self.traces = [
+            ["examine patient", "check X-ray risk", "perform x-ray", "apply cast", "remove cast", 
+             "Twice", "Twice", "ThreeToFive", "Other1", "ThreeToFive", "ThreeToFive"],
+            ["perform surgery"],
+        ]
+    
+    def test_check(self):
+        checker = declarechecker.Checker(self.declarein.root())
+        self.assertEqual(len(checker.constraints), 14)
+        self.assertEqual(checker.check(self.traces[0]), 
+            ["NotChainSuccession(Twice, ThreeToFive)", "Exclusive(2 of Twice, ThreeToFive, Other1, Other2, Other3)"])
+        self.assertEqual(checker.check([]), ["Init(examine patient)", "Existence(Twice, 2)", "Existence(ThreeToFive, 3)", 
+            "Choice(1 of perform surgery, reposition, prescribe sling, apply cast)", 
+            "Exclusive(2 of Twice, ThreeToFive, Other1, Other2, Other3)"])
+        self.assertEqual((checker.traces, checker.events, checker.violating), (2, 11, 2))
+        self.assertEqual(checker.violations[checker.constraints.index("Init(examine patient)")], 1)
+    
+    def test_shared_automata(self):
+        D = self.declare.elements
+        with self.declare.instance() as instance:
+            instance.identifiers["root"] = root = D["DeclareDiagram"]()
+            for name in ("a", "b"):
+                D["Activity"](of=root, name=name, existence=2, absence=3)
+        checker = declarechecker.Checker(root)
+        self.assertEqual(checker.initial[0], checker.initial[2])
+        self.assertEqual(checker.initial[1], checker.initial[3])
+        self.assertEqual(checker.check(["a", "a", "b"]), ["Existence(b, 2)"])
+    
+    def test_run(self):
+        checker = declarechecker.Checker(self.declarein.root())
+        for trace in self.traces * 50:
+            checker.check(trace)
+        expected = checker.report()
+        
+        (fd, events) = tempfile.mkstemp(suffix=".csv")
+        (fd2, traces) = tempfile.mkstemp(suffix=".csv.gz")
+        os.close(fd2)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("activity,case,time\n")
+                for (i, trace) in enumerate(self.traces * 50):
+                    for activity in trace:
+                        f.write('"{0}",{1},0\n'.format(activity, i))
+            with gzip.open(traces, "wt") as f:
+                for trace in self.traces * 50:
+                    f.write(",".join(trace) + "\n\n")
+            runs = [(events, "events", 1), (traces, "traces", 1), (events, "events", 3), (traces, "traces", 2)]
+            for (filename, format, processes) in runs:
+                checker = declarechecker.Checker(self.declarein.root())
+                report = checker.run(filename, format, processes=processes, chunk=7)
+                for key in ("traces", "events", "violating", "constraints"):
+                    self.assertEqual(report[key], expected[key])
+            with self.assertRaisesRegexp(ValueError, "no column 'case'"):
+                checker.run(traces)
+        finally:
+            os.remove(events)
+            os.remove(traces)
+
 if __name__ == '__main__':
     unittest.main()
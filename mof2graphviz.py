@@ -21,8 +21,10 @@ import os
 
 if len(sys.argv)==1:
     sys.argv.append("-")
-if len(sys.argv)!=2 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
-    print("Usage: {0} [filename.m1|-]".format(sys.argv[0]))
+if len(sys.argv)==2:
+    sys.argv.append("-")
+if len(sys.argv)!=3 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
+    print("Usage: {0} [filename.m1|- [output.dot|output.dot.gz|-]]".format(sys.argv[0]))
     sys.exit(1)
 
 import metamodel
@@ -31,27 +33,20 @@ net = metamodel.load("mof.m3")
 netin = net.instance().load(sys.argv[1])
 
 @metamodel.TransformationRule
-def metamodel2graphviz(metamodel):
-    global attributecount, associationcount
-    attributecount=0
-    associationcount=0
-    r = ["digraph {", "overlap=false;", "splines=true;", "edge[fontsize=12, len=1];", "model=mds;"]
-    r.append("// Elements:")
+def metamodel2graphviz(metamodel, dot):
+    dot.write("// Elements:")
     for element in metamodel.elements:
-        element2graphviz(element, r)
+        element2graphviz(element, dot)
 
-    r.append("\n// Associations:")
+    dot.write("\n// Associations:")
     for element in metamodel.elements:
         for a in element.childlist:
-            association2graphviz(a, r)
-
-    r.append("}\n")
-    return "\n".join(r)
+            association2graphviz(a, dot)
 
 @metamodel.TransformationRule
-def element2graphviz(element, r):
+def element2graphviz(element, dot):
     if element.extends!=None:
-        r.append('{1}:T -> {0}:T [arrowtail=onormal, dir=back, len=.5];'.format(element.name, element.extends.name))
+        dot.write('{1}:T -> {0}:T [arrowtail=onormal, dir=back, len=.5];'.format(element.name, element.extends.name))
     if len(element.attributes) > 0:
         attrlist = '<TR><TD ALIGN="LEFT" BALIGN="LEFT"><FONT POINT-SIZE="12">{0}</FONT></TD></TR>'.format(r"<BR/>".join([a.name for a in element.attributes]))
     else:
@@ -61,25 +56,24 @@ def element2graphviz(element, r):
     else:
         name = element.name
     label = '<<TABLE PORT="T" BORDER="0" CELLBORDER="1" CELLSPACING="0"><TR><TD>{0}</TD></TR>{1}</TABLE>>'.format(name, attrlist)
-    r.append('{0} [shape=none, label={1}];'.format(element.name, label))
-    r.append("")
+    dot.write('{0} [shape=none, label={1}];'.format(element.name, label))
+    dot.write("")
 
 @metamodel.TransformationRule
-def association2graphviz(a, r):
-    global associationcount
-    associationcount += 1
-    dummy="_assoc_{0}".format(associationcount)
-    r.append(r'{0} [shape=point, label="", width=0, height=0]'.format(dummy))
-    r.append(r'{0}:T -> {1} [arrowtail=vee, dir=back, label="{2}\n{3}", len=.3];'.format(
+def association2graphviz(a, dot):
+    dummy="_assoc_{0}".format(dot.count("association")+1)
+    dot.write(r'{0} [shape=point, label="", width=0, height=0]'.format(dummy))
+    dot.write(r'{0}:T -> {1} [arrowtail=vee, dir=back, label="{2}\n{3}", len=.3];'.format(
         a.parent.name, dummy, 
         a.parentname, "0..1" if a.optional else "1",
     ))
-    r.append(r'{0} -> {1}:T [dir=none, label="{2}\n{3}", len=.3];'.format(
+    dot.write(r'{0} -> {1}:T [dir=none, label="{2}\n{3}", len=.3];'.format(
         dummy, a.child.name, 
         a.childname, "0..{0}".format(a.limit) if a.limit!=None else "*", 
     ))
-    r.append(r'{0}:T -> {1}:T [color=none, len=1.4];'.format(
+    dot.write(r'{0}:T -> {1}:T [color=none, len=1.4];'.format(
         a.parent.name, a.child.name,
     ))
 
-print(metamodel2graphviz(netin.root()))
+with metamodel.DotWriter.open(sys.argv[2], "overlap=false;", "splines=true;", "edge[fontsize=12, len=1];", "model=mds;") as dot:
+    metamodel2graphviz(netin.root(), dot)
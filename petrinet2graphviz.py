@@ -21,8 +21,10 @@ import os
 
 if len(sys.argv)==1:
     sys.argv.append("-")
-if len(sys.argv)!=2 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
-    print("Usage: {0} [filename.m1|-]".format(sys.argv[0]))
+if len(sys.argv)==2:
+    sys.argv.append("-")
+if len(sys.argv)!=3 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
+    print("Usage: {0} [filename.m1|- [output.dot|output.dot.gz|-]]".format(sys.argv[0]))
     sys.exit(1)
 
 import metamodel
@@ -33,35 +35,29 @@ netin = net.instance().load(sys.argv[1])
 M=type("PetrinetsModel", (), net.elements)
 
 @metamodel.TransformationRule
-def petrinet2graphviz(petrinet):
-    global elementcount
-    elementcount=0
-    r = ["digraph {", "overlap=false", "model=mds"]
-    r.append("// Places:")
+def petrinet2graphviz(petrinet, dot):
+    dot.write("// Places:")
     for place in petrinet.places:
-        element2graphviz(place, r, "circle")
-    r.append("\n// Transitions:")
+        element2graphviz(place, dot, "circle")
+    dot.write("\n// Transitions:")
     for transition in petrinet.transitions:
-        element2graphviz(transition, r, "square")
-    r.append("\n// Edges:")
+        element2graphviz(transition, dot, "square")
+    dot.write("\n// Edges:")
     for place in petrinet.places:
         for edge in place.totransitions:
-            edge2graphviz(edge, r)
+            edge2graphviz(edge, dot)
         for edge in place.fromtransitions:
-            edge2graphviz(edge, r)
-    r.append("}\n")
-    return "\n".join(r)
+            edge2graphviz(edge, dot)
 
 @metamodel.TransformationRule
-def element2graphviz(element,r,shape):
-    global elementcount
+def element2graphviz(element,dot,shape):
     a = ["shape={0}".format(shape)]
     
-    tag = "place_{0}".format(elementcount)
-    nametag = "cluster_p{0}".format(elementcount)
-    elementcount += 1
+    count = dot.count("element")
+    tag = "place_{0}".format(count)
+    nametag = "cluster_p{0}".format(count)
     if element.name!=None and element.name!="":
-        r.append('subgraph {0} {{ label="{1}"; color=none; fontsize=12;'.format(nametag, element.name))
+        dot.write('subgraph {0} {{ label="{1}"; color=none; fontsize=12;'.format(nametag, element.name))
     if isinstance(element, M.InterfacePlace) or isinstance(element, M.InterfaceTransition):
         a.append('penwidth=3')
     
@@ -76,17 +72,18 @@ def element2graphviz(element,r,shape):
     else:
         a.append('label=""')
         
-    r.append('{0} [{1}];'.format(tag, ",".join(a)))
+    dot.write('{0} [{1}];'.format(tag, ",".join(a)))
     if element.name!=None and element.name!="":
-        r.append('}')
+        dot.write('}')
     return tag
 
 @metamodel.TransformationRule
-def edge2graphviz(edge, r):
+def edge2graphviz(edge, dot):
     a=["len=1"]
     if edge.weight!=None and edge.weight!=1:
         a.append('label="{0}"'.format(edge.weight))
-    r.append("{0} -> {1} [{2}];".format(element2graphviz(edge.source), element2graphviz(edge.dest), ",".join(a)))
+    dot.write("{0} -> {1} [{2}];".format(element2graphviz(edge.source), element2graphviz(edge.dest), ",".join(a)))
     
 
-print(petrinet2graphviz(netin.root()))
+with metamodel.DotWriter.open(sys.argv[2], "overlap=false", "model=mds") as dot:
+    petrinet2graphviz(netin.root(), dot)
@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+#
+# Explores the reachable markings of petrinets.
+# Copyright (C) 2010  Bauke Conijn
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import gc
+import resource
+import sqlite3
+import time
+from collections import deque
+
+import metamodel
+from petrinetsimulation import Simulation, unbounded
+
+# The number of tokens of a place that can contain arbitrarily many tokens,
+# as returned by StateSpace.marking.
+omega = float("inf")
+
+# The typecodes used for encoding markings, from narrow to wide. The largest
+# value of each typecode stands for omega.
+typecodes = "BHIQ"
+
+
+class States:
+    """The encoded markings of the states of a StateSpace, numbered in the
+    order in which they are added. They are kept in a dictionary, until
+    they use more than 'memory' bytes. Then they are moved to a temporary
+    SQLite database, which is stored on disk."""
+
+    # The estimated number of bytes used per state, besides its marking.
+    overhead = 120
+
+    def __init__(self, memory=None):
+        self.index = dict()
+        self.keys = []
+        self.db = None
+        self.count = 0
+        self.memory = memory
+        self.size = 0
+
+    def add(self, key):
+        """Adds the encoded marking 'key', unless it is present already.
+        Returns its number and whether it was added."""
+        if self.db is None:
+            n = self.count
+            i = self.index.setdefault(key, n)
+            if i != n:
+                return (i, False)
+            self.keys.append(key)
+            self.count = n + 1
+            self.size += len(key) + self.overhead
+            if self.memory is not None and self.size > self.memory:
+                self.spill()
+            return (n, True)
+        cursor = self.db.execute("INSERT OR IGNORE INTO states VALUES (?, ?)", (self.count, key))
+        if cursor.rowcount == 0:
+            return (self.db.execute("SELECT id FROM states WHERE marking = ?", (key,)).fetchone()[0], False)
+        self.count += 1
+        return (self.count - 1, True)
+
+    def spill(self):
+        """Moves the states to the database."""
+        # An empty filename creates a temporary database on disk. Its cache
+        # is limited to about 2 MB.
+        self.db = sqlite3.connect("")
+        self.db.execute("PRAGMA cache_size = -2000")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE states (id INTEGER PRIMARY KEY, marking BLOB UNIQUE)")
+        self.db.executemany("INSERT INTO states VALUES (?, ?)", enumerate(self.keys))
+        self.index = None
+        self.keys = None
+
+    def __getitem__(self, i):
+        if self.db is None:
+            return self.keys[i]
+        return self.db.execute("SELECT marking FROM states WHERE id = ?", (i,)).fetchone()[0]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.db is None:
+            return iter(self.keys)
+        return (key for (key,) in self.db.execute("SELECT marking FROM states ORDER BY id"))
+
+    def recode(self, convert):
+        """Returns a States containing 'convert(key)' for each key, with
+        the same numbers."""
+        states = States(self.memory)
+        if self.db is not None:
+            states.spill()
+        for key in self:
+            states.add(convert(key))
+        return states
+
+
+class Expansion:
+    """The tables of a Simulation that are needed to compute the successors
+    of markings, encoded with 'typecode', in which 'omega' stands for 
+    arbitrarily many tokens. Unlike a Simulation, it can be pickled, such 
+    that it can be sent to worker processes."""
+
+    def __init__(self, simulation, typecode, omega):
+        self.transitions = len(simulation.transitions)
+        self.boundstart = simulation.boundstart
+        self.boundplace = simulation.boundplace
+        self.boundlow = simulation.boundlow
+        self.boundhigh = simulation.boundhigh
+        self.effectstart = simulation.effectstart
+        self.effectplace = simulation.effectplace
+        self.effectdelta = simulation.effectdelta
+        self.typecode = typecode
+        self.omega = omega
+
+    def successors(self, marking):
+        """Returns the transitions that are enabled in 'marking', a list of
+        integers, paired with the marking that results from firing them.
+        Raises an OverflowError if a marking does not fit the encoding."""
+        boundstart = self.boundstart
+        boundplace = self.boundplace
+        boundlow = self.boundlow
+        boundhigh = self.boundhigh
+        effectstart = self.effectstart
+        effectplace = self.effectplace
+        effectdelta = self.effectdelta
+        omega = self.omega
+        result = []
+        for t in range(self.transitions):
+            for b in range(boundstart[t], boundstart[t+1]):
+                v = marking[boundplace[b]]
+                if v < boundlow[b] or v > boundhigh[b]:
+                    break
+            else:
+                successor = marking[:]
+                for k in range(effectstart[t], effectstart[t+1]):
+                    p = effectplace[k]
+                    v = successor[p]
+                    if v != omega:
+                        v += effectdelta[k]
+                        if v >= omega:
+                            raise OverflowError("Marking does not fit in '{0}'".format(self.typecode))
+                        successor[p] = v
+                result.append((t, successor))
+        return result
+
+    def expand(self, keys):
+        """Returns the successors of each of the encoded markings 'keys'."""
+        result = []
+        for key in keys:
+            marking = array.array(self.typecode)
+            marking.frombytes(key)
+            result.append(self.successors(marking.tolist()))
+        return result
+
+
+class StateSpace:
+    """Explores the markings that are reachable from the initial marking of
+    a Petrinet element of an instance of petrinets.m2, as compiled by a
+    Simulation. Each marking is encoded as a fixed-width array of unsigned
+    integers. The width is the smallest that fits the initial marking and
+    the capacities and is increased when a marking does not fit. The
+    encoded markings are numbered and deduplicated by States.
+
+    To make the state space finite, the exploration follows the Karp-Miller
+    construction: if a marking covers a marking on the path that led to it,
+    with more tokens in some places, these places can contain arbitrarily
+    many tokens, which is represented by omega. Places with a capacity are
+    never set to omega and must have the same number of tokens. If the
+    number of tokens in the places without capacity can not increase, this
+    step is skipped. The resulting state space answers boundedness,
+    deadlock and coverability questions.
+
+    With 'order="depth"', the markings are explored depth-first instead of
+    breadth-first. With 'limit', the exploration stops after finding that
+    many states. With 'memory', the states are moved to disk once they use
+    more than that many bytes. The numbers of the parents of the states and
+    their sizes remain in memory, using 20 bytes per state.
+    With 'processes' more than 1, batches of 'batch' states are expanded by
+    that many worker processes, see metamodel.worker_pool. This only pays off for nets with
+    many transitions."""
+
+    def __init__(self, petrinet, order="breadth", limit=None, memory=None, processes=1, batch=10000):
+        if order not in ("breadth", "depth"):
+            raise ValueError("Unknown order '{0}'".format(order))
+        self.simulation = simulation = petrinet if isinstance(petrinet, Simulation) else Simulation(petrinet)
+        self.order = order
+        self.limit = limit
+        self.memory = memory
+        self.processes = processes
+        self.batch = batch
+        if min(simulation.marking, default=0) < 0:
+            raise ValueError("The initial marking contains a negative number of tokens")
+
+        # Whether places can contain arbitrarily many tokens.
+        self.capacity = capacity = simulation.capacity
+        increase = [0] * len(simulation.transitions)
+        for t in range(len(increase)):
+            for k in range(simulation.effectstart[t], simulation.effectstart[t+1]):
+                if capacity[simulation.effectplace[k]] == unbounded:
+                    increase[t] += simulation.effectdelta[k]
+        self.accelerate = any(i > 0 for i in increase)
+
+        # The encoding of the markings
+        largest = max([0] + list(simulation.marking) + [c for c in capacity if c != unbounded])
+        for typecode in typecodes:
+            self.setwidth(typecode)
+            if largest < self.omega:
+                break
+        self.states = None
+
+    def setwidth(self, typecode):
+        """Sets the typecode used to encode markings. The value standing
+        for omega is at most 'unbounded', such that it is within the bounds 
+        of places without capacity."""
+        self.typecode = typecode
+        self.omega = min(256 ** array.array(typecode).itemsize - 1, unbounded)
+        self.expansion = Expansion(self.simulation, typecode, self.omega)
+
+    def encode(self, marking):
+        """Returns the marking 'marking', a list of integers, as bytes."""
+        return array.array(self.typecode, marking).tobytes()
+
+    def decode(self, key, typecode=None):
+        """Returns the marking encoded by 'key' as list of integers."""
+        marking = array.array(typecode or self.typecode)
+        marking.frombytes(key)
+        return marking.tolist()
+
+    def successors(self, marking):
+        """Returns the transitions that are enabled in 'marking', a list of
+        integers, paired with the marking that results from firing them.
+        Raises an OverflowError if a marking does not fit the encoding."""
+        return self.expansion.successors(marking)
+
+    def size(self, marking):
+        """Returns the number of places containing omega in 'marking' and
+        the number of tokens in the other places. If a marking covers 
+        another marking and has more tokens in a place that does not 
+        contain omega, its size is larger."""
+        omega = self.omega
+        omegas = marking.count(omega)
+        return (omegas, sum(marking) - omegas * omega)
+
+    def __accelerate(self, parent, successor, size):
+        """Sets the places of 'successor' that have more tokens than in a
+        marking it covers on the path to 'parent' to omega. Returns the new
+        size of 'successor'."""
+        capacity = self.capacity
+        omega = self.omega
+        parents = self.parents
+        omegas = self.omegas
+        totals = self.totals
+        while parent >= 0:
+            if (omegas[parent], totals[parent]) < size:
+                ancestor = self.decode(self.states[parent])
+                if all(a <= b if capacity[p] == unbounded else a == b for (p, (a, b)) in enumerate(zip(ancestor, successor))):
+                    for (p, (a, b)) in enumerate(zip(ancestor, successor)):
+                        if a < b:
+                            successor[p] = omega
+                    size = self.size(successor)
+            parent = parents[parent]
+        return size
+
+    def __widen(self):
+        """Encodes the markings with the next wider typecode. Places that
+        contain omega keep containing omega."""
+        (typecode, old) = (self.typecode, self.omega)
+        self.setwidth(typecodes[typecodes.index(typecode) + 1])
+        new = self.omega
+        def convert(key):
+            return self.encode([new if v == old else v for v in self.decode(key, typecode)])
+        self.states = self.states.recode(convert)
+
+    def explore(self):
+        """Explores the reachable markings and returns a report, see
+        'report'."""
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+
+        self.states = States(self.memory)
+        # The parent, the number of places containing omega and the number
+        # of tokens in the other places of each state.
+        self.parents = array.array("q")
+        self.omegas = array.array("I")
+        self.totals = array.array("d")
+        self.edges = 0
+        self.deadlocks = array.array("q")
+        initial = list(self.simulation.marking)
+        self.states.add(self.encode(initial))
+        self.parents.append(-1)
+        self.omegas.append(0)
+        self.totals.append(sum(initial))
+        frontier = deque([0])
+        take = frontier.popleft if self.order == "breadth" else frontier.pop
+        limit = self.limit
+
+        self.complete = True
+        pool = metamodel.worker_pool(self.processes) if self.processes > 1 else None
+        try:
+            while frontier:
+                if limit is not None and len(self.states) >= limit:
+                    self.complete = False
+                    break
+                if self.processes > 1 and len(frontier) >= self.batch:
+                    ids = [take() for i in range(self.batch)]
+                else:
+                    ids = [take()]
+                while True:
+                    try:
+                        if len(ids) > 1:
+                            expanded = self.__expand_parallel(pool, [self.states[i] for i in ids])
+                        else:
+                            expanded = [self.successors(self.decode(self.states[ids[0]]))]
+                        break
+                    except OverflowError:
+                        self.__widen()
+                for (i, successors) in zip(ids, expanded):
+                    if not successors:
+                        self.deadlocks.append(i)
+                    for (t, successor) in successors:
+                        self.edges += 1
+                        self.__add(i, successor, frontier)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        self.seconds = time.time() - start
+        self.peak = max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+        return self.report()
+
+    def __add(self, parent, successor, frontier):
+        """Adds the state reached from 'parent' with marking 'successor'."""
+        size = self.size(successor)
+        if self.accelerate:
+            size = self.__accelerate(parent, successor, size)
+        (n, added) = self.states.add(self.encode(successor))
+        if added:
+            self.parents.append(parent)
+            self.omegas.append(size[0])
+            self.totals.append(size[1])
+            frontier.append(n)
+
+    def __expand_parallel(self, pool, keys):
+        """Returns the successors of the encoded markings 'keys', computed
+        by the worker processes of 'pool'."""
+        size = -(-len(keys) // self.processes)
+        futures = [pool.submit(self.expansion.expand, keys[i:i+size]) for i in range(0, len(keys), size)]
+        return [successors for future in futures for successors in future.result()]
+
+    def marking(self, state):
+        """Returns the marking of state number 'state' as a dictionary from
+        places to tokens. Places that can contain arbitrarily many tokens
+        have omega tokens."""
+        return {p: omega if v == self.omega else v for (p, v) in zip(self.simulation.places, self.decode(self.states[state]))}
+
+    def bounds(self):
+        """Returns a dictionary mapping each place to the largest number of
+        tokens it contains in a reachable marking, which is omega if it is
+        unbounded."""
+        largest = [0] * len(self.simulation.places)
+        for key in self.states:
+            largest = list(map(max, largest, self.decode(key)))
+        return {p: omega if v == self.omega else v for (p, v) in zip(self.simulation.places, largest)}
+
+    def bounded(self):
+        """Returns whether the number of tokens in each place is bounded."""
+        return all(v != omega for v in self.bounds().values())
+
+    def covers(self, target):
+        """Returns whether a marking can be reached in which each place in
+        the dictionary 'target' contains at least the given number of
+        tokens."""
+        index = self.simulation.placeindex
+        needed = [(index[p], tokens) for (p, tokens) in target.items()]
+        omega = self.omega
+        for key in self.states:
+            marking = self.decode(key)
+            if all(marking[i] >= tokens or marking[i] == omega for (i, tokens) in needed):
+                return True
+        return False
+
+    def report(self):
+        """Returns the results of the exploration as a dictionary: the
+        number of states and edges, the number of deadlocks, whether the
+        net is bounded, whether the exploration was complete, how long it
+        took, how many states were found per second and by how much it
+        increased the peak memory usage of this process in bytes."""
+        return dict(
+            states=len(self.states),
+            edges=self.edges,
+            deadlocks=len(self.deadlocks),
+            bounded=self.bounded(),
+            complete=self.complete,
+            seconds=self.seconds,
+            states_per_second=len(self.states)/self.seconds if self.seconds else None,
+            peak_bytes=self.peak,
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Explores the reachable markings of a petrinet.")
+    parser.add_argument("filename", nargs="?", default="-", help="the petrinet instance (default: standard input)")
+    parser.add_argument("--depth", action="store_true", help="explore depth-first instead of breadth-first")
+    parser.add_argument("--limit", type=int, help="stop after finding this many states")
+    parser.add_argument("--memory", type=int, help="move the states to disk when they use more than this many bytes")
+    parser.add_argument("--processes", type=int, default=1, help="the number of worker processes")
+    args = parser.parse_args()
+
+    import metamodel
+
+    net = metamodel.load("petrinets.m2")
+    netin = net.instance().load(args.filename)
+
+    space = StateSpace(netin.root(), "depth" if args.depth else "breadth", args.limit, args.memory, args.processes)
+    for (name, value) in sorted(space.explore().items()):
+        print("{0}: {1}".format(name, value))
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+#
+# Plays the token game on petrinets.
+# Copyright (C) 2010  Bauke Conijn
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import heapq
+import random
+import sys
+
+# Upper bound of the number of tokens in a place without a capacity.
+unbounded = sys.maxsize
+
+
+class Simulation:
+    """Plays the token game on a Petrinet element of an instance of
+    petrinets.m2. The net is compiled into arrays of integers: the marking,
+    the change in tokens caused by each transition and, for each transition,
+    the bounds on the tokens of the places it depends on. A transition is
+    enabled if each of its input places contains at least the weight of its
+    arcs in tokens and firing it does not cause a place to exceed its
+    capacity. Arcs without a weight have weight 1.
+
+    For each transition, the number of its bounds that are violated is
+    maintained. Firing a transition only checks the bounds on the places
+    whose tokens it changes, such that the cost of a firing does not depend
+    on the size of the net. The enabled transitions are kept in a list,
+    from which the next transition can be picked at random.
+
+    The places of the net are not changed while simulating. 'apply()' sets
+    their tokens to the current marking."""
+
+    def __init__(self, petrinet):
+        self.places = places = list(petrinet.places)
+        self.transitions = transitions = list(petrinet.transitions)
+        placeindex = {p: i for (i, p) in enumerate(places)}
+        transitionindex = {t: i for (i, t) in enumerate(transitions)}
+
+        # The initial marking and the capacities
+        self.marking = array.array("q", (integer(p.tokens, 0, p, "tokens") for p in places))
+        self.capacity = capacity = [bound(p) for p in places]
+
+        # The incidence of each transition, as place -> weight dictionaries
+        inputs = [dict() for t in transitions]
+        outputs = [dict() for t in transitions]
+        for (i, p) in enumerate(places):
+            for arc in p.totransitions:
+                t = lookup(transitionindex, arc.dest, arc)
+                inputs[t][i] = inputs[t].get(i, 0) + integer(arc.weight, 1, arc, "weight")
+            for arc in p.fromtransitions:
+                t = lookup(transitionindex, arc.source, arc)
+                outputs[t][i] = outputs[t].get(i, 0) + integer(arc.weight, 1, arc, "weight")
+
+        # The changes in tokens caused by the transitions and the bounds on
+        # the tokens of the places they depend on, stored consecutively. 
+        # Those of transition t start at effectstart[t] and boundstart[t]
+        # and end before effectstart[t+1] and boundstart[t+1].
+        self.effectstart = effectstart = array.array("q", [0])
+        self.effectplace = effectplace = array.array("q")
+        self.effectdelta = effectdelta = array.array("q")
+        self.boundstart = boundstart = array.array("q", [0])
+        self.boundplace = boundplace = array.array("q")
+        self.boundlow = boundlow = array.array("q")
+        self.boundhigh = boundhigh = array.array("q")
+        self.boundtransition = boundtransition = array.array("q")
+        for (t, (pre, post)) in enumerate(zip(inputs, outputs)):
+            for i in sorted(set(pre) | set(post)):
+                delta = post.get(i, 0) - pre.get(i, 0)
+                if delta:
+                    effectplace.append(i)
+                    effectdelta.append(delta)
+                low = pre.get(i, 0)
+                high = capacity[i] - delta if delta > 0 and capacity[i] != unbounded else unbounded
+                if low > 0 or high != unbounded:
+                    boundplace.append(i)
+                    boundlow.append(low)
+                    boundhigh.append(high)
+                    boundtransition.append(t)
+            effectstart.append(len(effectplace))
+            boundstart.append(len(boundplace))
+
+        # The bounds on each place, stored consecutively.
+        watchers = [[] for p in places]
+        for (b, i) in enumerate(boundplace):
+            watchers[i].append(b)
+        self.watchstart = watchstart = array.array("q", [0])
+        self.watch = watch = array.array("q")
+        for w in watchers:
+            watch.extend(w)
+            watchstart.append(len(watch))
+
+        # The number of violated bounds of each transition and the list of
+        # enabled transitions, with the position of each transition in
+        # that list, or -1 if it is disabled.
+        marking = self.marking
+        self.violated = violated = array.array("q", [0]) * len(transitions)
+        for b in range(len(boundplace)):
+            if not boundlow[b] <= marking[boundplace[b]] <= boundhigh[b]:
+                violated[boundtransition[b]] += 1
+        self.enabledlist = [t for t in range(len(transitions)) if violated[t] == 0]
+        self.position = array.array("q", [-1]) * len(transitions)
+        for (k, t) in enumerate(self.enabledlist):
+            self.position[t] = k
+        self.transitionindex = transitionindex
+        self.placeindex = placeindex
+        self.fired = 0
+
+    def __firing(self, heap):
+        """Returns a function that fires transition number 't', which must 
+        be enabled. Transitions that become enabled are pushed on 'heap', 
+        unless it is None. The arrays are bound to local variables once, 
+        which makes firing many transitions faster."""
+        marking = self.marking
+        effectstart = self.effectstart
+        effectplace = self.effectplace
+        effectdelta = self.effectdelta
+        watchstart = self.watchstart
+        watch = self.watch
+        boundlow = self.boundlow
+        boundhigh = self.boundhigh
+        boundtransition = self.boundtransition
+        violated = self.violated
+        enabledlist = self.enabledlist
+        position = self.position
+        push = heapq.heappush
+        def fire(t):
+            for k in range(effectstart[t], effectstart[t+1]):
+                p = effectplace[k]
+                old = marking[p]
+                new = marking[p] = old + effectdelta[k]
+                for b in watch[watchstart[p]:watchstart[p+1]]:
+                    low = boundlow[b]
+                    high = boundhigh[b]
+                    before = low <= old <= high
+                    if before != (low <= new <= high):
+                        u = boundtransition[b]
+                        if before:
+                            if violated[u] == 0:
+                                # Disable u
+                                j = position[u]
+                                last = enabledlist.pop()
+                                if last != u:
+                                    enabledlist[j] = last
+                                    position[last] = j
+                                position[u] = -1
+                            violated[u] += 1
+                        else:
+                            violated[u] -= 1
+                            if violated[u] == 0:
+                                # Enable u
+                                position[u] = len(enabledlist)
+                                enabledlist.append(u)
+                                if heap is not None:
+                                    push(heap, u)
+        return fire
+
+    def enabled(self):
+        """Returns a list of the enabled transitions, in the order of the
+        transitions of the net."""
+        return [self.transitions[t] for t in sorted(self.enabledlist)]
+
+    def is_enabled(self, transition):
+        """Returns whether 'transition' is enabled."""
+        return self.position[self.transitionindex[transition]] >= 0
+
+    def fire(self, transition):
+        """Fires 'transition'. Raises a ValueError if it is not enabled."""
+        t = self.transitionindex[transition]
+        if self.position[t] < 0:
+            raise ValueError("Transition {0} is not enabled".format(transition))
+        self.__firing(None)(t)
+        self.fired += 1
+
+    def step(self):
+        """Fires the first enabled transition and returns it. Returns None
+        if no transition is enabled."""
+        if not self.enabledlist:
+            return None
+        t = min(self.enabledlist)
+        self.__firing(None)(t)
+        self.fired += 1
+        return self.transitions[t]
+
+    def run(self, n, rng=None):
+        """Fires at most 'n' transitions and returns how many were fired.
+        Fewer are fired if the net reaches a marking in which no transition
+        is enabled. Each time, the first enabled transition is fired, unless
+        'rng' is given. Then a transition is picked from the enabled
+        transitions using 'rng', which is a random.Random or a seed."""
+        enabledlist = self.enabledlist
+        count = 0
+        if rng is None:
+            # Keep a heap of the enabled transitions. It can contain
+            # transitions that were disabled in the meantime.
+            position = self.position
+            heap = list(enabledlist)
+            heapq.heapify(heap)
+            fire = self.__firing(heap)
+            pop = heapq.heappop
+            push = heapq.heappush
+            while count < n and heap:
+                t = pop(heap)
+                if position[t] < 0:
+                    continue
+                fire(t)
+                if position[t] >= 0:
+                    push(heap, t)
+                count += 1
+        else:
+            if not isinstance(rng, random.Random):
+                rng = random.Random(rng)
+            fire = self.__firing(None)
+            pick = rng.random
+            while count < n and enabledlist:
+                fire(enabledlist[int(pick() * len(enabledlist))])
+                count += 1
+        self.fired += count
+        return count
+
+    def tokens(self, place):
+        """Returns the number of tokens in 'place' in the current marking."""
+        return self.marking[self.placeindex[place]]
+
+    def apply(self):
+        """Sets the tokens of the places to the current marking."""
+        for (p, tokens) in zip(self.places, self.marking):
+            p.tokens = tokens
+
+
+def integer(value, default, element, name):
+    """Returns 'value' as an integer, or 'default' if it is None."""
+    if value is None:
+        return default
+    if not isinstance(value, int):
+        raise ValueError("The {0} of {1} is not an integer: {2!r}".format(name, element, value))
+    return int(value)
+
+
+def bound(place):
+    """Returns the capacity of 'place', or 'unbounded' if it has none."""
+    capacity = integer(place.capacity, unbounded, place, "capacity")
+    if capacity < 0:
+        raise ValueError("The capacity of {0} is negative: {1!r}".format(place, capacity))
+    return capacity
+
+
+def lookup(index, transition, arc):
+    """Returns the number of 'transition', which is connected by 'arc'."""
+    try:
+        return index[transition]
+    except KeyError:
+        raise ValueError("{0} connects to a transition of another Petrinet".format(arc))
+
+
+if __name__ == '__main__':
+    import os
+
+    if len(sys.argv)==1:
+        sys.argv.append("-")
+    if not 2 <= len(sys.argv) <= 4 or not (sys.argv[1]=="-" or os.path.isfile(sys.argv[1])):
+        print("Usage: {0} [filename.m1|- [firings [seed]]]".format(sys.argv[0]))
+        sys.exit(1)
+
+    import metamodel
+
+    net = metamodel.load("petrinets.m2")
+    netin = net.instance().load(sys.argv[1])
+
+    simulation = Simulation(netin.root())
+    simulation.run(int(sys.argv[2]) if len(sys.argv) > 2 else 1, int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    simulation.apply()
+    print(netin)